@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import concurrent.futures
+import logging
+
+
+class BackgroundPool(object):
+    u"""job をバックグラウンドのスレッドで実行し、後処理を呼び出し元のスレッドで行う
+
+    submit(job, finish) で job を登録し、完了した job は finish(job) で後処理を行う。
+    finish は完了した順に、submit/poll/wait を呼び出したスレッドで呼び出すので、
+    後処理では集計やログ出力をスレッドを気にせずに行える。
+    実行中・未処理の job が maxPending 個ある場合、submit はどれかが完了するまで待つ。
+    workers が 0 の場合は submit の中で job を実行する。
+    サブクラスは _run(job) で job を実行し、_done(job, finish) で後処理の前に集計を行う。
+    """
+
+    # ログに出力する名前
+    NAME = 'background'
+    # maxPending を省略した場合の workers あたりの数
+    PENDING_PER_WORKER = 2
+
+    def __init__(self, workers=0, maxPending=None):
+        self._Logger = logging.getLogger(self.__class__.__name__)
+        self._Workers = workers
+        if maxPending is None:
+            maxPending = workers * self.PENDING_PER_WORKER
+        self._MaxPending = max(maxPending, workers, 1)
+        self._Pool = None
+        # (future, finish) を submit の順に保持する
+        self._Pending = collections.deque()
+
+    @property
+    def workers(self):
+        return self._Workers
+
+    @property
+    def pending(self):
+        return len(self._Pending)
+
+    def _getPool(self):
+        if self._Pool is None:
+            self._Logger.debug('Starting %s pool with %s workers', self.NAME, self._Workers)
+            self._Pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._Workers)
+        return self._Pool
+
+    def _run(self, job):
+        return job.run()
+
+    def _done(self, job, finish):
+        finish(job)
+
+    def submit(self, job, finish):
+        if self._Workers <= 0:
+            self._done(self._run(job), finish)
+            return
+        self.poll()
+        while len(self._Pending) >= self._MaxPending:
+            self._Logger.debug('Waiting for %s: %s jobs pending', self.NAME, len(self._Pending))
+            self._finish(concurrent.futures.FIRST_COMPLETED)
+        self._Pending.append((
+            self._getPool().submit(self._run, job),
+            finish,
+        ))
+
+    def poll(self):
+        u"""完了している job の後処理を行う"""
+        self._finish(None)
+
+    def wait(self):
+        u"""すべての job の完了を待ち、後処理を行う"""
+        while self._Pending:
+            self._finish(concurrent.futures.FIRST_COMPLETED)
+
+    def _finish(self, returnWhen):
+        if returnWhen is not None and self._Pending:
+            concurrent.futures.wait(
+                [future for future, _ in self._Pending],
+                return_when=returnWhen,
+            )
+        while True:
+            entry = next((entry for entry in self._Pending if entry[0].done()), None)
+            if entry is None:
+                return
+            # finish が例外を投げても残りの job を待てるよう先に取り除く
+            self._Pending.remove(entry)
+            future, finish = entry
+            self._done(future.result(), finish)
+
+    def shutdown(self):
+        try:
+            self.wait()
+        finally:
+            if self._Pool is not None:
+                self._Pool.shutdown()
+                self._Pool = None
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import logging
+
+
+# ワーカープロセスで変換に使用するオブジェクト (factory(opts) の結果)
+_Converter = None
+
+
+class _RecordHandler(logging.Handler):
+    u"""ログをプロセス間で受け渡せる形で保持する"""
+
+    def __init__(self):
+        super(_RecordHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        data = dict(record.__dict__)
+        data['msg'] = record.getMessage()
+        data['args'] = None
+        if record.exc_info:
+            data['exc_text'] = logging.Formatter().formatException(record.exc_info)
+        data['exc_info'] = None
+        self.records.append(data)
+
+
+def _initWorker(factory, opts, levels):
+    global _Converter
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+    _Converter = factory(opts)
+
+
+def _convertBook(kind, indexes, file, toDir):
+    u"""ワーカーで 1 冊を変換し、(成功したか, ログ, 本ごとの集計) を返す
+
+    ログはまとめて呼び出し元で出力し、他の本のログと混ざらないようにする。
+    """
+    root = logging.getLogger()
+    handlers = root.handlers
+    handler = _RecordHandler()
+    root.handlers = [handler]
+    succeeded = False
+    try:
+        failures = _Converter.failures
+        copiers = _Converter.copiers(kind)
+        for index in indexes:
+            copiers[index].convert(file, toDir)
+        _Converter.wait()
+        # kindlegen の後処理の失敗は例外にならずログに出力済み
+        succeeded = _Converter.failures == failures
+    except Exception:
+        logging.getLogger(BookScheduler.__name__).exception('Failed to convert %s', file['path'])
+    finally:
+        root.handlers = handlers
+    return succeeded, handler.records, _Converter.stats.takeBooks()
+
+
+class BookScheduler(object):
+    u"""本単位の変換をプロセスプールで並列に実行する
+
+    CopyingIndexGenerator に渡すと、IndexScanner.scan は 2 回に分けて呼び出す。
+        1 回目 (planning): copier.plan() で変換する本を集め、index.html は書き込まない
+        run(): 集めた本をプロセスプールで変換する
+        2 回目: 1 回目の plan() の結果で index.html を書き込む
+    --max, --only の判定や件数は 1 回目に呼び出し元のプロセスで行う。
+    同じ本の copier (epub, mobi) は同じワーカーで続けて変換する。
+    変換に失敗した本は index.html に含めない。
+
+    factory(opts) はワーカーごとに呼び出し、次のメソッドを持つオブジェクトを返す。
+        copiers(kind): CopyingIndexGenerator に渡したものと同じ並びの copier のリスト
+        wait(): バックグラウンドの処理 (kindlegen) の完了を待つ
+        failures: バックグラウンドの処理に失敗した本の数
+        stats: pagestats.StatsCollector
+    kind は CopyingIndexGenerator の出力先のディレクトリ。
+    """
+
+    def __init__(self, jobs, factory, opts, stats=None):
+        self._Logger = logging.getLogger(self.__class__.__name__)
+        self._Jobs = jobs
+        self._Factory = factory
+        self._Opts = opts
+        # 変換した本の集計を加える pagestats.StatsCollector
+        self._Stats = stats
+        self._Planning = True
+        # (kind, path) -> [result]
+        self._Results = {}
+        # (kind, indexes, file, toDir)
+        self._Queue = []
+        # (kind, path) -> 変換に失敗した copier の位置
+        self._Failures = {}
+
+    @property
+    def planning(self):
+        return self._Planning
+
+    @property
+    def failures(self):
+        return len(self._Failures)
+
+    def __call__(self, kind, copiers, file, toDir, opts):
+        u"""file に対する copier の結果のリストを返す。planning 中は変換を予約する"""
+        key = (kind, file['path'])
+        if not self._Planning:
+            results = list(self._Results.get(key, [None] * len(copiers)))
+            for index in self._Failures.get(key, []):
+                results[index] = None
+            return results
+
+        results = []
+        indexes = []
+        for index, copier in enumerate(copiers):
+            result, convert = copier.plan(file, toDir, opts)
+            results.append(result)
+            if convert:
+                indexes.append(index)
+        self._Results[key] = results
+        if indexes:
+            self._Queue.append((kind, indexes, file, toDir))
+        return results
+
+    def run(self):
+        u"""予約した本を変換する。終わると planning を終える"""
+        queue, self._Queue = self._Queue, []
+        self._Planning = False
+        if not queue:
+            return
+        self._Logger.info('Converting %s books with %s jobs', len(queue), self._Jobs)
+        # ワーカーでも呼び出し元と同じログレベルにする
+        levels = dict(
+            (name, logger.level)
+            for name, logger in logging.root.manager.loggerDict.items()
+            if isinstance(logger, logging.Logger) and logger.level != logging.NOTSET
+        )
+        levels[''] = logging.getLogger().level
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=self._Jobs,
+            initializer=_initWorker,
+            initargs=(self._Factory, self._Opts, levels),
+        ) as pool:
+            futures = dict(
+                (pool.submit(_convertBook, kind, indexes, file, toDir), (kind, indexes, file))
+                for kind, indexes, file, toDir in queue
+            )
+            for future in concurrent.futures.as_completed(futures):
+                kind, indexes, file = futures[future]
+                try:
+                    succeeded, records, books = future.result()
+                except Exception:
+                    self._Logger.exception('Worker failed for %s', file['path'])
+                    succeeded, records, books = False, [], []
+                for data in records:
+                    record = logging.makeLogRecord(data)
+                    logging.getLogger(record.name).handle(record)
+                if self._Stats is not None:
+                    for name, stats in books:
+                        self._Stats.addBook(name, stats)
+                if not succeeded:
+                    self._Failures[(kind, file['path'])] = indexes
+        if self._Failures:
+            self._Logger.error('Failed to convert %s books', len(self._Failures))
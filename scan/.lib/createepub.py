@@ -3,7 +3,6 @@
 
 import argparse
 import datetime
-import io
 import json
 import logging
 import os.path
@@ -11,6 +10,9 @@ import re
 from xml.dom import minidom
 import zipfile
 
+import pagearchive
+import pageexecutor
+
 
 """
 # workaround to make keep attribute orders
@@ -71,112 +73,154 @@ minidom.Element._get_attributes = DecorateElement_get_attributes(minidom.Element
 class ZipToKepubEpub(object):
     VERSION = 1559310345
 
-    def __init__(self, optimizer):
+    def __init__(self, optimizer, executor=None, singlePass=False):
         self._Logger = logging.getLogger(self.__class__.__name__)
         self._count = 0
         self._Optimizer = optimizer
+        if executor is None:
+            executor = pageexecutor.PageExecutor(workers=1)
+        self._Executor = executor
+        self._SinglePass = singlePass
 
     def __call__(self, file, toDir, opts):
+        result, convert = self.plan(file, toDir, opts)
+        if convert:
+            self.convert(file, toDir)
+        return result
+
+    def plan(self, file, toDir, opts):
+        u"""変換せずに、__call__ の戻り値と変換が必要かを (result, convert) で返す
+
+        変換が必要な場合は --max の件数に数える。
+        """
         fromFile = file['path']
         filename = file['basename'] + '.kepub.epub'
         toFile = os.path.join(toDir, filename)
+        result = {
+            'filename': filename,
+            'path': toFile,
+        }
 
         if os.path.exists(toFile):
-            return {
-                'filename': filename,
-                'path': toFile,
-            }
+            return result, False
             # 2021-11-08 新規生成中止
             toStat = os.stat(toFile)
             if toStat.st_mtime > self.VERSION and file.get('mtime', 0) > 0 and toStat.st_mtime >= file['mtime']:
-                return {
-                    'filename': filename,
-                    'path': toFile,
-                }
+                return result, False
 
         # 2021-11-08 新規生成中止
-        return None
+        return None, False
 
         only = getattr(opts, 'only', None)
         if only and not fromFile.startswith(only):
-            return None
+            return None, False
 
         maxCount = getattr(opts, 'max', -1)
         if maxCount >= 0 and self._count >= maxCount:
-            return None
+            return None, False
         self._count = self._count + 1
+        return result, True
+
+    def convert(self, file, toDir):
+        u"""plan() で変換が必要とした本を変換する
+
+        2021-11-08 に新規生成を中止したため plan() は変換を返さず、現在は呼び出されない。
+        ページの処理は ZipToMobi と揃えておく。
+        """
+        fromFile = file['path']
+        toFile = os.path.join(toDir, file['basename'] + '.kepub.epub')
 
         self._Logger.info('Converting %s -> %s', fromFile, toFile)
+        stats = self._Executor.stats.beginBook(toFile)
 
         if not os.path.exists(toDir):
             self._Logger.info('Creating: %s', toDir)
-            os.makedirs(toDir)
+            os.makedirs(toDir, exist_ok=True)
 
         tmpFile = toFile + '.tmp'
-        with zipfile.ZipFile(fromFile, 'r') as rh, zipfile.ZipFile(tmpFile, 'w') as wh:
-            wh.writestr(
-                'mimetype',
-                'application/epub+zip',
-                compress_type=zipfile.ZIP_STORED,
-            )
-            wh.writestr(
-                'META-INF/container.xml',
-                self._CreateContainer(),
-            )
-            fileList = []
-
-            self._Optimizer.reset()
-            if self._Optimizer.need_prescan():
+        try:
+            with zipfile.ZipFile(fromFile, 'r') as rh, zipfile.ZipFile(tmpFile, 'w') as wh, pagearchive.PageWriter(wh, stats) as writer:
+                wh.writestr(
+                    'mimetype',
+                    'application/epub+zip',
+                    compress_type=zipfile.ZIP_STORED,
+                )
+                wh.writestr(
+                    'META-INF/container.xml',
+                    self._CreateContainer(),
+                )
+                fileList = []
+
+                archive = pagearchive.PageArchive(rh, self._SinglePass, stats)
+                self._Optimizer.reset()
+                if self._Optimizer.need_prescan():
+                    for f in sorted(rh.infolist(), key=(lambda x: x.filename)):
+                        if f.filename.endswith('/'):
+                            continue
+                        basename = f.filename.split('/')[-1]
+                        ext = os.path.splitext(basename)[1]
+                        if ext.lower() not in ('.jpg', '.jpeg'):
+                            continue
+                        archive.prescan(self._Optimizer, basename, f)
+                self._Optimizer.prepare_optimize()
+
+                metadataFile = None
+
+                pages = []
                 for f in sorted(rh.infolist(), key=(lambda x: x.filename)):
                     if f.filename.endswith('/'):
                         continue
                     basename = f.filename.split('/')[-1]
+                    if basename == 'metadata.json':
+                        metadataFile = f
+                        continue
                     ext = os.path.splitext(basename)[1]
                     if ext.lower() not in ('.jpg', '.jpeg'):
+                        self._Logger.warning('Skipped: %s', f.filename)
                         continue
-                    self._Optimizer.prescan(basename, io.BytesIO(rh.read(f)))
-            self._Optimizer.prepare_optimize()
-
-            metadataFile = None
-
-            for f in sorted(rh.infolist(), key=(lambda x: x.filename)):
-                if f.filename.endswith('/'):
-                    continue
-                basename = f.filename.split('/')[-1]
-                if basename == 'metadata.json':
-                    metadataFile = f
-                    continue
-                ext = os.path.splitext(basename)[1]
-                if ext.lower() not in ('.jpg', '.jpeg'):
-                    self._Logger.warning('Skipped: %s', f.filename)
-                    continue
-                filenameInZip = 'content/' + basename
-                fileList.append(filenameInZip)
-                w = io.BytesIO()
-                self._Optimizer.optimize(
-                    basename,
-                    io.BytesIO(rh.read(f)),
-                    w,
+                    pages.append((basename, f))
+
+                def openOutputs(basename, divide):
+                    filenameInZip = 'content/' + basename
+                    fileList.append(filenameInZip)
+                    return [writer.open(filenameInZip)]
+
+                self._Executor.writePages(
+                    self._Optimizer,
+                    archive,
+                    (
+                        (basename, f, False)
+                        for basename, f in pages
+                    ),
+                    openOutputs,
                 )
-                wh.writestr(
-                    filenameInZip,
-                    w.getvalue(),
+                writer.close()
+                outputBytes = writer.bytesWritten
+
+                inputBytes = sum(f.file_size for _, f in pages)
+                self._Logger.info(
+                    'Pages: %s bytes -> %s bytes (%s bytes saved)',
+                    inputBytes,
+                    outputBytes,
+                    inputBytes - outputBytes,
                 )
 
-            metadata = {}
-            if metadataFile is not None:
-                metadata = json.loads(rh.read(metadataFile))
+                metadata = {}
+                if metadataFile is not None:
+                    metadata = json.loads(rh.read(metadataFile))
 
-            wh.writestr(
-                'metadata.opf',
-                self._CreateMetadata(file, fileList, metadata),
-            )
+                wh.writestr(
+                    'metadata.opf',
+                    self._CreateMetadata(file, fileList, metadata),
+                )
+        except Exception:
+            # 書きかけの epub を残さない
+            os.unlink(tmpFile)
+            raise
 
         os.rename(tmpFile, toFile)
-        return {
-            'filename': filename,
-            'path': toFile,
-        }
+        self._Executor.stats.endBook()
+        self._Logger.info('Stages: %s', stats.format())
 
     def _CreateContainer(self):
         doc = minidom.Document()
@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import calendar
 import datetime
 import io
 import json
@@ -15,30 +14,54 @@ import tempfile
 import time
 import zipfile
 
+import kindlegenpool
+import mobiwriter
+import pagearchive
+import pageexecutor
+import pagestats
+import s3
+import srcsstrip
+import uploadqueue
+
 
 class ZipToMobi(object):
     VERSION = 1559310345
     SIZE = (758, 1024)
 
-    def __init__(self, optimizer, skip=False, preseveEpub=False, skipMobi=False, s3Bucket=None):
+    def __init__(self, optimizer, skip=False, preseveEpub=False, skipMobi=False, s3Bucket=None, executor=None, singlePass=False, kindlegenPool=None, nativeMobi=False, s3Inventory=None, uploadQueue=None, s3Hashes=None):
         self._Logger = logging.getLogger(self.__class__.__name__)
         self._count = 0
+        # kindlegen 以降の後処理に失敗した本の数
+        self._failures = 0
         self._skip = skip
         self._Optimizer = optimizer
+        if executor is None:
+            executor = pageexecutor.PageExecutor(workers=1)
+        self._Executor = executor
+        self._SinglePass = singlePass
         self._PreserveEpub = preseveEpub
         self._SkipMobi = skipMobi
         self._S3Bucket = s3Bucket
+        # s3Bucket の s3.S3Inventory。ある場合はアップロードの要否を一覧から判定する
+        self._S3Inventory = s3Inventory
+        # S3 へのアップロードを実行するキュー。共有すると他の copier のアップロードと並行に実行する
+        if uploadQueue is None:
+            uploadQueue = uploadqueue.UploadQueue()
+        self._UploadQueue = uploadQueue
+        # s3.ETagCache。ある場合は更新日時ではなく内容のハッシュで S3 の更新の要否を判定する
+        self._S3Hashes = s3Hashes
+        # kindlegen を実行するプール。共有すると他の copier の kindlegen と並行に実行する
+        if kindlegenPool is None:
+            kindlegenPool = kindlegenpool.KindlegenPool()
+        self._KindlegenPool = kindlegenPool
+        # kindlegen を使わずに mobiwriter で mobi を書き出す
+        self._NativeMobi = nativeMobi
 
         self._kindlegen = self.find_executable('kindlegen')
 
-        self._SRCSStripper = None
-        try:
-            # https://www.mobileread.com/forums/showthread.php?t=96903
-            # https://pypi.org/project/kindlestrip/
-            import kindlestrip # type: ignore
-            self._SRCSStripper = kindlestrip.SRCSStripper
-        except ImportError:
-            self._Logger.info('kindlestrip was not found. SRCS strip feature is disabled.')
+    @property
+    def failures(self):
+        return self._failures
 
     def find_executable(self, executable):
         if os.environ.get('PATHEXT'):
@@ -71,127 +94,95 @@ class ZipToMobi(object):
         return None
 
     def __call__(self, file, toDir, opts):
+        result, convert = self.plan(file, toDir, opts)
+        if convert:
+            self.convert(file, toDir)
+        return result
+
+    def plan(self, file, toDir, opts):
+        u"""変換せずに、__call__ の戻り値と変換が必要かを (result, convert) で返す
+
+        変換が必要な場合は --max の件数に数える。
+        """
         fromFile = file['path']
         filename = file['basename'] + '.mobi'
         toFile = os.path.join(toDir, filename)
+        result = {
+            'filename': filename,
+            'path': toFile,
+        }
 
         if os.path.exists(toFile):
             toStat = os.stat(toFile)
             if toStat.st_mtime > self.VERSION and file.get('mtime', 0) > 0 and toStat.st_mtime >= file['mtime']:
-                return {
-                    'filename': filename,
-                    'path': toFile,
-                }
+                return result, False
 
         if self._skip:
-            return None
+            return None, False
 
         only = getattr(opts, 'only', None)
         if only and not fromFile.startswith(only):
-            return None
+            return None, False
 
         maxCount = getattr(opts, 'max', -1)
         if maxCount >= 0 and self._count >= maxCount:
-            return None
+            return None, False
         self._count = self._count + 1
+        return result, True
+
+    def convert(self, file, toDir):
+        u"""plan() で変換が必要とした本を変換する
+
+        kindlegen を共有のプールで実行する場合、mobi の完成は wait() で待つ。
+        """
+        fromFile = file['path']
+        toFile = os.path.join(toDir, file['basename'] + '.mobi')
 
         self._Logger.info('Converting %s -> %s', fromFile, toFile)
+        stats = self._Executor.stats.beginBook(toFile)
 
         if not os.path.exists(toDir):
             self._Logger.info('  Creating: %s', toDir)
-            os.makedirs(toDir)
+            os.makedirs(toDir, exist_ok=True)
 
         epubScanStartTime = time.time()
+        if self._NativeMobi:
+            self._ConvertNative(file, toFile, stats, epubScanStartTime)
+            return
+
         fd, tmpEpubFile = tempfile.mkstemp(suffix='.epub')
         os.close(fd)
-        with zipfile.ZipFile(fromFile, 'r') as rh, zipfile.ZipFile(tmpEpubFile, 'w') as wh:
-            wh.writestr(
-                'mimetype',
-                'application/epub+zip',
-                compress_type=zipfile.ZIP_STORED,
-            )
-            wh.writestr(
-                'META-INF/container.xml',
-                self._CreateContainer(),
-            )
-            fileList = []
-            metadataFile = None
-            metadata = {}
-
-            # self._Optimizer.reset(self.SIZE)
-            self._Optimizer.reset()
-            if self._Optimizer.need_prescan():
-                for f in sorted(rh.infolist(), key=(lambda x: x.filename)):
-                    if f.filename.endswith('/'):
-                        continue
-                    basename = f.filename.split('/')[-1]
-                    if basename == 'metadata.json':
-                        metadataFile = f
-                        continue
-                    ext = os.path.splitext(basename)[1]
-                    if ext.lower() not in ('.jpg', '.jpeg'):
-                        continue
-                    self._Optimizer.prescan(basename, io.BytesIO(rh.read(f)))
-
-            if metadataFile is not None and not metadata:
-                metadata = json.loads(rh.read(metadataFile))
-                if metadata.get('page-progression-direction') == 'ltr':
-                    self._Optimizer.setLTR()
-
-            self._Optimizer.prepare_optimize()
-
-            epubGenerateStartTime = time.time()
-            for f in rh.infolist():
-                if f.filename.endswith('/'):
-                    continue
-                basename = f.filename.split('/')[-1]
-                if basename == 'metadata.json':
-                    metadataFile = f
-                    continue
-                ext = os.path.splitext(basename)[1]
-                if ext.lower() not in ('.jpg', '.jpeg'):
-                    self._Logger.warning('  Skipped: %s', f.filename)
-                    continue
-                if self._Optimizer.divideMode:
-                    w = (io.BytesIO(), io.BytesIO())
-                    self._Optimizer.optimize(
-                        basename,
-                        io.BytesIO(rh.read(f)),
-                        w,
-                    )
-                    basenamebase = os.path.splitext(basename)[0]
-                    for index in (0, 1):
-                        basename = '{0}.{1}{2}'.format(basenamebase, index + 1, ext)
-                        filenameInZip = 'content/' + basename
-                        fileList.append(filenameInZip)
-                        wh.writestr(
-                            filenameInZip,
-                            w[index].getvalue(),
-                        )
-                else:
-                    filenameInZip = 'content/' + basename
-                    fileList.append(filenameInZip)
-                    w = io.BytesIO()
-                    self._Optimizer.optimize(
-                        basename,
-                        io.BytesIO(rh.read(f)),
-                        w,
-                    )
-                    wh.writestr(
-                        filenameInZip,
-                        w.getvalue(),
-                    )
+        try:
+            with zipfile.ZipFile(fromFile, 'r') as rh, zipfile.ZipFile(tmpEpubFile, 'w') as wh, pagearchive.PageWriter(wh, stats) as writer:
+                wh.writestr(
+                    'mimetype',
+                    'application/epub+zip',
+                    compress_type=zipfile.ZIP_STORED,
+                )
+                wh.writestr(
+                    'META-INF/container.xml',
+                    self._CreateContainer(),
+                )
+                fileList = []
 
-            if metadataFile is not None and not metadata:
-                metadata = json.loads(rh.read(metadataFile))
-                if metadata.get('page-progression-direction') == 'ltr':
-                    self._Optimizer.setLTR()
-            self._Optimizer.report()
+                def openOutputs(filenames):
+                    fileList.extend(filenames)
+                    return [writer.open(filename) for filename in filenames]
 
-            wh.writestr(
-                'metadata.opf',
-                self._CreateMetadata(file, fileList, metadata),
-            )
+                def closeOutputs():
+                    writer.close()
+                    return writer.bytesWritten
+
+                metadata, epubGenerateStartTime = self._OptimizePages(rh, stats, openOutputs, closeOutputs)
+
+                wh.writestr(
+                    'metadata.opf',
+                    self._CreateMetadata(file, fileList, metadata),
+                )
+        except Exception:
+            # 書きかけの epub を残さない
+            os.unlink(tmpEpubFile)
+            raise
 
         mobiGenerateStartTime = time.time()
         tmpMobiFile = tmpEpubFile + '.mobi'
@@ -203,6 +194,29 @@ class ZipToMobi(object):
                 tmpEpubFile,
             ]).rstrip()
 
+        # 本の集計は kindlegen を待たずに終え、次の本の最適化を始められるようにする
+        self._Executor.stats.endBook()
+
+        def finish(job):
+            # kindlegen を並行に実行する場合は次の本の submit や wait の中で呼び出されるので、
+            # 例外を投げずにこの本の失敗としてログに残す
+            try:
+                self._FinishMobi(
+                    job,
+                    file,
+                    toFile,
+                    tmpEpubFile,
+                    tmpMobiFile,
+                    stats,
+                    (epubScanStartTime, epubGenerateStartTime, mobiGenerateStartTime),
+                )
+            except Exception:
+                self._Logger.exception('  Failed to convert %s', toFile)
+                self._failures += 1
+                for tmpFile in (tmpMobiFile, toFile + '.tmp', tmpEpubFile):
+                    if os.path.exists(tmpFile):
+                        os.unlink(tmpFile)
+
         if not self._SkipMobi:
             self._Logger.debug('  Launching %s', self._kindlegen)
             cmd = [
@@ -214,44 +228,195 @@ class ZipToMobi(object):
                 '-o',
                 os.path.basename(tmpMobiFile),
             ]
-            p = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+            self._KindlegenPool.submit(kindlegenpool.KindlegenJob(toFile, cmd), finish)
+        else:
+            finish(None)
+
+    def _OptimizePages(self, rh, stats, openOutputs, closeOutputs):
+        u"""rh (元の zip) のページを最適化して書き込む
+
+        openOutputs(filenames) は content/ 以下のファイル名のリストを受け取り、
+        それぞれの書き込み先のリストを返す。
+        closeOutputs() は書き込みを終えた後に呼び出し、出力したバイト数を返す。
+        (metadata.json の内容, 最適化を始めた時刻) を返す。
+        """
+        metadataFile = None
+        metadata = {}
+
+        archive = pagearchive.PageArchive(rh, self._SinglePass, stats)
+        # self._Optimizer.reset(self.SIZE)
+        self._Optimizer.reset()
+        if self._Optimizer.need_prescan():
+            for f in sorted(rh.infolist(), key=(lambda x: x.filename)):
+                if f.filename.endswith('/'):
+                    continue
+                basename = f.filename.split('/')[-1]
+                if basename == 'metadata.json':
+                    metadataFile = f
+                    continue
+                ext = os.path.splitext(basename)[1]
+                if ext.lower() not in ('.jpg', '.jpeg'):
+                    continue
+                archive.prescan(self._Optimizer, basename, f)
+
+        if metadataFile is not None and not metadata:
+            metadata = json.loads(rh.read(metadataFile))
+            if metadata.get('page-progression-direction') == 'ltr':
+                self._Optimizer.setLTR()
+
+        self._Optimizer.prepare_optimize()
+
+        optimizeStartTime = time.time()
+        divideMode = self._Optimizer.divideMode
+        pages = []
+        for f in rh.infolist():
+            if f.filename.endswith('/'):
+                continue
+            basename = f.filename.split('/')[-1]
+            if basename == 'metadata.json':
+                metadataFile = f
+                continue
+            ext = os.path.splitext(basename)[1]
+            if ext.lower() not in ('.jpg', '.jpeg'):
+                self._Logger.warning('  Skipped: %s', f.filename)
+                continue
+            pages.append((basename, f))
+
+        def openPageOutputs(basename, divide):
+            if divide:
+                basenamebase, ext = os.path.splitext(basename)
+                filenames = [
+                    'content/{0}.{1}{2}'.format(basenamebase, index + 1, ext)
+                    for index in (0, 1)
+                ]
+            else:
+                filenames = ['content/' + basename]
+            return openOutputs(filenames)
+
+        self._Executor.writePages(
+            self._Optimizer,
+            archive,
+            (
+                (basename, f, divideMode)
+                for basename, f in pages
+            ),
+            openPageOutputs,
+        )
+        outputBytes = closeOutputs()
+
+        inputBytes = sum(f.file_size for _, f in pages)
+        self._Logger.info(
+            '  Pages: %s bytes -> %s bytes (%s bytes saved)',
+            inputBytes,
+            outputBytes,
+            inputBytes - outputBytes,
+        )
+
+        if metadataFile is not None and not metadata:
+            metadata = json.loads(rh.read(metadataFile))
+            if metadata.get('page-progression-direction') == 'ltr':
+                self._Optimizer.setLTR()
+        self._Optimizer.report()
+        return metadata, optimizeStartTime
+
+    def _ConvertNative(self, file, toFile, stats, epubScanStartTime):
+        u"""kindlegen を使わずに mobiwriter で mobi を書き出す
+
+        最適化したページはファイル名順に並べるため、書き出すまでメモリに保持する。
+        """
+        pages = {}
+
+        def openOutputs(filenames):
+            outputs = [io.BytesIO() for _ in filenames]
+            pages.update(zip(filenames, outputs))
+            return outputs
+
+        def closeOutputs():
+            return sum(len(output.getbuffer()) for output in pages.values())
+
+        with zipfile.ZipFile(file['path'], 'r') as rh:
+            metadata, epubGenerateStartTime = self._OptimizePages(rh, stats, openOutputs, closeOutputs)
+
+        mobiGenerateStartTime = time.time()
+        with stats.timer('mobiWrite'):
+            writer = mobiwriter.MobiWriter(
+                file['title'],
+                author=file['author'],
+                published=datetime.datetime.fromtimestamp(file['mtime'], datetime.timezone.utc),
+                language=metadata.get('language', 'ja'),
+                direction=metadata.get('page-progression-direction', 'rtl'),
+                resolution=self.SIZE,
             )
-            stdout, stderr = p.communicate()
-            if p.returncode != 0:
-                self._Logger.error(
-                    'command failed with %s: %s',
-                    p.returncode,
-                    cmd,
-                )
-                self._Logger.error('stdout from kindlegen: %s', stdout)
-                self._Logger.error('stderr from kindlegen: %s', stderr)
-                raise('Command failed with {0}: {1}'.format(p.returncode, cmd))
-
-            self._Logger.debug('stdout from kindlegen: %s', stdout)
-            self._Logger.debug('stderr from kindlegen: %s', stderr)
-
-            with open(tmpMobiFile, 'rb') as fh:
-                data = fh.read()
-            if self._SRCSStripper:
-                stripper = self._SRCSStripper(data)
-                data = stripper.getResult()
+            for filename in sorted(pages):
+                writer.addPage(pages.pop(filename).getvalue())
             # cross-device link にならないよう別名で書き出し
             toFileTmp = toFile + '.tmp'
             with open(toFileTmp, 'wb') as fh:
-                fh.write(data)
+                writer.write(fh)
+            os.rename(toFileTmp, toFile)
+
+        self._Executor.stats.endBook()
+        self._FinishMobi(
+            None,
+            file,
+            toFile,
+            None,
+            None,
+            stats,
+            (epubScanStartTime, epubGenerateStartTime, mobiGenerateStartTime),
+        )
+
+    def wait(self):
+        u"""バックグラウンドで実行中の kindlegen とアップロードの完了を待ち、後処理を行う"""
+        self._KindlegenPool.wait()
+        self._UploadQueue.wait()
+
+    def _FinishMobi(self, job, file, toFile, tmpEpubFile, tmpMobiFile, stats, startTimes):
+        u"""kindlegen の完了後に mobi を strip・rename し、S3 にアップロードする
+
+        job が None の場合 (skipMobi) は epub の後始末のみ行う。
+        tmpEpubFile も None の場合 (nativeMobi) は mobi の書き出しは済んでいる。
+        所要時間は endBook() 済みの本の集計 stats に加える。
+        """
+        epubScanStartTime, epubGenerateStartTime, mobiGenerateStartTime = startTimes
+        finishStats = pagestats.PageStats()
+        if job is not None:
+            finishStats.add('kindlegen', job.seconds)
+            if not job.succeeded:
+                if job.timedOut:
+                    self._Logger.error('command timed out: %s', job.cmd)
+                else:
+                    self._Logger.error(
+                        'command failed with %s: %s',
+                        job.returncode,
+                        job.cmd,
+                    )
+                self._Logger.error('stdout from kindlegen: %s', job.stdout)
+                self._Logger.error('stderr from kindlegen: %s', job.stderr)
+                raise RuntimeError('Command failed with {0}: {1}'.format(job.returncode, job.cmd))
+
+            self._Logger.debug('stdout from kindlegen: %s', job.stdout)
+            self._Logger.debug('stderr from kindlegen: %s', job.stderr)
+
+            # cross-device link にならないよう別名で書き出し
+            toFileTmp = toFile + '.tmp'
+            with finishStats.timer('srcsStrip'):
+                stripped = srcsstrip.stripFile(tmpMobiFile, toFileTmp)
+            self._Logger.debug('  Stripped SRCS: %s bytes', stripped)
+            os.unlink(tmpMobiFile)
 
             os.rename(toFileTmp, toFile)
 
-        if not self._PreserveEpub:
-            os.unlink(tmpEpubFile)
-        else:
-            os.rename(tmpEpubFile, toFile + '.epub')
+        if tmpEpubFile is not None:
+            if not self._PreserveEpub:
+                os.unlink(tmpEpubFile)
+            else:
+                os.rename(tmpEpubFile, toFile + '.epub')
 
         mobiGenerateEndTime = time.time()
 
+        if self._KindlegenPool.workers > 0:
+            self._Logger.info('Finished %s', toFile)
         self._Logger.info(
             '  Done took %ss (Prescan: %ss,  Epub: %ss Epub to Mobi: %ss',
             int(mobiGenerateEndTime - epubScanStartTime),
@@ -261,65 +426,98 @@ class ZipToMobi(object):
         )
 
         if self._S3Bucket:
-            self._UploadToS3(self._S3Bucket, file)
+            with finishStats.timer('s3Check'):
+                self._UploadToS3(self._S3Bucket, file, toFile)
 
-        return {
-            'filename': filename,
-            'path': toFile,
-        }
+        self._Executor.stats.addToBook(toFile, finishStats)
+        self._Logger.info('  Stages: %s', stats.format())
 
-    def _UploadToS3(self, bucket, file):
-        object = bucket.Object(file['relative'])
-        if not self._CheckUploadToS3(object, file):
+    def _UploadToS3(self, bucket, file, toFile):
+        u"""必要であれば file を bucket (s3.Storage) にアップロードする
+
+        アップロードは共有のキューで実行し、完了後の集計は toFile の本に加える。
+        """
+        key = file['relative']
+        if not self._CheckUploadToS3(bucket, key, file):
             return
-        self._Logger.info('  Uploading to s3://%s/%s...', object.bucket_name, object.key)
-        startTime = time.time()
-        import botocore
+        self._Logger.info('  Uploading to s3://%s/%s...', bucket.name, key)
+
+        metadata = None
+        if self._S3Hashes is not None:
+            metadata = {'md5': self._S3Hashes.md5(file['path'])}
+
+        def finish(job):
+            if not job.succeeded:
+                self._Logger.error('  Uploading to %s failed: %s', job.name, job.error)
+                return
+            if self._S3Inventory is not None:
+                etag = None
+                if self._S3Hashes is not None:
+                    etag = self._S3Hashes.etag(file['path'], self._UploadQueue.chunkSize)
+                self._S3Inventory.put(key, job.bytes, job.finishedAt, etag=etag)
+            self._Logger.info(
+                '  Uploaded %s took %ss (%.2f MB/s)',
+                job.name,
+                int(job.seconds),
+                job.bytes / max(job.seconds, 0.001) / 1024 / 1024,
+            )
+            uploadStats = pagestats.PageStats()
+            uploadStats.add('s3Upload', job.seconds)
+            self._Executor.stats.addToBook(toFile, uploadStats)
+
+        self._UploadQueue.submit(uploadqueue.UploadJob(bucket, key, file['path'], metadata=metadata), finish)
+
+    def _CheckUploadToS3(self, bucket, key, file):
+        if self._S3Inventory is not None:
+            self._Logger.debug('  Looking up s3://%s/%s...', bucket.name, key)
+            entry = self._S3Inventory.get(key)
+            if entry is None:
+                self._Logger.debug('  Not found')
+                return True
+            if self._S3Hashes is not None and entry.get('etag'):
+                return not self._IsSameContent(file, etag=entry['etag'])
+            return self._IsS3Older(entry['mtime'], file)
+
+        self._Logger.debug('  Checking s3://%s/%s...', bucket.name, key)
         retry = 0
         while True:
             try:
-                object.upload_file(file['path'])
-            except botocore.exceptions.ClientError as e:
+                info = bucket.stat(key)
+            except s3.StorageError as e:
                 if retry < 3:
                     retry = retry + 1
+                    delay = uploadqueue.backoffDelay(retry)
                     self._Logger.warning(
-                        '  Uploading to s3://%s/%s failed. Retrying...: %s',
-                        object.bucket_name,
-                        object.key,
+                        '  Checking s3://%s/%s failed. Retrying in %.1fs...: %s',
+                        bucket.name,
+                        key,
+                        delay,
                         e,
                     )
+                    time.sleep(delay)
                     continue
                 raise
             break
-        endTime = time.time()
-        self._Logger.info(
-            '  Done took %ss',
-            int(endTime - startTime),
-        )
+        if info is None:
+            self._Logger.debug('  Not found')
+            return True
+        if self._S3Hashes is not None:
+            return not self._IsSameContent(file, etag=info['etag'], md5=info['metadata'].get('md5'))
+        return self._IsS3Older(info['mtime'], file)
+
+    def _IsSameContent(self, file, etag=None, md5=None):
+        u"""S3 のオブジェクトが file と同じ内容かを、メタデータの md5 または ETag で判定する"""
+        if md5:
+            same = self._S3Hashes.md5(file['path']) == md5
+        else:
+            same = self._S3Hashes.matches(file['path'], etag, self._UploadQueue.chunkSize)
+        if same:
+            self._Logger.debug('  S3 has the same content')
+        else:
+            self._Logger.info('  S3 has different content')
+        return same
 
-    def _CheckUploadToS3(self, object, file):
-        self._Logger.debug('  Checking s3://%s/%s...', object.bucket_name, object.key)
-        import botocore
-        retry = 0
-        while True:
-            try:
-                object.load()
-            except botocore.exceptions.ClientError as e:
-                if e.response['Error']['Code'] == '404':
-                    self._Logger.debug('  Not found')
-                    return True
-                if retry < 3:
-                    retry = retry + 1
-                    self._Logger.warning(
-                        '  Checking s3://%s/%s failed. Retrying...: %s',
-                        object.bucket_name,
-                        object.key,
-                        e,
-                    )
-                    continue
-                raise
-            break
-        s3mtime = int(calendar.timegm(object.last_modified.utctimetuple()))
+    def _IsS3Older(self, s3mtime, file):
         if file['mtime'] <= s3mtime:
             self._Logger.debug(
                 '  S3 is newer: S3 %s > filesystem %s',
@@ -437,6 +635,7 @@ if __name__ == '__main__':
     parser.add_argument('-v', dest='verbose', action='count', default=0)
     parser.add_argument('-m', dest='mobi', action='store_true', default=False)
     parser.add_argument('-s', dest='s3', action='store_true', default=False)
+    parser.add_argument('--native', dest='native', action='store_true', default=False, help='write mobi without kindlegen')
     parser.add_argument('zipfile')
     opts = parser.parse_args()
     level = logging.INFO
@@ -466,7 +665,6 @@ if __name__ == '__main__':
         whitespace=imageoptimizer.ImageOptimizer.WHITESPACE_CLEAN,
         verboseBound=True,
     )
-    import s3
     if opts.s3:
         s3info = s3.getS3Info()
     else:
@@ -475,5 +673,6 @@ if __name__ == '__main__':
         optimizer,
         skipMobi=(not opts.mobi),
         s3Bucket=s3info.getBucket('novel'),
+        nativeMobi=opts.native,
     )
     copier(file, '.', opts)
@@ -0,0 +1,520 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import os
+import os.path
+import random
+import resource
+import sys
+import time
+
+import PIL.Image
+import PIL.ImageDraw
+
+import imageoptimizer
+
+
+class SyntheticPageGenerator(object):
+    u"""スキャンしたページに似せた画像を生成する
+
+    同じ seed からは同じページを生成する。
+    """
+
+    # A5 (mm)
+    PAGE_MM = (148, 210)
+    MARGIN_MM = 15
+    # 10pt 程度 (mm)
+    CHAR_MM = 3.5
+    DPIS = [150, 300, 600]
+    KIND_TEXT = 'text'
+    KIND_DIRTY = 'dirty'
+    KIND_RULED = 'ruled'
+    KIND_BLACK = 'black'
+    KIND_BLANK = 'blank'
+    KIND_COLOR = 'color'
+    # RGB で保存されたモノクロのページ
+    KIND_RGB_TEXT = 'rgbtext'
+    KINDS = [KIND_TEXT, KIND_DIRTY, KIND_RULED, KIND_BLACK, KIND_BLANK, KIND_COLOR, KIND_RGB_TEXT]
+    # 紙の黄ばみ (白を 255 とした R, G, B の倍率)
+    PAPER_TINT = (255, 247, 238)
+    QUALITY = 90
+
+    def __init__(self, seed=0):
+        self._Seed = seed
+
+    def name(self, kind, dpi, number):
+        u"""ImageOptimizer.FILENAME_PARSER で種類・解像度ごとにまとまる名前を返す"""
+        return '%s-%sdpi-%04d.jpg' % (kind, dpi, number)
+
+    def pages(self, count, dpis=None, kinds=None):
+        u"""(名前, JPEG のバイト列) のリストを返す"""
+        pages = []
+        for dpi in dpis or self.DPIS:
+            for kind in kinds or self.KINDS:
+                for number in range(1, count + 1):
+                    pages.append((
+                        self.name(kind, dpi, number),
+                        self.generate(kind, dpi, number),
+                    ))
+        return pages
+
+    def generate(self, kind, dpi, number):
+        u"""ページを生成し、JPEG のバイト列を返す"""
+        rnd = random.Random('%s/%s/%s/%s' % (self._Seed, kind, dpi, number))
+        pxPerMm = dpi / imageoptimizer.ImageOptimizer.MM_PER_INCH
+        size = (int(self.PAGE_MM[0] * pxPerMm), int(self.PAGE_MM[1] * pxPerMm))
+        margin = int(self.MARGIN_MM * pxPerMm)
+        body = (margin, margin, size[0] - margin, size[1] - margin)
+
+        if kind == self.KIND_COLOR:
+            image = PIL.Image.new('RGB', size, (250, 246, 238))
+            draw = PIL.ImageDraw.Draw(image)
+            self._drawIllustration(draw, rnd, body)
+        else:
+            image = PIL.Image.new('L', size, 255)
+            draw = PIL.ImageDraw.Draw(image)
+            if kind == self.KIND_BLACK:
+                # 表紙・扉のような、ほぼ黒いページ
+                draw.rectangle((0, 0, size[0], size[1]), fill=20)
+                self._drawText(draw, rnd, body, pxPerMm, 235, 255, columns=3)
+            elif kind == self.KIND_BLANK:
+                # 白紙。閾値より薄い汚れだけがある
+                self._drawDirts(draw, rnd, size, margin, pxPerMm, 200, 250)
+            else:
+                self._drawText(draw, rnd, body, pxPerMm, 0, 80)
+                if kind == self.KIND_RULED:
+                    self._drawRules(draw, rnd, size, body, pxPerMm)
+                elif kind in (self.KIND_DIRTY, self.KIND_RGB_TEXT):
+                    self._drawDirts(draw, rnd, size, margin, pxPerMm, 0, 120)
+                    self._drawPaperEdge(draw, rnd, size, pxPerMm)
+        del draw
+        if kind == self.KIND_RGB_TEXT:
+            image = PIL.Image.merge('RGB', [
+                image.point(lambda x, tint=tint: x * tint // 255)
+                for tint in self.PAPER_TINT
+            ])
+
+        outfh = io.BytesIO()
+        image.save(outfh, 'JPEG', quality=self.QUALITY, dpi=(dpi, dpi))
+        return outfh.getvalue()
+
+    def _drawText(self, draw, rnd, body, pxPerMm, darkest, lightest, columns=None):
+        u"""縦書きの本文に似せて、字の大きさの線の組を列ごとに並べる"""
+        charSize = max(3, int(self.CHAR_MM * pxPerMm))
+        stroke = max(1, int(0.3 * pxPerMm))
+        x = body[2] - charSize
+        column = 0
+        while x >= body[0] and (columns is None or column < columns):
+            y = body[1]
+            end = body[3] if rnd.random() > 0.2 else rnd.randrange(body[1], body[3])
+            while y + charSize <= end:
+                if rnd.random() > 0.05:
+                    fill = rnd.randrange(darkest, lightest + 1)
+                    cy = y + rnd.randrange(charSize)
+                    cx = x + rnd.randrange(charSize)
+                    draw.rectangle((x, cy, x + charSize - 1, cy + stroke - 1), fill=fill)
+                    draw.rectangle((cx, y, cx + stroke - 1, y + charSize - 1), fill=fill)
+                y += charSize + max(1, charSize // 8)
+            x -= charSize * 2
+            column += 1
+
+    def _drawRules(self, draw, rnd, size, body, pxPerMm):
+        u"""罫線・柱の線を引く"""
+        stroke = max(1, int(0.2 * pxPerMm))
+        # 柱の下の横線
+        y = body[1] - int(4 * pxPerMm)
+        draw.rectangle((body[0], y, body[2], y + stroke - 1), fill=0)
+        # 表
+        top = rnd.randrange(body[1], (body[1] + body[3]) // 2)
+        bottom = top + int(40 * pxPerMm)
+        for ix in range(5):
+            x = body[0] + (body[2] - body[0]) * ix // 4
+            draw.rectangle((x, top, x + stroke - 1, bottom), fill=0)
+        for iy in range(9):
+            y = top + (bottom - top) * iy // 8
+            draw.rectangle((body[0], y, body[2], y + stroke - 1), fill=0)
+
+    def _drawDirts(self, draw, rnd, size, margin, pxPerMm, darkest, lightest):
+        u"""余白に汚れを描く"""
+        maxDirt = max(2, int(1.5 * pxPerMm))
+        for _ in range(rnd.randrange(3, 12)):
+            side = rnd.randrange(4)
+            w = rnd.randrange(1, maxDirt)
+            h = rnd.randrange(1, maxDirt)
+            if side == 0:
+                x, y = rnd.randrange(0, margin), rnd.randrange(0, size[1] - h)
+            elif side == 1:
+                x, y = rnd.randrange(size[0] - margin, size[0] - w), rnd.randrange(0, size[1] - h)
+            elif side == 2:
+                x, y = rnd.randrange(0, size[0] - w), rnd.randrange(0, margin)
+            else:
+                x, y = rnd.randrange(0, size[0] - w), rnd.randrange(size[1] - margin, size[1] - h)
+            draw.rectangle((x, y, x + w, y + h), fill=rnd.randrange(darkest, lightest + 1))
+
+    def _drawPaperEdge(self, draw, rnd, size, pxPerMm):
+        u"""スキャン時に写り込んだ紙の端の影を描く"""
+        width = max(1, int(rnd.uniform(0.2, 1.0) * pxPerMm))
+        if rnd.random() < 0.5:
+            draw.rectangle((0, 0, width - 1, size[1]), fill=rnd.randrange(20, 90))
+        else:
+            draw.rectangle((size[0] - width, 0, size[0], size[1]), fill=rnd.randrange(20, 90))
+
+    def _drawIllustration(self, draw, rnd, body):
+        u"""カラーの挿絵に似せて、色のついた図形を描く"""
+        for _ in range(rnd.randrange(10, 30)):
+            x0 = rnd.randrange(body[0], body[2])
+            y0 = rnd.randrange(body[1], body[3])
+            x1 = rnd.randrange(x0, body[2] + 1)
+            y1 = rnd.randrange(y0, body[3] + 1)
+            color = (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+            if rnd.random() < 0.5:
+                draw.ellipse((x0, y0, x1, y1), fill=color)
+            else:
+                draw.rectangle((x0, y0, x1, y1), fill=color)
+
+
+def _readStatus(key):
+    u"""/proc/self/status の値をバイト数で返す。読めない場合は None"""
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _resetPeakRss():
+    u"""Linux では最大 RSS (VmHWM) を現在の RSS に戻せる"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+    except OSError:
+        pass
+
+
+def _rss():
+    return _readStatus('VmRSS') or 0
+
+
+def _peakRss():
+    peak = _readStatus('VmHWM')
+    if peak is not None:
+        return peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        # Linux などでは KB 単位
+        peak *= 1024
+    return peak
+
+
+def _measureStage(benchmark, stage, whitespace, pages, repeat):
+    u"""ProcessPool から呼び出す"""
+    # 汚れの警告などは計測の邪魔になる
+    logging.getLogger('ImageOptimizer').setLevel(logging.ERROR)
+    return benchmark.measureStage(stage, whitespace, pages, repeat)
+
+
+class ImageBenchmark(object):
+    u"""ImageOptimizer の段階ごとの処理速度・メモリ使用量を計測する
+
+    段階ごとの入力はその前の段階までを実行して用意し、計測には含めない。
+    メモリ使用量の計測のため、計測ごとに別のプロセスで実行する。
+    """
+
+    STAGE_DECODE = 'decode'
+    STAGE_REMOVE_DIRTS = 'removeDirts'
+    STAGE_AUTOCONTRAST = 'autocontrast'
+    STAGE_BOLDIZE = 'boldize'
+    STAGE_ENCODE = 'encode'
+    STAGE_OPTIMIZE = 'optimize'
+    STAGE_DIVIDE = 'divide'
+    STAGE_SPLIT = 'split'
+    STAGES = [
+        STAGE_DECODE,
+        STAGE_REMOVE_DIRTS,
+        STAGE_AUTOCONTRAST,
+        STAGE_BOLDIZE,
+        STAGE_ENCODE,
+        STAGE_OPTIMIZE,
+        STAGE_DIVIDE,
+        STAGE_SPLIT,
+    ]
+    WHITESPACES = {
+        'none': imageoptimizer.ImageOptimizer.WHITESPACE_NONE,
+        'clean': imageoptimizer.ImageOptimizer.WHITESPACE_CLEAN,
+        'trim': imageoptimizer.ImageOptimizer.WHITESPACE_TRIM,
+    }
+    # 分割モードの出力サイズ (createmobi.ZipToMobi.SIZE)
+    DIVIDE_SIZE = (758, 1024)
+
+    def __init__(self, boundEngine=None, bandMemory=None):
+        self._Logger = logging.getLogger(self.__class__.__name__)
+        self._BoundEngine = boundEngine
+        self._BandMemory = bandMemory
+
+    def _optimizer(self, whitespace):
+        return imageoptimizer.ImageOptimizer(
+            whitespace=self.WHITESPACES[whitespace],
+            boundEngine=self._BoundEngine,
+            bandMemory=self._BandMemory,
+        )
+
+    def _decode(self, optimizer, data):
+        u"""ImageOptimizer.optimize と同様に、モノクロの判定をしてから開く"""
+        infh = io.BytesIO(data)
+        return optimizer._open(infh, optimizer._detectGray(infh))
+
+    def _prepare(self, optimizer, stage, name, data):
+        u"""stage の入力を用意する。その段階を実行しないページでは None を返す"""
+        if stage in (self.STAGE_DECODE, self.STAGE_OPTIMIZE, self.STAGE_DIVIDE):
+            return data
+        image = self._decode(optimizer, data)
+        image.load()
+        histogram = None
+        if image.mode == 'L' and optimizer._Whitespace != optimizer.WHITESPACE_NONE:
+            if stage == self.STAGE_REMOVE_DIRTS:
+                return image
+            image, histogram = optimizer._removeDirts(image, name)
+        elif stage == self.STAGE_REMOVE_DIRTS:
+            return None
+        if optimizer._size:
+            histogram = None
+            image = optimizer._resize(image, stage == self.STAGE_SPLIT)
+        if image.mode == 'L':
+            if histogram is None:
+                histogram = image.histogram()
+            if stage == self.STAGE_AUTOCONTRAST:
+                return (image, histogram)
+            image, histogram = optimizer._autocontrast(image, histogram)
+            if optimizer._needBoldize(image, histogram):
+                if stage == self.STAGE_BOLDIZE:
+                    return image
+                image = optimizer.boldize(image)
+        if stage in (self.STAGE_AUTOCONTRAST, self.STAGE_BOLDIZE):
+            return None
+        return image
+
+    def _run(self, optimizer, stage, name, arg):
+        if stage == self.STAGE_DECODE:
+            self._decode(optimizer, arg).load()
+        elif stage == self.STAGE_REMOVE_DIRTS:
+            optimizer._removeDirts(arg, name)
+        elif stage == self.STAGE_AUTOCONTRAST:
+            optimizer._autocontrast(*arg)
+        elif stage == self.STAGE_BOLDIZE:
+            optimizer.boldize(arg)
+        elif stage == self.STAGE_ENCODE:
+            optimizer._Encoder.save(arg, io.BytesIO(), name)
+        elif stage == self.STAGE_OPTIMIZE:
+            optimizer.optimize(name, io.BytesIO(arg), io.BytesIO())
+        elif stage == self.STAGE_DIVIDE:
+            optimizer.optimize(name, io.BytesIO(arg), (io.BytesIO(), io.BytesIO()))
+        elif stage == self.STAGE_SPLIT:
+            optimizer._divide(arg)
+
+    def measureStage(self, stage, whitespace, pages, repeat=1):
+        u"""1 つの段階を計測し、結果の dict を返す。対象のページがない場合は None"""
+        optimizer = self._optimizer(whitespace)
+        if stage in (self.STAGE_DIVIDE, self.STAGE_SPLIT):
+            optimizer.reset(self.DIVIDE_SIZE)
+            optimizer.setLTR()
+            for name, data in pages:
+                optimizer.prescan(name, io.BytesIO(data))
+            optimizer.prepare_optimize()
+            if not optimizer.divideMode:
+                return None
+        count = 0
+        seconds = 0.0
+        peakRss = None
+        baseRss = None
+        for _ in range(repeat):
+            inputs = [
+                (name, self._prepare(optimizer, stage, name, data))
+                for name, data in pages
+            ]
+            inputs = [(name, arg) for name, arg in inputs if arg is not None]
+            if not inputs:
+                return None
+            _resetPeakRss()
+            base = _rss()
+            for name, arg in inputs:
+                start = time.perf_counter()
+                self._run(optimizer, stage, name, arg)
+                seconds += time.perf_counter() - start
+                count += 1
+            peak = _peakRss()
+            if peakRss is None or peak - base > peakRss - baseRss:
+                peakRss = peak
+                baseRss = base
+            del inputs
+        return {
+            'stage': stage,
+            'whitespace': whitespace,
+            'pages': count,
+            'seconds': seconds,
+            'pagesPerSec': count / seconds if seconds else None,
+            'peakRss': peakRss,
+            'stageRss': peakRss - baseRss,
+        }
+
+    def run(self, pages, stages=None, whitespaces=None, repeat=1):
+        u"""段階・余白処理・解像度ごとに計測し、結果の dict のリストを返す"""
+        byDpi = {}
+        for name, data in pages:
+            dpi = PIL.Image.open(io.BytesIO(data)).info['dpi'][0]
+            byDpi.setdefault(int(round(dpi)), []).append((name, data))
+        results = []
+        context = multiprocessing.get_context('spawn')
+        for dpi in sorted(byDpi):
+            for stage in stages or self.STAGES:
+                for whitespace in whitespaces or self.WHITESPACES.keys():
+                    # 計測ごとにプロセスを作り直す
+                    with context.Pool(1, maxtasksperchild=1) as pool:
+                        result = pool.apply(
+                            _measureStage,
+                            (self, stage, whitespace, byDpi[dpi], repeat),
+                        )
+                    if result is None:
+                        continue
+                    result['dpi'] = dpi
+                    self._Logger.debug('%s', result)
+                    results.append(result)
+        return results
+
+    def bounds(self, pages):
+        u"""ページごとの検出した描画範囲と、出力の描画範囲を返す
+
+        最適化の実装を変更しても、この結果は変わってはならない。
+        """
+        bounds = {}
+        for whitespace in ['clean', 'trim']:
+            for name, data in pages:
+                optimizer = self._optimizer(whitespace)
+                optimizer.reset()
+                outfh = io.BytesIO()
+                optimizer.optimize(name, io.BytesIO(data), outfh)
+                output = PIL.Image.open(io.BytesIO(outfh.getvalue()))
+                detected = None
+                for pageInfos in optimizer.pageInfoMap.values():
+                    for pageInfo in pageInfos:
+                        detected = [round(mm, 2) for mm in pageInfo['bound']]
+                outputBound = None
+                if output.mode == 'L':
+                    outputBound = output.point(
+                        lambda x: 0 if x > optimizer.PRINT_BLACK_THRESHOLD else 255
+                    ).getbbox()
+                bounds['%s/%s' % (whitespace, name)] = {
+                    'detected': detected,
+                    'size': list(output.size),
+                    'output': list(outputBound) if outputBound else None,
+                }
+        return bounds
+
+    def checkBounds(self, bounds, golden):
+        u"""golden と異なるページの数を返す"""
+        mismatches = 0
+        for key in sorted(set(bounds) | set(golden)):
+            if bounds.get(key) != golden.get(key):
+                self._Logger.error(
+                    '%s: bound mismatch: expected %s, actual %s',
+                    key,
+                    golden.get(key),
+                    bounds.get(key),
+                )
+                mismatches += 1
+        return mismatches
+
+    def report(self, results, outfh=sys.stdout):
+        outfh.write('%5s %-12s %-6s %6s %10s %12s %12s\n' % (
+            'dpi', 'stage', 'space', 'pages', 'pages/sec', 'peakRSS(MB)', 'stageRSS(MB)',
+        ))
+        for result in results:
+            outfh.write('%5d %-12s %-6s %6d %10.2f %12.1f %12.1f\n' % (
+                result['dpi'],
+                result['stage'],
+                result['whitespace'],
+                result['pages'],
+                result['pagesPerSec'] or 0,
+                result['peakRss'] / 1024.0 / 1024.0,
+                result['stageRss'] / 1024.0 / 1024.0,
+            ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', dest='verbose', action='count', default=0)
+    parser.add_argument('--pages', dest='pages', type=int, default=2, help='pages per kind and dpi')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('--repeat', dest='repeat', type=int, default=1)
+    parser.add_argument('--dpi', dest='dpis', type=int, action='append')
+    parser.add_argument('--kind', dest='kinds', action='append', choices=SyntheticPageGenerator.KINDS)
+    parser.add_argument('--stage', dest='stages', action='append', choices=ImageBenchmark.STAGES)
+    parser.add_argument('--whitespace', dest='whitespaces', action='append', choices=list(ImageBenchmark.WHITESPACES.keys()))
+    parser.add_argument(
+        '--bound-engine',
+        dest='boundEngine',
+        choices=[
+            imageoptimizer.ImageOptimizer.BOUND_ENGINE_IMAGE,
+            imageoptimizer.ImageOptimizer.BOUND_ENGINE_PROFILE,
+        ],
+    )
+    parser.add_argument('--intermediate-memory', dest='bandMemory', type=int, help='MB for working buffers (processed in bands); decoded pages are still held whole')
+    parser.add_argument(
+        '--golden',
+        dest='golden',
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'imagebenchmark.json'),
+    )
+    parser.add_argument('--update-golden', dest='updateGolden', action='store_true')
+    parser.add_argument('--skip-timing', dest='skipTiming', action='store_true')
+    parser.add_argument('--json', dest='json', help='write results to this file')
+    opts = parser.parse_args()
+    level = logging.WARNING
+    if opts.verbose:
+        level = logging.DEBUG if opts.verbose > 1 else logging.INFO
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)s: %(message)s',
+        level=level,
+    )
+    # 汚れの警告などは計測の邪魔になる
+    logging.getLogger('ImageOptimizer').setLevel(max(level, logging.ERROR))
+
+    generator = SyntheticPageGenerator(opts.seed)
+    pages = generator.pages(opts.pages, opts.dpis, opts.kinds)
+    benchmark = ImageBenchmark(
+        boundEngine=opts.boundEngine,
+        bandMemory=opts.bandMemory * 1024 * 1024 if opts.bandMemory else None,
+    )
+
+    status = 0
+    bounds = benchmark.bounds(pages)
+    if opts.updateGolden:
+        with open(opts.golden, 'w') as fh:
+            json.dump(bounds, fh, indent=1, sort_keys=True)
+            fh.write('\n')
+        logging.warning('Updated %s', opts.golden)
+    elif os.path.exists(opts.golden):
+        with open(opts.golden) as fh:
+            golden = json.load(fh)
+        # 一部のページだけを生成した場合は、そのページだけを比較する
+        golden = dict((key, value) for key, value in golden.items() if key in bounds)
+        mismatches = benchmark.checkBounds(bounds, golden)
+        if mismatches:
+            logging.error('%s pages do not match %s', mismatches, opts.golden)
+            status = 1
+    else:
+        logging.warning('%s does not exist. Run with --update-golden', opts.golden)
+
+    if not opts.skipTiming:
+        results = benchmark.run(pages, opts.stages, opts.whitespaces, opts.repeat)
+        benchmark.report(results)
+        if opts.json:
+            with open(opts.json, 'w') as fh:
+                json.dump(results, fh, indent=1)
+    sys.exit(status)
@@ -1,6 +1,8 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import copy
+import io
 import logging
 import os
 import os.path
@@ -13,13 +15,225 @@ import PIL.ImageEnhance
 import PIL.ImageFilter
 import PIL.ImageOps
 
+import pagestats
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class _InkProfile(object):
+    u"""描画範囲の検出用に、列・行ごとの描画ピクセル数を保持する
+
+    画像を都度切り取り・貼り付けする代わりに、有効範囲(clip)を矩形で管理し、
+    矩形内の描画範囲を列・行ごとの描画数から求める。
+    """
+
+    def __init__(self, image, threshold=None, bandRows=None):
+        u"""threshold を指定しない場合、invert().getbbox() と同様、真っ白(255)以外を描画とみなす。
+        threshold を指定した場合、その値以下を描画とみなす。
+        bandRows を指定した場合、その行数ずつ画像を読み込む。
+        """
+        width, height = image.size
+        if not bandRows:
+            bandRows = height
+        self._Size = (width, height)
+        self._Clip = [0, 0, width, height]
+        # 描画の有無は 1 pixel 1 bit で保持する
+        self._Bits = numpy.empty((height, (width + 7) // 8), dtype=numpy.uint8)
+        # clip 内の列ごと・行ごとの描画ピクセル数
+        self._ColCounts = numpy.zeros(width, dtype=numpy.int64)
+        self._RowCounts = numpy.zeros(height, dtype=numpy.int64)
+        for y0 in range(0, height, bandRows):
+            y1 = min(y0 + bandRows, height)
+            band = numpy.asarray(image.crop((0, y0, width, y1)))
+            if threshold is None:
+                band = band != 255
+            else:
+                band = band <= threshold
+            self._ColCounts += band.sum(axis=0)
+            self._RowCounts[y0:y1] = band.sum(axis=1)
+            self._Bits[y0:y1] = numpy.packbits(band, axis=1)
+
+    def _mask(self, x0, y0, x1, y1):
+        u"""矩形内の描画の有無を bool の配列で返す"""
+        bits = numpy.unpackbits(self._Bits[y0:y1, x0 // 8:(x1 + 7) // 8], axis=1)
+        return bits[:, x0 % 8:x0 % 8 + (x1 - x0)].view(bool)
+
+    @property
+    def size(self):
+        return self._Size
+
+    @property
+    def clipRect(self):
+        return list(self._Clip)
+
+    def _shrink(self, rect):
+        u"""clip を rect に狭めた場合の列・行ごとの描画ピクセル数を返す"""
+        x0, y0, x1, y1 = self._Clip
+        colCounts = self._ColCounts
+        rowCounts = self._RowCounts
+        # 左右を狭める
+        for start, end in ((x0, rect[0]), (rect[2], x1)):
+            if start < end:
+                if rowCounts is self._RowCounts:
+                    rowCounts = rowCounts.copy()
+                rowCounts[y0:y1] -= self._mask(start, y0, end, y1).sum(axis=1)
+        # 上下を狭める
+        for start, end in ((y0, rect[1]), (rect[3], y1)):
+            if start < end:
+                if colCounts is self._ColCounts:
+                    colCounts = colCounts.copy()
+                colCounts[rect[0]:rect[2]] -= self._mask(rect[0], start, rect[2], end).sum(axis=0)
+        return colCounts, rowCounts
+
+    def clip(self, rect):
+        u"""有効範囲を rect に狭める (rect は現在の有効範囲に含まれること)"""
+        self._ColCounts, self._RowCounts = self._shrink(rect)
+        self._Clip = list(rect)
+
+    def getbbox(self, rect=None):
+        u"""rect 内 (省略時は有効範囲) の描画範囲を返す。描画がなければ None"""
+        if rect is None:
+            rect = self._Clip
+            colCounts = self._ColCounts
+            rowCounts = self._RowCounts
+        else:
+            if rect[2] <= rect[0] or rect[3] <= rect[1]:
+                return None
+            colCounts, rowCounts = self._shrink(rect)
+        cols = numpy.flatnonzero(colCounts[rect[0]:rect[2]])
+        if not len(cols):
+            return None
+        rows = numpy.flatnonzero(rowCounts[rect[1]:rect[3]])
+        return (
+            rect[0] + int(cols[0]),
+            rect[1] + int(rows[0]),
+            rect[0] + int(cols[-1]) + 1,
+            rect[1] + int(rows[-1]) + 1,
+        )
+
+    def count(self, rect):
+        u"""rect 内の描画ピクセル数を返す"""
+        return int(self._mask(*rect).sum())
+
+
+class JpegEncoder(object):
+    u"""ページを JPEG で出力する
+
+    指定しないオプションは PIL のデフォルトのままにする。
+    maxBytes を指定した場合、1 ページがそのサイズに収まる最も高い quality を
+    minQuality から quality (デフォルト 75) の範囲で探索する。
+    """
+
+    DEFAULT_QUALITY = 75
+
+    def __init__(self, quality=None, optimize=False, progressive=False, subsampling=None, maxBytes=None, minQuality=30):
+        self._Logger = logging.getLogger(self.__class__.__name__)
+        self._Quality = quality
+        self._Optimize = optimize
+        self._Progressive = progressive
+        self._Subsampling = subsampling
+        self._MaxBytes = maxBytes
+        self._MinQuality = minQuality
+
+    def parameters(self):
+        return {
+            'quality': self._Quality,
+            'optimize': self._Optimize,
+            'progressive': self._Progressive,
+            'subsampling': self._Subsampling,
+            'maxBytes': self._MaxBytes,
+            'minQuality': self._MinQuality,
+        }
+
+    @property
+    def reencodes(self):
+        u"""quality などのオプションを指定していて、元の JPEG をそのまま使えないかを返す
+
+        maxBytes は元の JPEG が収まれば満たせるので含めない。
+        """
+        return (
+            self._Quality is not None
+            or self._Optimize
+            or self._Progressive
+            or self._Subsampling is not None
+        )
+
+    def accepts(self, size):
+        u"""元の JPEG をそのまま使える大きさかを返す"""
+        return not self._MaxBytes or size <= self._MaxBytes
+
+    def _options(self, quality=None):
+        options = {}
+        if quality is None:
+            quality = self._Quality
+        if quality is not None:
+            options['quality'] = quality
+        if self._Optimize:
+            options['optimize'] = True
+        if self._Progressive:
+            options['progressive'] = True
+        if self._Subsampling is not None:
+            options['subsampling'] = self._Subsampling
+        return options
+
+    def _encode(self, image, quality):
+        w = io.BytesIO()
+        image.save(w, format='jpeg', **self._options(quality))
+        return w.getvalue()
+
+    def save(self, image, outfh, name=None):
+        if not self._MaxBytes:
+            image.save(outfh, format='jpeg', **self._options())
+            return
+
+        quality = self._Quality or self.DEFAULT_QUALITY
+        data = self._encode(image, quality)
+        if len(data) > self._MaxBytes:
+            # 収まる最も高い quality を二分探索する
+            best = None
+            lo = self._MinQuality
+            hi = quality - 1
+            while lo <= hi:
+                mid = (lo + hi) // 2
+                test = self._encode(image, mid)
+                if len(test) <= self._MaxBytes:
+                    best = (mid, test)
+                    lo = mid + 1
+                else:
+                    data = test
+                    hi = mid - 1
+            if best is None:
+                self._Logger.warning(
+                    '%s: %s bytes exceeds %s bytes even with quality %s',
+                    name,
+                    len(data),
+                    self._MaxBytes,
+                    self._MinQuality,
+                )
+                quality = min(quality, self._MinQuality)
+            else:
+                quality, data = best
+            self._Logger.debug('%s: quality %s (%s bytes)', name, quality, len(data))
+        outfh.write(data)
+
 
 class ImageOptimizer(object):
+    # 出力が変わる変更を行った場合に更新する (ページキャッシュを無効にする)
+    VERSION = 2
 
     WHITESPACE_NONE = 0
     WHITESPACE_CLEAN = 1
     WHITESPACE_TRIM = 2
 
+    # 描画範囲の検出方法
+    # 画像の切り取りを繰り返す (参照実装)
+    BOUND_ENGINE_IMAGE = 'image'
+    # 列・行ごとの描画数から計算する (numpy が必要)
+    BOUND_ENGINE_PROFILE = 'profile'
+
     # 外れ値検知の最低サンプル数
     OUTLIERS_MIN_SAMPLES = 20
     # 外れ値検知の際に無視する先頭・末尾ページ数。
@@ -41,13 +255,40 @@ class ImageOptimizer(object):
 
     # ボールド処理を行う dpi 数
     BOLDIZE_DPI = 200
+    # 縮小する場合、JPEG のデコード時に出力サイズのこの倍率までは縮小する
+    # (PIL.Image.thumbnail の reducing_gap と同じ)
+    DRAFT_REDUCING_GAP = 2
+    # RGB の画像がモノクロかの判定
+    # JPEG の DCT スケーリングでこの分の 1 に縮小してデコードした標本で判定する
+    GRAY_SAMPLE_SCALE = 8
+    # 彩度 (RGB の最大値 - 最小値) がこの値以上の画素を色つきとみなす
+    GRAY_CHROMA_THRESHOLD = 24
+    # 色つきの画素がこの割合以下であればモノクロとみなす
+    GRAY_COLORED_RATIO = 0.001
 
     # 基本名 連番 . 拡張子
     FILENAME_PARSER = re.compile(r'^(.*?)(\d+)\..*?$')
 
-    def __init__(self, whitespace, percentile=95, boldize=True, verboseBound=False, traceBound=False):
+    def __init__(self, whitespace, percentile=95, boldize=True, verboseBound=False, traceBound=False, boundEngine=None, encoder=None, bandMemory=None, detectGray=True):
         self._Logger = logging.getLogger(self.__class__.__name__)
         self._Whitespace = whitespace
+        # RGB で保存されたモノクロのページを L に変換して処理する
+        self._DetectGray = detectGray
+        # 指定した場合、ページ全体の作業用の画像を作成せず、
+        # 画像を横長の帯に分けてその場で処理する。作業用のメモリの目安 (バイト)。
+        # デコードしたページ自体は全体を保持するため、制限するのは作業用の画像だけで、
+        # ページの画素数に比例するメモリは減らない。
+        self._BandMemory = bandMemory
+        self._Stats = pagestats.PageStats()
+        if encoder is None:
+            encoder = JpegEncoder()
+        self._Encoder = encoder
+        if boundEngine is None:
+            boundEngine = self.BOUND_ENGINE_PROFILE if numpy is not None else self.BOUND_ENGINE_IMAGE
+        if boundEngine == self.BOUND_ENGINE_PROFILE and numpy is None:
+            self._Logger.info('numpy was not found. Fall back to image bound engine.')
+            boundEngine = self.BOUND_ENGINE_IMAGE
+        self._BoundEngine = boundEngine
         self._Boldize = boldize
         self._Percentile = percentile
         self._VerboseBound = verboseBound
@@ -68,18 +309,14 @@ class ImageOptimizer(object):
     def divideMode(self):
         return self._LTR and self._preferDivide
 
-    def is_black_image(self, image):
+    def is_black_image(self, image, histogram=None):
         if image.mode != 'L':
             return False
 
-        # gets [(count, color)]
-        whites = 0
-        blacks = 0
-        for count, color in image.getcolors():
-            if color < self.PRINT_BLACK_THRESHOLD:
-                blacks = blacks + count
-            else:
-                whites = whites + count
+        if histogram is None:
+            histogram = image.histogram()
+        blacks = sum(histogram[:self.PRINT_BLACK_THRESHOLD])
+        whites = sum(histogram[self.PRINT_BLACK_THRESHOLD:])
         return whites * 10 < blacks
 
     def reset(self, size=None):
@@ -88,6 +325,46 @@ class ImageOptimizer(object):
         self._preferDivide = False
         self._size = size
 
+    def clone(self):
+        u"""並列処理用に、設定と prepare_optimize の結果だけを引き継いだ複製を返す"""
+        optimizer = copy.copy(self)
+        optimizer._pageInfoMap = {}
+        optimizer._actualMmSizeList = []
+        optimizer._Stats = pagestats.PageStats()
+        return optimizer
+
+    @property
+    def stats(self):
+        u"""段階ごとの所要時間・カウンター (pagestats.PageStats)"""
+        return self._Stats
+
+    def takeStats(self):
+        u"""これまでの集計を返し、新しい集計を始める"""
+        stats = self._Stats
+        self._Stats = pagestats.PageStats()
+        return stats
+
+    def parameters(self, divide=False):
+        u"""最適化の結果に影響するパラメーターを返す"""
+        return {
+            'version': self.VERSION,
+            'whitespace': self._Whitespace,
+            'boldize': self._Boldize,
+            'detectGray': self._DetectGray,
+            'size': list(self._size) if self._size else None,
+            'divide': bool(divide and self.divideMode),
+            'encoder': self._Encoder.parameters(),
+        }
+
+    @property
+    def pageInfoMap(self):
+        return self._pageInfoMap
+
+    def mergePageInfo(self, pageInfoMap):
+        u"""複製で集計したページ情報を取り込む"""
+        for basename, pageInfos in pageInfoMap.items():
+            self._pageInfoMap.setdefault(basename, []).extend(pageInfos)
+
     def need_prescan(self):
         return (
             self._Whitespace == self.WHITESPACE_CLEAN
@@ -154,71 +431,329 @@ class ImageOptimizer(object):
             if self._LTR and self._preferDivide:
                 self._Logger.info('Divide mode is enabled')
 
-    def optimize(self, name, infh, outfh):
+    def _isGray(self, image):
+        u"""RGB の画像に色つきの画素がほとんどないかを返す"""
+        r, g, b = image.split()
+        chroma = PIL.ImageChops.difference(
+            PIL.ImageChops.lighter(PIL.ImageChops.lighter(r, g), b),
+            PIL.ImageChops.darker(PIL.ImageChops.darker(r, g), b),
+        )
+        histogram = chroma.histogram()
+        colored = sum(histogram[self.GRAY_CHROMA_THRESHOLD:])
+        return colored <= sum(histogram) * self.GRAY_COLORED_RATIO
+
+    def _detectGray(self, infh):
+        u"""RGB の画像が実質的にモノクロかを返す
+
+        画像全体はデコードせず、縮小した標本の彩度で判定する。
+        infh は先頭に戻す。
+        """
+        if not self._DetectGray:
+            return False
+        try:
+            image = PIL.Image.open(infh)
+            if image.mode != 'RGB':
+                return False
+            sampleSize = (
+                max(1, image.size[0] // self.GRAY_SAMPLE_SCALE),
+                max(1, image.size[1] // self.GRAY_SAMPLE_SCALE),
+            )
+            if image.format == 'JPEG':
+                image.draft('RGB', sampleSize)
+            else:
+                image = image.resize(sampleSize, PIL.Image.NEAREST)
+            return self._isGray(image)
+        finally:
+            infh.seek(0)
+
+    def _open(self, infh, gray=False):
+        u"""画像を開く
+
+        縮小する場合は JPEG の DCT スケーリングで縮小しながらデコードする。
+        ゴミ除去を行う場合は、その閾値が 1px 以上になる解像度までに縮小を留める。
+        gray の場合は L に変換する。JPEG では輝度成分だけをデコードする。
+        """
         image = PIL.Image.open(infh)
+        mode = 'L' if gray else image.mode
+        if image.format == 'JPEG':
+            image = self._draft(image, mode)
+        if image.mode != mode:
+            image = image.convert(mode)
+        return image
 
-        if image.mode == 'L' and self._Whitespace != self.WHITESPACE_NONE:
-            image = self.removeDirts(image, name)
+    def _draft(self, image, mode):
+        if not self._size:
+            if mode != image.mode:
+                image.draft(mode, None)
+            return image
 
+        requestSize = [
+            self._size[0] * self.DRAFT_REDUCING_GAP,
+            self._size[1] * self.DRAFT_REDUCING_GAP,
+        ]
+        if (
+            mode == 'L'
+            and self._Whitespace != self.WHITESPACE_NONE
+            and 'dpi' in image.info
+        ):
+            minSkip = min(skip for skip, _ in self.OUTER_THRESHOLDS + self.INNER_THRESHOLDS)
+            maxScale = int(min(image.info['dpi']) * minSkip / self.MM_PER_INCH)
+            if maxScale < 2:
+                if mode != image.mode:
+                    image.draft(mode, None)
+                return image
+            requestSize = [
+                max(requestSize[i], -(-image.size[i] // maxScale))
+                for i in range(0, 2)
+            ]
+
+        originalWidth = image.size[0]
+        result = image.draft(mode, tuple(requestSize))
+        if not result:
+            return image
+        scale = originalWidth / result[1][2]
+        if scale > 1 and 'dpi' in image.info:
+            image.info['dpi'] = tuple(dpi / scale for dpi in image.info['dpi'])
+        return image
+
+    def optimize(self, name, infh, outfh):
+        stats = self._Stats
+        stats.count('pages')
+        with stats.timer('detectGray'):
+            gray = self._detectGray(infh)
+        if gray:
+            self._Logger.debug('%s: RGB image without colors', name)
+            stats.count('grayPages')
+        with stats.timer('open'):
+            image = self._open(infh, gray)
         inDivideMode = self.divideMode and isinstance(outfh, (list, tuple))
 
-        image = self._resize(image, inDivideMode)
+        # ページのヒストグラム。画像を変更する各段階で更新して使い回す。
+        histogram = None
+        if (
+            image.format == 'JPEG'
+            and not gray
+            and not self._size
+            and not inDivideMode
+            and not self._Encoder.reencodes
+            and (image.mode != 'L' or self._Whitespace == self.WHITESPACE_NONE)
+        ):
+            # 画素もエンコードのオプションも変更しない場合は、元の JPEG をそのまま出力する
+            if image.mode == 'L':
+                with stats.timer('decode'):
+                    image.load()
+                with stats.timer('histogram'):
+                    histogram = image.histogram()
+            if image.mode != 'L' or not self._changesMonochrome(image, histogram):
+                infh.seek(0)
+                data = infh.read()
+                if self._Encoder.accepts(len(data)):
+                    self._Logger.debug('%s: passthrough', name)
+                    stats.count('passthrough')
+                    outfh.write(data)
+                    return
+
+        with stats.timer('decode'):
+            image.load()
+
+        if image.mode == 'L' and self._Whitespace != self.WHITESPACE_NONE:
+            with stats.timer('removeDirts'):
+                image, histogram = self._removeDirts(image, name)
+
+        if self._size:
+            # 縮小するとヒストグラムが変わる
+            histogram = None
+            with stats.timer('resize'):
+                image = self._resize(image, inDivideMode)
         # コントラストを設定する
         #image = PIL.ImageEnhance.Contrast(image).enhance(2.0)
 
         if image.mode == 'L':
-            image = PIL.ImageOps.autocontrast(image)
-            if (
-                not self.is_black_image(image)
-                and self._Boldize
-                and 'dpi' in image.info
-                and image.info['dpi'][0] <= self.BOLDIZE_DPI
-            ):
+            if histogram is None:
+                with stats.timer('histogram'):
+                    histogram = image.histogram()
+            with stats.timer('autocontrast'):
+                image, histogram = self._autocontrast(image, histogram)
+            if self._needBoldize(image, histogram):
                 # モノクロ画像の場合、ボールド処理を行う
-                # 単純な MinFilter では太くなりすぎる
-                # image = image.filter(PIL.ImageFilter.MinFilter(3))
-                # 画像を縦横 1 pixel ずらしてコピーしてボールド処理とする。
-                width, height = image.size
-                offset = 1
-                offsetImage = PIL.Image.new(image.mode, image.size, 255)
-                offsetImage.paste(image, (offset, 0))
-                image = PIL.ImageChops.darker(image, offsetImage)
-                offsetImage = PIL.Image.new(image.mode, image.size, 255)
-                offsetImage.paste(image, (0, offset))
-                image = PIL.ImageChops.darker(image, offsetImage)
+                with stats.timer('boldize'):
+                    image = self.boldize(image)
 
         if inDivideMode:
-            image = image.rotate(90, expand=True)
-            width = int(image.size[0] * (1 + self.DIVIDE_OVERWRAP) / 2)
-            imageL = PIL.Image.new(
-                image.mode,
-                (width, image.size[1]),
-                255 if image.mode == 'L' else (255, 255, 255),
-            )
-            imageL.paste(
-                image.crop((0, 0, width, image.size[1])),
-                (0, 0),
-            )
-            imageR = PIL.Image.new(
-                image.mode,
-                (width, image.size[1]),
-                255 if image.mode == 'L' else (255, 255, 255),
-            )
-            imageR.paste(
-                image.crop((image.size[0] - width, 0, image.size[0], image.size[1])),
-                (0, 0),
-            )
-            imageL.save(outfh[0], format='jpeg')
-            imageR.save(outfh[1], format='jpeg')
+            with stats.timer('divide'):
+                imageL, imageR = self._divide(image)
+            with stats.timer('encode'):
+                self._Encoder.save(imageL, outfh[0], name)
+                self._Encoder.save(imageR, outfh[1], name)
             return
 
-        image.save(outfh, format='jpeg')
+        with stats.timer('encode'):
+            self._Encoder.save(image, outfh, name)
+
+    def _divide(self, image):
+        u"""画像を 90 度回転して、一部重複させて左右に分割した 2 つの画像を返す
+
+        全体を回転してから切り取る代わりに、回転後の左右にあたる上下の範囲を
+        切り取ってから回転する。回転後の画像・貼り付け先の画像を作成しない。
+        """
+        width = int(image.size[1] * (1 + self.DIVIDE_OVERWRAP) / 2)
+        halves = []
+        for top in (0, image.size[1] - width):
+            half = image.crop((0, top, image.size[0], top + width)).transpose(PIL.Image.ROTATE_90)
+            # 新しい画像に貼り付けていた時と同様に info は引き継がない
+            half.info = {}
+            halves.append(half)
+        return halves
+
+    def boldize(self, image):
+        u"""画像を縦横 1 pixel ずらして重ねたボールド処理を行う
+
+        単純な MinFilter では太くなりすぎる
+        image = image.filter(PIL.ImageFilter.MinFilter(3))
+        """
+        if numpy is None:
+            return self._boldizeByImage(image)
+        bandRows = self._bandRows(image)
+        if bandRows:
+            return self._boldizeByBands(image, bandRows)
+        return self._boldizeByArray(image)
+
+    def _boldizeByImage(self, image):
+        u"""boldize の参照実装。ずらした画像を作成して重ねる"""
+        width, height = image.size
+        offset = 1
+        offsetImage = PIL.Image.new(image.mode, image.size, 255)
+        offsetImage.paste(image, (offset, 0))
+        image = PIL.ImageChops.darker(image, offsetImage)
+        offsetImage = PIL.Image.new(image.mode, image.size, 255)
+        offsetImage.paste(image, (0, offset))
+        image = PIL.ImageChops.darker(image, offsetImage)
+        return image
+
+    def _boldizeByArray(self, image):
+        u"""boldize の numpy 実装
+
+        左隣・上隣・左上との最小値を、画像の配列と作業用の配列の 2 つだけで計算する。
+        """
+        pixels = numpy.array(image)
+        work = numpy.empty_like(pixels)
+        # 上隣との最小値
+        work[0] = pixels[0]
+        numpy.minimum(pixels[1:], pixels[:-1], out=work[1:])
+        # 左隣との最小値
+        pixels[:, 0] = work[:, 0]
+        numpy.minimum(work[:, 1:], work[:, :-1], out=pixels[:, 1:])
+        result = PIL.Image.fromarray(pixels, image.mode)
+        result.info.update(image.info)
+        return result
+
+    def _boldizeByBands(self, image, bandRows):
+        u"""boldize を帯ごとにその場で行う
+
+        上の帯から順に処理し、直前の帯の最終行は処理前の値を保持しておく。
+        """
+        previousRow = None
+        for box in self._bands(image.size, bandRows):
+            pixels = numpy.array(image.crop(box))
+            work = numpy.empty_like(pixels)
+            # 上隣との最小値
+            if previousRow is None:
+                work[0] = pixels[0]
+            else:
+                numpy.minimum(pixels[0], previousRow, out=work[0])
+            numpy.minimum(pixels[1:], pixels[:-1], out=work[1:])
+            previousRow = pixels[-1].copy()
+            # 左隣との最小値
+            pixels[:, 0] = work[:, 0]
+            numpy.minimum(work[:, 1:], work[:, :-1], out=pixels[:, 1:])
+            image.paste(PIL.Image.fromarray(pixels, image.mode), box[:2])
+        return image
+
+    def _needBoldize(self, image, histogram):
+        return (
+            not self.is_black_image(image, histogram)
+            and self._Boldize
+            and 'dpi' in image.info
+            and image.info['dpi'][0] <= self.BOLDIZE_DPI
+        )
+
+    def _changesMonochrome(self, image, histogram):
+        u"""モノクロ画像に対してコントラスト調整・ボールド処理で画素が変わるかを返す"""
+        if self._autocontrastLut(histogram) is not None:
+            return True
+        return self._needBoldize(image, histogram)
+
+    def _autocontrastLut(self, histogram):
+        u"""PIL.ImageOps.autocontrast と同じ変換表を返す。変換しても変わらない場合は None"""
+        for lo in range(256):
+            if histogram[lo]:
+                break
+        for hi in range(255, -1, -1):
+            if histogram[hi]:
+                break
+        if hi <= lo or (lo == 0 and hi == 255):
+            return None
+        scale = 255.0 / (hi - lo)
+        offset = -lo * scale
+        lut = []
+        for ix in range(256):
+            ix = int(ix * scale + offset)
+            if ix < 0:
+                ix = 0
+            elif ix > 255:
+                ix = 255
+            lut.append(ix)
+        return lut
+
+    def _autocontrast(self, image, histogram):
+        u"""PIL.ImageOps.autocontrast(image) と同じ処理をヒストグラムを再計算せずに行う
+
+        (処理後の画像, 処理後のヒストグラム) を返す。
+        帯に分けて処理する場合は image をその場で変更する。
+        """
+        lut = self._autocontrastLut(histogram)
+        if lut is None:
+            # 変換しても変わらない
+            return image, histogram
+        newHistogram = [0] * 256
+        for ix, count in enumerate(histogram):
+            newHistogram[lut[ix]] += count
+        bandRows = self._bandRows(image)
+        if not bandRows:
+            return image.point(lut), newHistogram
+        for box in self._bands(image.size, bandRows):
+            image.paste(image.crop(box).point(lut), box[:2])
+        return image, newHistogram
+
+    def _bandRows(self, image):
+        u"""帯に分けて処理する場合の 1 つの帯の行数を返す。分けない場合は None
+
+        1 つの帯の処理には、帯の大きさの作業用のバッファをおよそ 4 つ使う。
+        """
+        if not self._BandMemory:
+            return None
+        return max(1, self._BandMemory // (image.size[0] * len(image.getbands()) * 4))
+
+    def _bands(self, size, bandRows, box=None):
+        u"""box (省略時は画像全体) を bandRows 行ずつに分けた矩形を返す"""
+        if box is None:
+            box = (0, 0, size[0], size[1])
+        for y in range(box[1], box[3], bandRows):
+            yield (box[0], y, box[2], min(y + bandRows, box[3]))
 
     def removeDirts(self, image, name):
-        u"""余白部のノイズを除去した画像を返す"""
+        u"""余白部のノイズを除去した画像を返す
+
+        帯に分けて処理する場合 (bandMemory)、WHITESPACE_CLEAN では image をその場で変更する。
+        """
+        return self._removeDirts(image, name)[0]
+
+    def _removeDirts(self, image, name):
+        u"""余白部のノイズを除去した画像と、そのヒストグラムを返す"""
+        histogram = image.histogram()
         if 'dpi' not in image.info:
             self._Logger.warning('%s: no dpi information', name)
-            return image
+            return image, histogram
 
         pxPerMm = [
             image.info['dpi'][i] / self.MM_PER_INCH
@@ -229,14 +764,28 @@ class ImageOptimizer(object):
             if not os.path.exists('verbose'):
                 os.mkdir('verbose')
 
-        # ある程度薄い色は無視する
-        boundImage = image.point(lambda x: 255 if x > self.PRINT_BLACK_THRESHOLD  else x)
-        if self._TraceBound:
-            if not os.path.exists('verbose/bound'):
-                os.mkdir('verbose/bound')
-            boundImage.save('verbose/bound/%s' % name)
-        bound = PIL.ImageOps.invert(boundImage).getbbox()
-        detectBound = self.detectBound(boundImage, pxPerMm, name)
+        bandRows = self._bandRows(image)
+        if (
+            bandRows
+            and self._BoundEngine == self.BOUND_ENGINE_PROFILE
+            and not self._TraceBound
+        ):
+            # 閾値を適用した画像を作成せず、描画の分布を帯ごとに集計する
+            with self._Stats.timer('detectBound'):
+                profile = _InkProfile(image, self.PRINT_BLACK_THRESHOLD, bandRows)
+                bound = profile.getbbox()
+                detectBound = self._detectBoundByProfile(None, pxPerMm, name, profile)
+            del profile
+        else:
+            # ある程度薄い色は無視する
+            boundImage = image.point(lambda x: 255 if x > self.PRINT_BLACK_THRESHOLD  else x)
+            if self._TraceBound:
+                if not os.path.exists('verbose/bound'):
+                    os.mkdir('verbose/bound')
+                boundImage.save('verbose/bound/%s' % name)
+            bound = PIL.ImageOps.invert(boundImage).getbbox()
+            detectBound = self.detectBound(boundImage, pxPerMm, name, bound)
+            del boundImage
 
         if self._TraceBound:
             self._Logger.debug('  update bound: %s -> %s', bound, detectBound)
@@ -244,6 +793,12 @@ class ImageOptimizer(object):
         if not detectBound:
             # 真っ白なページ
             self._Logger.debug('%s: White page', name)
+            self._Stats.count('whitePages')
+            if bandRows:
+                image.paste(255, (0, 0, image.size[0], image.size[1]))
+                # PIL.Image.new で作成した場合と同様に info は引き継がない
+                image.info = {}
+                return image, [0] * 255 + [image.size[0] * image.size[1]]
             whitepage = PIL.Image.new(
                 image.mode,
                 image.size,
@@ -257,7 +812,7 @@ class ImageOptimizer(object):
                     os.mkdir('verbose/dirts')
                 diff.save('verbose/dirts/%s' % name)
             """
-            return whitepage
+            return whitepage, [0] * 255 + [image.size[0] * image.size[1]]
 
         # ページの情報の集計
         # ページは xxx0000.jpg のフォーマットになっていると仮定し、
@@ -293,18 +848,20 @@ class ImageOptimizer(object):
         ]
         bound = self.invertBound(image.size, bound)
 
-        trimmedImage = image.crop(bound)
-        cleanedImage = PIL.Image.new(image.mode, image.size, 255)
-        cleanedImage.paste(trimmedImage, bound[:2])
-        diff = PIL.ImageChops.difference(cleanedImage, image)
-
-        graydiffs = 0
-        blackdiffs = 0
-        for count, color in diff.getcolors():
-            if color >= self.DIRT_BLACK_THRESHOLD:
-                graydiffs = graydiffs + count
-            if color >= self.PRINT_BLACK_THRESHOLD:
-                blackdiffs = blackdiffs + count
+        # 消去する範囲だけのヒストグラムから汚れの量を数える
+        # 消去すると白(255)になるので、差分が閾値以上の色は 255 - 閾値 以下の色
+        blankedAreas = self.blankedAreas(image.size, bound)
+        blankedHistogram = [0] * 256
+        for blank in blankedAreas:
+            for box in self._bands(image.size, bandRows or image.size[1], blank):
+                for ix, count in enumerate(image.crop(box).histogram()):
+                    blankedHistogram[ix] += count
+        graydiffs = sum(blankedHistogram[:256 - self.DIRT_BLACK_THRESHOLD])
+        blackdiffs = sum(blankedHistogram[:256 - self.PRINT_BLACK_THRESHOLD])
+        trimmedHistogram = [
+            histogram[ix] - blankedHistogram[ix]
+            for ix in range(256)
+        ]
 
         if self._VerboseBound:
             if graydiffs > 0:
@@ -316,7 +873,7 @@ class ImageOptimizer(object):
                 """
             if not os.path.exists('verbose/trimmed'):
                 os.mkdir('verbose/trimmed')
-            PIL.ImageOps.invert(trimmedImage).save('verbose/trimmed/%s' % name)
+            PIL.ImageOps.invert(image.crop(bound)).save('verbose/trimmed/%s' % name)
 
         if graydiffs > self.DIFF_THRESHOLD_WARN  * image.size[0] * image.size[1]:
             self._Logger.warning('%s: Many dirts (gray %s / black %s)', name, graydiffs, blackdiffs)
@@ -324,14 +881,53 @@ class ImageOptimizer(object):
             self._Logger.info('%s: Dirts (gray %s / black %s)', name, graydiffs, blackdiffs)
 
         if self._Whitespace == self.WHITESPACE_CLEAN:
-            return cleanedImage
+            trimmedHistogram[255] += sum(blankedHistogram)
+            if bandRows:
+                # 消去する範囲をその場で白く塗る
+                for blank in blankedAreas:
+                    image.paste(255, blank)
+                # PIL.Image.new で作成した場合と同様に info は引き継がない
+                image.info = {}
+                return image, trimmedHistogram
+            cleanedImage = PIL.Image.new(image.mode, image.size, 255)
+            cleanedImage.paste(image.crop(bound), bound[:2])
+            return cleanedImage, trimmedHistogram
         elif self._Whitespace == self.WHITESPACE_TRIM:
-            return trimmedImage
+            return image.crop(bound), trimmedHistogram
 
-        return image
+        return image, histogram
 
+    def blankedAreas(self, size, bound):
+        u"""画像を bound で切り取った際に消去される範囲の矩形のリストを返す"""
+        areas = [
+            (0, 0, size[0], bound[1]),
+            (0, bound[3], size[0], size[1]),
+            (0, bound[1], bound[0], bound[3]),
+            (bound[2], bound[1], size[0], bound[3]),
+        ]
+        return [
+            area for area in areas
+            if area[0] < area[2] and area[1] < area[3]
+        ]
+
+
+    # 外辺でこれだけの余白(mm)がない場合はノイズがあると判断する
+    OUTER_MIN_MARGIN = 0.5
+    # 外辺での削る幅(Skip)と検知の幅(Detect) (mm)
+    OUTER_THRESHOLDS = (
+        (1.0, 3.0),
+    )
+    # 「本来の印刷がある」と判断する印刷の割合
+    PRINT_THRESHOLD = 0.01
+    # 外辺以外での削る幅(Skip)と検知の幅(Detect) (mm)
+    INNER_THRESHOLDS = (
+        (0.1, 1.0),
+        (0.2, 2.0),
+        (0.5, 3.0),
+        (1.0, 5.0),
+    )
 
-    def detectBound(self, image, pxPerMm, name):
+    def detectBound(self, image, pxPerMm, name, bound=None):
         u"""画像の周辺の余白部分にあるゴミを削除した範囲を返す
 
         モノクロ画像である前提とする。
@@ -352,25 +948,24 @@ class ImageOptimizer(object):
         * 最外辺以外
             * 各辺について、0.5mm 削り、それによって余白が 5mm 増えたらノイズだと判断する。
             * ただし、罫線の可能性を考慮し、削った部分に印刷が1%未満であることも条件とする。
+
+        bound には計算済みの描画範囲 (PIL.ImageOps.invert(image).getbbox()) を渡せる。
         """
-        # 外辺でこれだけの余白(mm)がない場合はノイズがあると判断する
-        OUTER_MIN_MARGIN = 0.5
-        # 外辺での削る幅(Skip)と検知の幅(Detect) (mm)
-        OUTER_THRESHOLDS = (
-            (1.0, 3.0),
-        )
-        # 「本来の印刷がある」と判断する印刷の割合
-        PRINT_THRESHOLD = 0.01
-        # 外辺以外での削る幅(Skip)と検知の幅(Detect) (mm)
-        INNER_THRESHOLDS = (
-            (0.1, 1.0),
-            (0.2, 2.0),
-            (0.5, 3.0),
-            (1.0, 5.0),
-        )
+        with self._Stats.timer('detectBound'):
+            if self._BoundEngine == self.BOUND_ENGINE_PROFILE:
+                return self._detectBoundByProfile(image, pxPerMm, name)
+            return self._detectBoundByImage(image, pxPerMm, name, bound)
+
+    def _detectBoundByImage(self, image, pxPerMm, name, bound=None):
+        u"""detectBound の参照実装。画像の切り取りを繰り返して判定する"""
+        OUTER_MIN_MARGIN = self.OUTER_MIN_MARGIN
+        OUTER_THRESHOLDS = self.OUTER_THRESHOLDS
+        PRINT_THRESHOLD = self.PRINT_THRESHOLD
+        INNER_THRESHOLDS = self.INNER_THRESHOLDS
 
         # 何らかの描画がある範囲の抽出
-        bound = PIL.ImageOps.invert(image).getbbox()
+        if bound is None:
+            bound = PIL.ImageOps.invert(image).getbbox()
         if not bound:
             # 真っ白なページ
             return None
@@ -399,6 +994,7 @@ class ImageOptimizer(object):
                 ]
                 if self._TraceBound:
                     self._Logger.debug('  Try detect outer dirts with %s, %s, %s', skip, detect, testBoundMm)
+                self._Stats.count('detectBound.trials')
                 testBound = self.toPx(testBoundMm, pxPerMm)
 
                 # 演算誤差による誤検出を避けるため、一度もとの範囲で切り取って、
@@ -406,6 +1002,7 @@ class ImageOptimizer(object):
                 trimmedImage = image.crop(self.invertBound(image.size, bound))
                 testBound = self.invertBound(trimmedImage.size, testBound)
                 trimmedImage = trimmedImage.crop(testBound)
+                self._Stats.count('detectBound.crops', 2)
                 trimmedBound = PIL.ImageOps.invert(trimmedImage).getbbox()
                 if not trimmedBound:
                     # 真っ白なページ
@@ -437,6 +1034,8 @@ class ImageOptimizer(object):
                     trimmedImage = image.crop(trimBound)
                     image = PIL.Image.new(image.mode, image.size, 255)
                     image.paste(trimmedImage, trimBound[:2])
+                    self._Stats.count('detectBound.crops')
+                    self._Stats.count('detectBound.dirts')
                     break
 
         # 左辺、上辺、右辺、下辺のそれぞれについてノイズテストを行って幅を狭める
@@ -446,6 +1045,7 @@ class ImageOptimizer(object):
             while True:
                 # 更新がある間繰り返す。
                 updated = False
+                self._Stats.count('detectBound.iterations')
 
                 # 現時点の何らかの描画がある範囲の抽出
                 bound = PIL.ImageOps.invert(image).getbbox()
@@ -463,6 +1063,7 @@ class ImageOptimizer(object):
                     testPrint = image.crop((bound[2] - 1, bound[1], bound[2], bound[3]))
                 else:
                     testPrint = image.crop((bound[0], bound[3] - 1, bound[2], bound[3]))
+                self._Stats.count('detectBound.crops')
 
                 points = 0
                 blacks = 0
@@ -480,6 +1081,7 @@ class ImageOptimizer(object):
                 for skip, detect in INNER_THRESHOLDS:
                     if self._TraceBound:
                         self._Logger.debug(' Try detect with skip=%s detect=%s', skip, detect)
+                    self._Stats.count('detectBound.trials')
                     testBoundMm = [0] * 4
                     testBoundMm[target] = skip
                     testBound = self.toPx(testBoundMm, pxPerMm)
@@ -489,6 +1091,7 @@ class ImageOptimizer(object):
                     trimmedImage = image.crop(self.invertBound(image.size, bound))
                     testBound = self.invertBound(trimmedImage.size, testBound)
                     trimmedImage = trimmedImage.crop(testBound)
+                    self._Stats.count('detectBound.crops', 2)
                     trimmedBound = PIL.ImageOps.invert(trimmedImage).getbbox()
                     if not trimmedBound:
                         # 真っ白なページ
@@ -523,6 +1126,7 @@ class ImageOptimizer(object):
                                 bound[1] + testBound[1],
                             ),
                         )
+                        self._Stats.count('detectBound.dirts')
                         updated = True
                         break
                     elif trimmedBoundMm[target] > 0.5:
@@ -540,6 +1144,206 @@ class ImageOptimizer(object):
 
         return PIL.ImageOps.invert(image).getbbox()
 
+    def _detectBoundByProfile(self, image, pxPerMm, name, profile=None):
+        u"""detectBound の numpy 実装
+
+        列・行ごとの描画数を一度だけ計算し、
+        切り取りは有効範囲の矩形の更新で表現する。
+        判定・ログ出力は _detectBoundByImage と同じになる。
+        profile に作成済みの _InkProfile を渡した場合、image は使用しない。
+        """
+        if profile is None:
+            profile = _InkProfile(image)
+
+        # 何らかの描画がある範囲の抽出
+        bound = profile.getbbox()
+        if not bound:
+            # 真っ白なページ
+            return None
+        bound = self.invertBound(profile.size, bound)
+        boundMm = self.toMm(bound, pxPerMm)
+        if self._TraceBound:
+            self._Logger.debug('  Initial blanks: %s', boundMm)
+
+        # 外辺の余白が一定未満の場合、ノイズと判定する。
+        outerDirtSuspect = [
+            boundMm[i] < self.OUTER_MIN_MARGIN
+            for i in range(0, 4)
+        ]
+        if any(outerDirtSuspect):
+            self._Logger.debug(
+                '%s: outer dirt suspection: %s, %s',
+                name,
+                outerDirtSuspect,
+                boundMm,
+            )
+            for skip, detect in self.OUTER_THRESHOLDS:
+                # ノイズの疑いがある外辺を狭めて再度余白チェックする
+                testBoundMm = [
+                    0 if not outerDirtSuspect[i] else skip
+                    for i in range(0, 4)
+                ]
+                if self._TraceBound:
+                    self._Logger.debug('  Try detect outer dirts with %s, %s, %s', skip, detect, testBoundMm)
+                self._Stats.count('detectBound.trials')
+                testBound = self.toPx(testBoundMm, pxPerMm)
+                trimmedBound, trimmedBoundMm = self._trimBoundByProfile(
+                    profile,
+                    self.invertBound(profile.size, bound),
+                    testBound,
+                    pxPerMm,
+                )
+                if not trimmedBound:
+                    # 真っ白なページ
+                    if self._TraceBound:
+                        self._Logger.debug('  Results white page')
+                    return None
+                if self._TraceBound:
+                    self._Logger.debug('  New blanks %s', trimmedBoundMm)
+                outerDirtDetect = [
+                    trimmedBoundMm[i] > detect
+                    for i in range(0, 4)
+                ]
+                if any(outerDirtDetect):
+                    self._Logger.debug(
+                        '%s: Detected outer dirts: %s %s %s',
+                        name,
+                        outerDirtDetect,
+                        boundMm,
+                        trimmedBoundMm,
+                    )
+                    trimBoundMm = [
+                        0 if not outerDirtDetect[i] else skip
+                        for i in range(0, 4)
+                    ]
+                    trimBound = self.toPx(trimBoundMm, pxPerMm)
+                    profile.clip(self.invertBound(profile.size, trimBound))
+                    self._Stats.count('detectBound.clips')
+                    self._Stats.count('detectBound.dirts')
+                    break
+
+        # 左辺、上辺、右辺、下辺のそれぞれについてノイズテストを行って幅を狭める
+        for target in range(0, 4):
+            if self._TraceBound:
+                self._Logger.debug('Detecting dirts in direction %s', target)
+            while True:
+                # 更新がある間繰り返す。
+                updated = False
+                self._Stats.count('detectBound.iterations')
+
+                # 現時点の何らかの描画がある範囲の抽出
+                bound = profile.getbbox()
+                if not bound:
+                    # 真っ白なページ
+                    # ここに来る前に return していないとおかしい
+                    self._Logger.warning('%s: Unexpected white page', name)
+                    return None
+                # 印刷量検知
+                if target == 0:
+                    testPrint = (bound[0], bound[1], bound[0] + 1, bound[3])
+                elif target == 1:
+                    testPrint = (bound[0], bound[1], bound[2], bound[1] + 1)
+                elif target == 2:
+                    testPrint = (bound[2] - 1, bound[1], bound[2], bound[3])
+                else:
+                    testPrint = (bound[0], bound[3] - 1, bound[2], bound[3])
+
+                points = (testPrint[2] - testPrint[0]) * (testPrint[3] - testPrint[1])
+                blacks = profile.count(testPrint)
+
+                if self._TraceBound:
+                    self._Logger.debug('  blacks / points = %s / %s (%.3f)', blacks, points, (float(blacks) / points))
+
+                boundRect = bound
+                bound = self.invertBound(profile.size, bound)
+
+                for skip, detect in self.INNER_THRESHOLDS:
+                    if self._TraceBound:
+                        self._Logger.debug(' Try detect with skip=%s detect=%s', skip, detect)
+                    self._Stats.count('detectBound.trials')
+                    testBoundMm = [0] * 4
+                    testBoundMm[target] = skip
+                    testBound = self.toPx(testBoundMm, pxPerMm)
+                    trimmedBound, trimmedBoundMm = self._trimBoundByProfile(
+                        profile,
+                        boundRect,
+                        testBound,
+                        pxPerMm,
+                    )
+                    if not trimmedBound:
+                        # 真っ白なページ
+                        if self._TraceBound:
+                            self._Logger.debug('  Results white page')
+                        return None
+                    if self._TraceBound:
+                        self._Logger.debug('  New blanks %s', trimmedBoundMm)
+
+                    if trimmedBoundMm[target] > detect:
+                        # 汚れと判定
+                        self._Logger.debug('%s (%s): detect dirt: %s', name, target, trimmedBound)
+
+                        if blacks > points * self.PRINT_THRESHOLD:
+                            # 一定以上の印刷があるのでノイズではないと判定
+                            self._Logger.info(
+                                '%s: Doubt dirt in direction %s, but ignored as much prints: %s / %s',
+                                name,
+                                target,
+                                blacks,
+                                points,
+                            )
+                            break
+
+                        # 描画範囲の外側には描画がないので、対象の辺だけ狭めればよい
+                        clip = profile.clipRect
+                        if target < 2:
+                            clip[target] = boundRect[target] + testBound[target]
+                        else:
+                            clip[target] = boundRect[target] - testBound[target]
+                        profile.clip(clip)
+                        self._Stats.count('detectBound.clips')
+                        self._Stats.count('detectBound.dirts')
+                        updated = True
+                        break
+                    elif trimmedBoundMm[target] > 0.5:
+                        self._Logger.debug(
+                            '%s (%s): detected but not dirt with skip %s: %s',
+                            name,
+                            target,
+                            skip,
+                            trimmedBoundMm,
+                        )
+
+                if updated:
+                    continue
+                break
+
+        return profile.getbbox()
+
+    def _trimBoundByProfile(self, profile, rect, testBound, pxPerMm):
+        u"""rect の各辺を testBound (px) だけ狭めた範囲での余白を返す
+
+        (余白 px, 余白 mm) を返す。描画がない場合は (None, None)。
+        """
+        trimmedRect = [
+            rect[0] + testBound[0],
+            rect[1] + testBound[1],
+            rect[2] - testBound[2],
+            rect[3] - testBound[3],
+        ]
+        trimmedBound = profile.getbbox(trimmedRect)
+        if not trimmedBound:
+            return None, None
+        trimmedBound = self.invertBound(
+            (trimmedRect[2] - trimmedRect[0], trimmedRect[3] - trimmedRect[1]),
+            [
+                trimmedBound[0] - trimmedRect[0],
+                trimmedBound[1] - trimmedRect[1],
+                trimmedBound[2] - trimmedRect[0],
+                trimmedBound[3] - trimmedRect[1],
+            ],
+        )
+        return trimmedBound, self.toMm(trimmedBound, pxPerMm)
+
     def invertBound(self, size, bound):
         return [
             bound[0],
@@ -377,11 +377,18 @@ class IndexGenerator(object):
 
 
 class CopyingIndexGenerator(IndexGenerator):
-    def __init__(self, fromdir, todir, copier):
+    u"""copier で本を変換し、変換後のファイルの index.html を書き込む
+
+    scheduler (bookscheduler.BookScheduler) を指定した場合、変換は scheduler に任せ、
+    scheduler.planning の間は index.html を書き込まない。
+    """
+
+    def __init__(self, fromdir, todir, copier, scheduler=None):
         self._Logger = logging.getLogger(self.__class__.__name__)
         self._Fromdir = fromdir
         self._Todir = todir
         self._Copier = copier
+        self._Scheduler = scheduler
 
     def __call__(self, indexFile, controllerPath, title, subdirList, fileList, opts):
         toIndexFile = os.path.join(
@@ -392,13 +399,19 @@ class CopyingIndexGenerator(IndexGenerator):
         toDir = os.path.dirname(toIndexFile)
         newFileList = []
         for file in fileList:
+            if self._Scheduler is not None:
+                results = self._Scheduler(self._Todir, self._Copier, file, toDir, opts)
+            else:
+                results = [
+                    copier(
+                        file,
+                        toDir,
+                        opts,
+                    )
+                    for copier in self._Copier
+                ]
             updates = []
-            for copier in self._Copier:
-                u = copier(
-                    file,
-                    toDir,
-                    opts,
-                )
+            for u in results:
                 if u is None:
                     continue
                 if u:
@@ -408,6 +421,9 @@ class CopyingIndexGenerator(IndexGenerator):
                     newfile = dict(file)
                     newfile.update(u)
                     newFileList.append(newfile)
+        if self._Scheduler is not None and self._Scheduler.planning:
+            # 変換が終わってから書き込む
+            return bool(subdirList or newFileList)
         return super(CopyingIndexGenerator, self).__call__(
             toIndexFile,
             controllerPath,
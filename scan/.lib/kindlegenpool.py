@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import subprocess
+import time
+
+import backgroundpool
+
+
+class KindlegenJob(object):
+    u"""kindlegen の 1 回分の実行
+
+    run() の後、returncode, stdout, stderr, seconds を参照できる。
+    タイムアウトした場合はプロセスを kill し、timedOut を真にする。
+    """
+
+    def __init__(self, name, cmd):
+        self.name = name
+        self.cmd = cmd
+        self.returncode = None
+        self.stdout = None
+        self.stderr = None
+        self.timedOut = False
+        self.seconds = None
+
+    def run(self, timeout=None):
+        start = time.perf_counter()
+        p = subprocess.Popen(
+            self.cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        try:
+            self.stdout, self.stderr = p.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            self.stdout, self.stderr = p.communicate()
+            self.timedOut = True
+        self.returncode = p.returncode
+        self.seconds = time.perf_counter() - start
+        return self
+
+    @property
+    def succeeded(self):
+        return not self.timedOut and self.returncode == 0
+
+
+class KindlegenPool(backgroundpool.BackgroundPool):
+    u"""kindlegen をバックグラウンドで実行する
+
+    submit(job, finish) で kindlegen の実行を登録し、
+    完了した job は finish(job) で後処理 (strip, rename, upload など) を行う。
+    finish を呼び出すスレッドや待ち合わせは backgroundpool.BackgroundPool を参照。
+    workers が 0 の場合は submit の中で kindlegen を実行する (従来の動作)。
+    timeout は job ごとの秒数。
+    """
+
+    NAME = 'kindlegen'
+
+    def __init__(self, workers=0, timeout=None, maxPending=None):
+        super(KindlegenPool, self).__init__(workers, maxPending=maxPending)
+        self._Timeout = timeout
+
+    def _run(self, job):
+        return job.run(self._Timeout)
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import os.path
+
+import s3
+import uploadqueue
+
+
+class MirrorSync(object):
+    u"""ローカルの出力先 (index.html, index.json, epub, mobi) をアップロード先にそのまま同期する
+
+    root からの相対パスをキーとし、paths に指定したファイル・ディレクトリの下のみを比較する。
+        ローカルにのみあるもの: アップロードする
+        内容が異なるもの: アップロードする
+            hashes (s3.ETagCache) がある場合は ETag、無い場合はサイズと更新日時で判定する
+        アップロード先にのみあるもの: delete が真の場合のみ削除する
+    アップロード先の一覧は inventory (s3.S3Inventory) から取得し、アップロードは uploads (UploadQueue) で並行に行う。
+    dryRun の場合は予定の転送・削除をログに出力するだけにする。
+    """
+
+    ADD = 'add'
+    UPDATE = 'update'
+    DELETE = 'delete'
+
+    # 同期しないファイル名の拡張子 (書き込み中のファイル)
+    IGNORED_EXTENSIONS = ('.tmp',)
+
+    def __init__(self, bucket, inventory, uploads, hashes=None, delete=False, dryRun=False):
+        self._Logger = logging.getLogger(self.__class__.__name__)
+        self._Bucket = bucket
+        self._Inventory = inventory
+        self._Uploads = uploads
+        self._Hashes = hashes
+        self._Delete = delete
+        self._DryRun = dryRun
+        self._Failures = 0
+
+    def _LocalFiles(self, root, paths):
+        u"""key -> ローカルのパスを返す"""
+        files = {}
+        for path in paths:
+            fullPath = os.path.join(root, path)
+            if os.path.isfile(fullPath):
+                files[path.replace(os.sep, '/')] = fullPath
+                continue
+            for dirpath, dirnames, filenames in os.walk(fullPath):
+                dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+                for filename in sorted(filenames):
+                    if filename.startswith('.') or filename.endswith(self.IGNORED_EXTENSIONS):
+                        continue
+                    filePath = os.path.join(dirpath, filename)
+                    files[os.path.relpath(filePath, root).replace(os.sep, '/')] = filePath
+        return files
+
+    def _IsChanged(self, path, entry):
+        if self._Hashes is not None and entry.get('etag'):
+            return not self._Hashes.matches(path, entry['etag'], self._Uploads.chunkSize)
+        stat = os.stat(path)
+        return stat.st_size != entry['size'] or int(stat.st_mtime) > entry['mtime']
+
+    def plan(self, root, paths):
+        u"""[(ADD/UPDATE/DELETE, key, ローカルのパス)] を返す"""
+        files = self._LocalFiles(root, paths)
+        prefixes = tuple(path.replace(os.sep, '/').rstrip('/') + '/' for path in paths)
+        remote = dict(
+            (key, entry)
+            for key, entry in self._Inventory.items()
+            if key in paths or key.startswith(prefixes)
+        )
+        actions = []
+        for key, path in sorted(files.items()):
+            entry = remote.get(key)
+            if entry is None:
+                actions.append((self.ADD, key, path))
+            elif self._IsChanged(path, entry):
+                actions.append((self.UPDATE, key, path))
+        for key in sorted(remote):
+            if key not in files:
+                actions.append((self.DELETE, key, None))
+        self._Logger.info(
+            'Mirror to s3://%s: %s files, %s to add, %s to update, %s orphans',
+            self._Bucket.name,
+            len(files),
+            sum(1 for action, _, _ in actions if action == self.ADD),
+            sum(1 for action, _, _ in actions if action == self.UPDATE),
+            sum(1 for action, _, _ in actions if action == self.DELETE),
+        )
+        return actions
+
+    def sync(self, root, paths):
+        u"""root の下の paths をアップロード先に同期し、失敗した数を返す"""
+        actions = self.plan(root, paths)
+        deletes = []
+        for action, key, path in actions:
+            if action == self.DELETE:
+                if self._Delete:
+                    deletes.append(key)
+                elif self._DryRun:
+                    self._Logger.info('(dryrun) KEEP: s3://%s/%s', self._Bucket.name, key)
+                continue
+            if self._DryRun:
+                self._Logger.info('(dryrun) %s: %s -> s3://%s/%s', action.upper(), path, self._Bucket.name, key)
+                continue
+            self._Upload(key, path)
+        self._Uploads.wait()
+
+        if deletes:
+            if self._DryRun:
+                for key in deletes:
+                    self._Logger.info('(dryrun) DELETE: s3://%s/%s', self._Bucket.name, key)
+            else:
+                self._DeleteOrphans(deletes)
+        return self._Failures
+
+    def _Upload(self, key, path):
+        metadata = None
+        if self._Hashes is not None:
+            metadata = {'md5': self._Hashes.md5(path)}
+
+        def finish(job):
+            if not job.succeeded:
+                self._Failures += 1
+                self._Logger.error('  Uploading to %s failed: %s', job.name, job.error)
+                return
+            etag = None
+            if self._Hashes is not None:
+                etag = self._Hashes.etag(path, self._Uploads.chunkSize)
+            self._Inventory.put(key, job.bytes, job.finishedAt, etag=etag)
+            self._Logger.debug('  Uploaded %s', job.name)
+
+        self._Uploads.submit(uploadqueue.UploadJob(self._Bucket, key, path, metadata=metadata), finish)
+
+    def _DeleteOrphans(self, keys):
+        self._Logger.info('Deleting %s orphans from s3://%s', len(keys), self._Bucket.name)
+        try:
+            self._Bucket.delete(keys)
+        except s3.StorageError as e:
+            self._Failures += len(keys)
+            self._Logger.error('  Deleting from s3://%s failed: %s', self._Bucket.name, e)
+            return
+        for key in keys:
+            self._Inventory.remove(key)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', dest='verbose', action='count', default=0)
+    parser.add_argument('-n', dest='dryrun', action='store_true')
+    parser.add_argument('--bucket', dest='bucket', default='mirror', help='key of buckets in s3.json')
+    parser.add_argument('--delete', dest='delete', action='store_true', help='delete remote objects missing locally')
+    parser.add_argument('--compare-hash', dest='compareHash', action='store_true')
+    parser.add_argument('--workers', dest='workers', type=int, default=4)
+    parser.add_argument('--local', dest='local', help='sync to this directory instead of S3')
+    parser.add_argument('--local-latency', dest='localLatency', type=int, default=0, help='ms per request with --local')
+    parser.add_argument('root')
+    parser.add_argument('paths', nargs='+')
+    opts = parser.parse_args()
+    level = logging.INFO
+    if opts.verbose:
+        level = logging.DEBUG
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)s: %(message)s',
+        level=level,
+    )
+    for name in ['boto3', 'botocore', 's3transfer', 'urllib3']:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    s3info = s3.getS3Info(localRoot=opts.local, localLatency=opts.localLatency / 1000.0)
+    bucket = s3info.getBucket(opts.bucket)
+    if bucket is None:
+        parser.error('No bucket for {0}'.format(opts.bucket))
+    uploads = uploadqueue.UploadQueue(opts.workers)
+    mirror = MirrorSync(
+        bucket,
+        s3info.getInventory(opts.bucket),
+        uploads,
+        hashes=(s3.ETagCache() if opts.compareHash else None),
+        delete=opts.delete,
+        dryRun=opts.dryrun,
+    )
+    failures = mirror.sync(opts.root, opts.paths)
+    uploads.shutdown()
+    s3info.saveInventories()
+    s3info.report()
+    if failures:
+        raise SystemExit(1)
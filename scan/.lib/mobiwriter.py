@@ -0,0 +1,551 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import calendar
+import datetime
+import html
+import io
+import logging
+import re
+import struct
+import zlib
+
+import PIL.Image
+
+# https://wiki.mobileread.com/wiki/PDB
+# https://wiki.mobileread.com/wiki/MOBI
+# https://wiki.mobileread.com/wiki/KF8
+
+
+NULL = 0xFFFFFFFF
+BASE32_DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUV'
+
+
+def toBase32(value, width=0):
+    u"""kindle:embed などで使用する 32 進数の文字列を返す"""
+    digits = ''
+    while True:
+        digits = BASE32_DIGITS[value % 32] + digits
+        value //= 32
+        if value == 0:
+            break
+    return digits.rjust(width, '0')
+
+
+def encodeInt(value):
+    u"""INDX で使用する可変長の整数 (最後のバイトの最上位ビットが立つ) を返す"""
+    data = bytearray()
+    while True:
+        data.insert(0, value & 0x7F)
+        value >>= 7
+        if value == 0:
+            break
+    data[-1] |= 0x80
+    return bytes(data)
+
+
+def alignBlock(data, size=4):
+    if len(data) % size != 0:
+        data += b'\0' * (size - len(data) % size)
+    return data
+
+
+class ExthTypes(object):
+    Creator = 100
+    Published = 106
+    FixedLayout = 122
+    BookType = 123
+    Resources = 125
+    CoverOffset = 201
+    ThumbOffset = 202
+    CreatorSoftware = 204
+    CreatorMajor = 205
+    CreatorMinor = 206
+    CreatorBuild = 207
+    OriginalResolution = 307
+    CdeType = 501
+    UpdatedTitle = 503
+    Language = 524
+    PrimaryWritingMode = 525
+    PageProgressionDirection = 527
+
+
+class _Index(object):
+    u"""KF8 の INDX レコード (ヘッダーのレコード, エントリのレコード, CNCX のレコード) を作る
+
+    TAG_TYPES は (名前, タグ番号, エントリあたりの値の数, コントロールバイトのマスク)。
+    エントリは (ラベル, {名前: 値のタプル})。
+    strings はエントリから cncx() のオフセットで参照する文字列。
+    """
+
+    HEADER_LENGTH = 192
+    RECORD_LIMIT = 0x10000 - HEADER_LENGTH - 1048
+    TAG_TYPES = ()
+
+    def __init__(self, strings=()):
+        # CNCX: ラベルなどの文字列を保持する
+        self._CncxRecords = []
+        self._CncxOffsets = {}
+        buf = b''
+        for string in strings:
+            if string in self._CncxOffsets:
+                continue
+            data = string.encode('utf-8')
+            data = encodeInt(len(data)) + data
+            if len(buf) + len(data) > 0xFBF8:
+                self._CncxRecords.append(alignBlock(buf))
+                buf = b''
+            self._CncxOffsets[string] = len(self._CncxRecords) * 0x10000 + len(buf)
+            buf += data
+        if buf:
+            self._CncxRecords.append(alignBlock(buf))
+
+    def cncx(self, string):
+        return self._CncxOffsets[string]
+
+    def _tagx(self):
+        data = b''
+        for _, number, valuesPerEntry, mask in self.TAG_TYPES:
+            data += struct.pack('>BBBB', number, valuesPerEntry, mask, 0)
+        # 終端
+        data += struct.pack('>BBBB', 0, 0, 0, 1)
+        return b'TAGX' + struct.pack('>LL', 12 + len(data), 1) + data
+
+    def _encodeEntry(self, label, tags):
+        label = label.encode('utf-8')
+        control = 0
+        values = b''
+        for name, _, valuesPerEntry, mask in self.TAG_TYPES:
+            if name not in tags:
+                continue
+            shift = (mask & -mask).bit_length() - 1
+            control |= mask & ((len(tags[name]) // valuesPerEntry) << shift)
+            for value in tags[name]:
+                values += encodeInt(value)
+        return struct.pack('>B', len(label)) + label + struct.pack('>B', control) + values
+
+    def records(self, entries):
+        # (エントリ, IDXT, 件数, 最後のラベル)
+        blocks = [[b'', b'', 0, b'']]
+        for label, tags in entries:
+            data = self._encodeEntry(label, tags)
+            block = blocks[-1]
+            if block[2] and len(block[0]) + len(block[1]) + len(data) + 2 > self.RECORD_LIMIT:
+                block = [b'', b'', 0, b'']
+                blocks.append(block)
+            block[1] += struct.pack('>H', self.HEADER_LENGTH + len(block[0]))
+            block[0] += data
+            block[2] += 1
+            block[3] = label.encode('utf-8')
+
+        records = []
+        for entries, idxt, count, _ in blocks:
+            entries = alignBlock(entries)
+            header = b'INDX' + struct.pack(
+                '>LLLLLL',
+                self.HEADER_LENGTH,
+                0,
+                # 1: エントリのレコード
+                1,
+                0,
+                # IDXT の位置
+                self.HEADER_LENGTH + len(entries),
+                count,
+            )
+            header += b'\xff' * 8
+            header = header.ljust(self.HEADER_LENGTH, b'\0')
+            records.append(header + entries + alignBlock(b'IDXT' + idxt))
+
+        # ヘッダーのレコード: 各レコードの最後のラベルと件数を持つ
+        tagx = alignBlock(self._tagx())
+        geometry = b''
+        idxt = b'IDXT'
+        for _, _, count, last in blocks:
+            idxt += struct.pack('>H', self.HEADER_LENGTH + len(tagx) + len(geometry))
+            geometry += struct.pack('>B', len(last)) + last + struct.pack('>H', count)
+        geometry = alignBlock(geometry)
+        header = b'INDX' + struct.pack(
+            '>LQLLLLLLLLL',
+            self.HEADER_LENGTH,
+            0,
+            # index type (calibre と同じ値)
+            2,
+            # IDXT の位置
+            self.HEADER_LENGTH + len(tagx) + len(geometry),
+            len(records),
+            65001,
+            NULL,
+            sum(block[2] for block in blocks),
+            0,
+            0,
+            0,
+        )
+        header += struct.pack('>L', len(self._CncxRecords))
+        header = header.ljust(180, b'\0')
+        header += struct.pack('>L', self.HEADER_LENGTH)
+        header = header.ljust(self.HEADER_LENGTH, b'\0')
+        records.insert(0, header + tagx + geometry + alignBlock(idxt))
+        return records + self._CncxRecords
+
+
+class _SkeletonIndex(_Index):
+    TAG_TYPES = (
+        ('chunkCount', 1, 1, 3),
+        ('geometry', 6, 2, 12),
+    )
+
+
+class _FragmentIndex(_Index):
+    TAG_TYPES = (
+        ('selector', 2, 1, 1),
+        ('fileNumber', 3, 1, 2),
+        ('sequenceNumber', 4, 1, 4),
+        ('geometry', 6, 2, 8),
+    )
+
+
+class _NcxIndex(_Index):
+    TAG_TYPES = (
+        ('offset', 1, 1, 1),
+        ('length', 2, 1, 2),
+        ('label', 3, 1, 4),
+        ('depth', 4, 1, 8),
+        ('posFid', 6, 2, 128),
+    )
+
+
+class MobiWriter(object):
+    u"""画像だけの本を固定レイアウトの KF8 (mobi) として書き出す
+
+    kindlegen を使わずに、1 ページ 1 画像の XHTML と画像のレコードから mobi を作る。
+    ページは addPage した順に並べ、最初のページを表紙にする。
+    画像はすべてメモリに保持し、write() でまとめて書き出す。
+    """
+
+    PALM_DOC_HEADER_LENGTH = 16
+    MOBI_HEADER_LENGTH = 264
+    RECORD_SIZE = 4096
+    THUMBNAIL_SIZE = (330, 470)
+    LANGUAGES = {
+        'en': 9,
+        'ja': 17,
+    }
+    CSS = (
+        '@page { margin: 0; }\n'
+        'html, body, div { margin: 0; padding: 0; width: 100%; height: 100%; }\n'
+        'img { display: block; width: 100%; height: 100%; }\n'
+    )
+
+    def __init__(self, title, author=None, published=None, language='ja', direction='rtl', resolution=(758, 1024)):
+        self._Logger = logging.getLogger(self.__class__.__name__)
+        self._Title = title
+        self._Author = author
+        if published is None:
+            published = datetime.datetime.now(datetime.timezone.utc)
+        self._Published = published
+        self._Language = language
+        self._Direction = direction
+        self._Resolution = resolution
+        # (JPEG, (幅, 高さ))
+        self._Pages = []
+
+    def addPage(self, data):
+        u"""JPEG のバイト列を 1 ページとして追加する"""
+        with PIL.Image.open(io.BytesIO(data)) as image:
+            size = image.size
+        self._Pages.append((data, size))
+
+    def write(self, fh):
+        if not self._Pages:
+            raise ValueError('No pages')
+        records = [None]
+        text, flowLengths, skeletons, fragments = self._buildText()
+        textRecords = self._buildTextRecords(text)
+        records.extend(textRecords)
+
+        firstNonText = len(records)
+        fragmentIndex = len(records)
+        records.extend(self._buildFragmentIndex(fragments))
+        skeletonIndex = len(records)
+        records.extend(self._buildSkeletonIndex(skeletons))
+        ncxIndex = len(records)
+        records.extend(self._buildNcxIndex(skeletons, flowLengths[0]))
+
+        firstResource = len(records)
+        for data, _ in self._Pages:
+            records.append(alignBlock(data))
+        thumbnail = len(records) - firstResource
+        records.append(self._buildThumbnail())
+        records.append(self._buildResc(skeletons))
+        resources = len(records) - firstResource
+
+        fdst = len(records)
+        records.append(self._buildFdst(flowLengths))
+        flis = len(records)
+        records.append(self._buildFlis())
+        fcis = len(records)
+        records.append(self._buildFcis(len(text)))
+        records.append(b'\xe9\x8e\r\n')
+
+        records[0] = self._buildRecord0(
+            textLength=len(text),
+            textRecords=len(textRecords),
+            firstNonText=firstNonText,
+            firstResource=firstResource,
+            fdst=fdst,
+            fdstCount=len(flowLengths),
+            fcis=fcis,
+            flis=flis,
+            ncxIndex=ncxIndex,
+            fragmentIndex=fragmentIndex,
+            skeletonIndex=skeletonIndex,
+            thumbnail=thumbnail,
+            resources=resources,
+        )
+        self._writePdb(fh, records)
+
+    def _buildText(self):
+        u"""(テキスト, フローの長さ, [(開始位置, 長さ)], [(挿入位置, セレクター, 長さ)]) を返す
+
+        フロー 0 は各ページのスケルトン (XHTML から本文を除いたもの) と
+        本文のフラグメントを順に並べたもの、フロー 1 は CSS。
+        """
+        text = b''
+        skeletons = []
+        fragments = []
+        title = html.escape(self._Title)
+        for index, (_, (width, height)) in enumerate(self._Pages):
+            bodyAid = toBase32(index * 2)
+            skeleton = (
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<html xmlns="http://www.w3.org/1999/xhtml">'
+                '<head><title>{title}</title>'
+                '<meta name="viewport" content="width={width}, height={height}"/>'
+                '<link href="kindle:flow:0001?mime=text/css" rel="stylesheet" type="text/css"/>'
+                '</head><body aid="{aid}"></body></html>'
+            ).format(title=title, width=width, height=height, aid=bodyAid).encode('utf-8')
+            fragment = (
+                '<div aid="{aid}"><img src="kindle:embed:{embed}?mime=image/jpeg" alt=""/></div>'
+            ).format(aid=toBase32(index * 2 + 1), embed=toBase32(index + 1, 4)).encode('utf-8')
+            start = len(text)
+            skeletons.append((start, len(skeleton)))
+            fragments.append((
+                start + skeleton.index(b'</body>'),
+                "P-//*[@aid='{0}']".format(bodyAid),
+                len(fragment),
+            ))
+            text += skeleton + fragment
+        css = self.CSS.encode('utf-8')
+        return text + css, (len(text), len(css)), skeletons, fragments
+
+    def _buildTextRecords(self, text):
+        u"""RECORD_SIZE ごとに分割する。末尾にマルチバイト文字の続きを持たせる"""
+        records = []
+        for start in range(0, len(text), self.RECORD_SIZE):
+            end = start + self.RECORD_SIZE
+            overlap = b''
+            while end + len(overlap) < len(text) and len(overlap) < 3 and text[end + len(overlap)] & 0xC0 == 0x80:
+                overlap += text[end + len(overlap):end + len(overlap) + 1]
+            records.append(text[start:end] + overlap + struct.pack('>B', len(overlap)))
+        return records
+
+    def _buildSkeletonIndex(self, skeletons):
+        # kindlegen と同様に値を 2 回ずつ繰り返す
+        return _SkeletonIndex().records([
+            ('SKEL{0:010d}'.format(index), {
+                'chunkCount': (1, 1),
+                'geometry': (start, length, start, length),
+            })
+            for index, (start, length) in enumerate(skeletons)
+        ])
+
+    def _buildFragmentIndex(self, fragments):
+        index = _FragmentIndex([selector for _, selector, _ in fragments])
+        return index.records([
+            ('{0:010d}'.format(insertPosition), {
+                'selector': (index.cncx(selector),),
+                'fileNumber': (number,),
+                'sequenceNumber': (number,),
+                'geometry': (0, length),
+            })
+            for number, (insertPosition, selector, length) in enumerate(fragments)
+        ])
+
+    def _buildNcxIndex(self, skeletons, textLength):
+        u"""表紙 (最初のフラグメント) を指す 1 項目だけの目次を作る"""
+        index = _NcxIndex([self._Title])
+        offset = skeletons[0][0] + skeletons[0][1]
+        return index.records([
+            ('0', {
+                'offset': (offset,),
+                'length': (textLength - offset,),
+                'label': (index.cncx(self._Title),),
+                'depth': (0,),
+                'posFid': (0, 0),
+            }),
+        ])
+
+    def _buildThumbnail(self):
+        with PIL.Image.open(io.BytesIO(self._Pages[0][0])) as image:
+            image.thumbnail(self.THUMBNAIL_SIZE)
+            out = io.BytesIO()
+            image.save(out, format='jpeg')
+        return alignBlock(out.getvalue())
+
+    def _buildResc(self, skeletons):
+        u"""ページの並び (spine) を持つ RESC レコードを作る"""
+        text = '<?xml version="1.0" encoding="utf-8"?>'
+        text += (
+            '<package version="2.0" xmlns="http://www.idpf.org/2007/opf" unique-identifier="uid">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">'
+            '</metadata>'
+        )
+        text += '<spine page-progression-direction="{0}">'.format(self._Direction)
+        for index in range(len(skeletons)):
+            text += '<itemref idref="page{0}" skelid="{0}"/>'.format(index)
+        text += '</spine></package>'
+        data = text.encode('utf-8')
+        prefix = 'size={0}&version=1&type=1'.format(toBase32(len(data))).encode('ascii')
+        return alignBlock(b'RESC' + b'\0' * 12 + prefix + data)
+
+    def _buildFdst(self, flowLengths):
+        data = b'FDST' + struct.pack('>LL', 12, len(flowLengths))
+        start = 0
+        for length in flowLengths:
+            data += struct.pack('>LL', start, start + length)
+            start += length
+        return data
+
+    def _buildFlis(self):
+        return b'FLIS' + struct.pack('>LHHLLHHLLL', 8, 65, 0, 0, NULL, 1, 3, 3, 1, NULL)
+
+    def _buildFcis(self, textLength):
+        return (
+            b'FCIS' + struct.pack('>LLLL', 20, 16, 2, 0)
+            + struct.pack('>L', textLength)
+            + b'\x00\x00\x00\x00\x00\x00\x00\x28\x00\x00\x00\x00\x00\x00\x00'
+            + b'\x28\x00\x00\x00\x08\x00\x01\x00\x01\x00\x00\x00\x00'
+        )
+
+    def _buildExth(self, thumbnail, resources):
+        width, height = self._Resolution
+        exthList = [
+            (ExthTypes.UpdatedTitle, self._Title),
+            (ExthTypes.Published, self._Published.strftime('%Y-%m-%dT%H:%M:%SZ')),
+            (ExthTypes.Language, self._Language),
+            (ExthTypes.CdeType, 'EBOK'),
+            (ExthTypes.FixedLayout, 'true'),
+            (ExthTypes.BookType, 'comic'),
+            (ExthTypes.OriginalResolution, '{0}x{1}'.format(width, height)),
+            (ExthTypes.PrimaryWritingMode, 'horizontal-rl' if self._Direction == 'rtl' else 'horizontal-lr'),
+            (ExthTypes.PageProgressionDirection, self._Direction),
+            (ExthTypes.CoverOffset, 0),
+            (ExthTypes.ThumbOffset, thumbnail),
+            (ExthTypes.Resources, resources),
+            # KF8 を扱える kindlegen (2.9) で作成したものとして扱わせる
+            (ExthTypes.CreatorSoftware, 201),
+            (ExthTypes.CreatorMajor, 2),
+            (ExthTypes.CreatorMinor, 9),
+            (ExthTypes.CreatorBuild, 0),
+        ]
+        if self._Author:
+            exthList.insert(0, (ExthTypes.Creator, self._Author))
+
+        data = b''
+        for type, value in exthList:
+            if isinstance(value, int):
+                value = struct.pack('>L', value)
+            else:
+                value = value.encode('utf-8')
+            data += struct.pack('>LL', type, len(value) + 8) + value
+        return alignBlock(b'EXTH' + struct.pack('>LL', len(data) + 12, len(exthList)) + data)
+
+    def _buildRecord0(self, textLength, textRecords, firstNonText, firstResource, fdst, fdstCount, fcis, flis, ncxIndex, fragmentIndex, skeletonIndex, thumbnail, resources):
+        exth = self._buildExth(thumbnail, resources)
+        title = self._Title.encode('utf-8')
+        uid = zlib.crc32(title + self._Published.isoformat().encode('ascii'))
+
+        # PalmDOC Header: 非圧縮
+        data = struct.pack('>HHLHHHH', 1, 0, textLength, textRecords, self.RECORD_SIZE, 0, 0)
+        # MOBI Header
+        data += b'MOBI' + struct.pack(
+            '>LLLLL',
+            self.MOBI_HEADER_LENGTH,
+            # mobipocket book
+            2,
+            # UTF-8
+            65001,
+            uid,
+            # KF8
+            8,
+        )
+        # 索引 (orth, infl, names, keys, extra 0-5): なし
+        data += struct.pack('>L', NULL) * 10
+        data += struct.pack(
+            '>LLLLLLLL',
+            firstNonText,
+            self.PALM_DOC_HEADER_LENGTH + self.MOBI_HEADER_LENGTH + len(exth),
+            len(title),
+            self.LANGUAGES.get(self._Language, 0),
+            0,
+            0,
+            # min version
+            8,
+            firstResource,
+        )
+        # Huffman: なし
+        data += b'\0' * 16
+        # EXTH あり
+        data += struct.pack('>L', 0x50)
+        data += b'\0' * 32
+        # 0xA4: unknown, DRM: なし
+        data += struct.pack('>LLLLL', NULL, NULL, 0, 0, 0)
+        data += b'\0' * 8
+        data += struct.pack('>LLLLLL', fdst, fdstCount, fcis, 1, flis, 1)
+        data += b'\0' * 8
+        # SRCS: なし
+        data += struct.pack('>LL', NULL, 0)
+        data += struct.pack('>LL', NULL, NULL)
+        # trailing entries: マルチバイト文字のみ
+        data += struct.pack('>L', 1)
+        data += struct.pack('>LLL', ncxIndex, fragmentIndex, skeletonIndex)
+        # DATP, guide: なし
+        data += struct.pack('>LL', NULL, NULL)
+        data += struct.pack('>LLLL', NULL, 0, NULL, 0)
+        assert len(data) == self.PALM_DOC_HEADER_LENGTH + self.MOBI_HEADER_LENGTH
+
+        data += exth + title
+        # kindlegen と同様に後から書き換えられるよう余白を設ける
+        return alignBlock(data + b'\0' * 8192)
+
+    def _writePdb(self, fh, records):
+        name = re.sub(r'[^-A-Za-z0-9]+', '_', self._Title).strip('_')[:31] or 'book'
+        timestamp = calendar.timegm(self._Published.utctimetuple()) + 2082844800
+        # 0: database name, attributes, version, dates, modification number,
+        # app info, sort info, type, creator, unique id seed, next record list
+        fh.write(struct.pack(
+            '>32sHHLLLLLL4s4sLL',
+            name.encode('ascii'),
+            0,
+            0,
+            timestamp,
+            timestamp,
+            0,
+            0,
+            0,
+            0,
+            b'BOOK',
+            b'MOBI',
+            2 * len(records) - 1,
+            0,
+        ))
+        # 76: record info list
+        fh.write(struct.pack('>H', len(records)))
+        offset = 78 + 8 * len(records) + 2
+        for index, record in enumerate(records):
+            fh.write(struct.pack('>LL', offset, 2 * index))
+            offset += len(record)
+        # gap to data
+        fh.write(b'\0\0')
+        for record in records:
+            fh.write(record)
@@ -23,6 +23,8 @@ class Monochromize(object):
         if image.mode == 'L':
             return False
 
+        # 輝度成分だけをデコードする
+        image.draft('L', None)
         image = image.convert('L')
 
         image.save(tofile, format='jpeg', **self._SaveOpts)
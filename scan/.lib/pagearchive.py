@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import io
+import logging
+import time
+import zipfile
+
+import pagestats
+
+
+class PageArchive(object):
+    u"""zip 内のページ画像を読み込む
+
+    prescan では画像全体を展開せず、zip のエントリをストリームとして開いて
+    PIL がヘッダ (JFIF/EXIF, SOF) を読む分だけ展開する。
+    最適化の際も open() でストリームとして読み込めば、ページ全体を保持しない。
+    singlePass の場合は prescan で全体を展開して保持し、
+    最適化の際に再度展開しないようにする。
+    展開・prescan の所要時間は stats (pagestats.PageStats) に集計する。
+    """
+
+    def __init__(self, zipFile, singlePass=False, stats=None):
+        self._Logger = logging.getLogger(self.__class__.__name__)
+        self._ZipFile = zipFile
+        self._SinglePass = singlePass
+        self._Buffers = {}
+        if stats is None:
+            stats = pagestats.PageStats()
+        self._Stats = stats
+
+    def prescan(self, optimizer, name, info):
+        with self._Stats.timer('prescan'):
+            if self._SinglePass:
+                with self._Stats.timer('zipRead'):
+                    data = self._ZipFile.read(info)
+                self._Buffers[info.filename] = data
+                optimizer.prescan(name, io.BytesIO(data))
+                return
+            with self._ZipFile.open(info) as fh:
+                optimizer.prescan(name, fh)
+
+    def open(self, info):
+        u"""エントリを読み込むファイルオブジェクトを返す。prescan で保持している場合はそれを返す
+
+        展開は読み込みに合わせて行うため、その所要時間は読み込む側の集計に含まれる。
+        """
+        data = self._Buffers.pop(info.filename, None)
+        if data is not None:
+            return io.BytesIO(data)
+        return self._ZipFile.open(info)
+
+    def read(self, info):
+        u"""エントリの内容を返す。prescan で保持している場合はそれを返す"""
+        data = self._Buffers.pop(info.filename, None)
+        if data is not None:
+            return data
+        with self._Stats.timer('zipRead'):
+            return self._ZipFile.read(info)
+
+
+class PageWriter(object):
+    u"""ページ画像を zip のエントリに直接書き込む
+
+    エントリは最初の書き込みで開き、別のエントリへの書き込みを始めた時か
+    close() で閉じる。zipfile は同時に 1 つのエントリにしか書き込めないため、
+    ページの出力は 1 つずつ順に書き込む。
+    JPEG は圧縮しても小さくならないので ZIP_STORED で格納する。
+    エントリを開いたままでは ZipFile を閉じられないため、with で使用して
+    ページの処理で例外が起きた場合も ZipFile より先に閉じる。
+    """
+
+    def __init__(self, zipFile, stats=None):
+        self._Logger = logging.getLogger(self.__class__.__name__)
+        self._ZipFile = zipFile
+        if stats is None:
+            stats = pagestats.PageStats()
+        self._Stats = stats
+        self._Filename = None
+        self._Handle = None
+        self._bytesWritten = 0
+
+    @property
+    def bytesWritten(self):
+        return self._bytesWritten
+
+    def open(self, filename):
+        u"""filename のエントリに書き込むファイルオブジェクトを返す"""
+        return _PageEntry(self, filename)
+
+    def _write(self, filename, data):
+        start = time.perf_counter()
+        calls = 0
+        if filename != self._Filename:
+            self.close()
+            # ZipFile.writestr にファイル名を渡した場合と同じ属性にする
+            info = zipfile.ZipInfo(filename, date_time=time.localtime(time.time())[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            info.external_attr = 0o600 << 16
+            self._Handle = self._ZipFile.open(info, 'w')
+            self._Filename = filename
+            calls = 1
+        self._Handle.write(data)
+        self._bytesWritten += len(data)
+        self._Stats.add('epubWrite', time.perf_counter() - start, calls)
+
+    def close(self):
+        if self._Handle is not None:
+            self._Handle.close()
+            self._Handle = None
+            self._Filename = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _PageEntry(object):
+    u"""PageWriter の 1 つのエントリへの書き込み口"""
+
+    def __init__(self, writer, filename):
+        self._Writer = writer
+        self._Filename = filename
+
+    def write(self, data):
+        self._Writer._write(self._Filename, data)
+        return len(data)
+
+    def flush(self):
+        pass
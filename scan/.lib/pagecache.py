@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tempfile
+
+
+class PageCache(object):
+    u"""最適化済みページのディスクキャッシュ
+
+    元の JPEG の内容と最適化のパラメーターをキーとして、
+    最適化後の JPEG と report() 用のページ情報を保存する。
+    合計サイズが maxBytes を超えた場合、最も古く使われたものから削除する。
+
+    ファイルの形式:
+        1 行目: JSON ({"sizes": [出力ごとのバイト数], "pageInfoMap": {...}})
+        2 行目以降: 出力の JPEG を連結したもの
+    """
+
+    def __init__(self, directory, maxBytes=1024 * 1024 * 1024):
+        self._Logger = logging.getLogger(self.__class__.__name__)
+        self._Directory = directory
+        self._MaxBytes = maxBytes
+        self._hits = 0
+        self._misses = 0
+        # key -> size を最後に使った順に保持する
+        self._Entries = collections.OrderedDict()
+        self._totalBytes = 0
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self._Directory):
+            os.makedirs(self._Directory)
+            return
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self._Directory):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                stat = os.stat(os.path.join(dirpath, filename))
+                entries.append((stat.st_mtime, filename, stat.st_size))
+        entries.sort()
+        for _, key, size in entries:
+            self._Entries[key] = size
+            self._totalBytes += size
+        self._Logger.debug(
+            'Loaded %s entries (%s bytes) from %s',
+            len(self._Entries),
+            self._totalBytes,
+            self._Directory,
+        )
+        self._evict()
+
+    def _path(self, key):
+        return os.path.join(self._Directory, key[:2], key)
+
+    def key(self, name, data, parameters):
+        h = hashlib.sha256()
+        h.update(json.dumps(
+            [name, parameters],
+            sort_keys=True,
+        ).encode('utf-8'))
+        h.update(b'\0')
+        h.update(data)
+        return h.hexdigest()
+
+    def get(self, key):
+        u"""(outputs, pageInfoMap) を返す。キャッシュにない場合は None"""
+        if key not in self._Entries:
+            self._misses += 1
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fh:
+                header = json.loads(fh.readline())
+                outputs = [fh.read(size) for size in header['sizes']]
+        except (OSError, ValueError, KeyError) as e:
+            self._Logger.warning('Broken cache %s: %s', path, e)
+            self._remove(key)
+            self._misses += 1
+            return None
+        self._hits += 1
+        self._Entries.move_to_end(key)
+        os.utime(path)
+        return outputs, header['pageInfoMap']
+
+    def put(self, key, outputs, pageInfoMap):
+        path = self._path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        header = json.dumps({
+            'sizes': [len(data) for data in outputs],
+            'pageInfoMap': pageInfoMap,
+        }).encode('utf-8')
+        fd, tmpFile = tempfile.mkstemp(suffix='.tmp', dir=dirname)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(header)
+            fh.write(b'\n')
+            for data in outputs:
+                fh.write(data)
+        os.replace(tmpFile, path)
+        if key in self._Entries:
+            self._totalBytes -= self._Entries.pop(key)
+        size = os.path.getsize(path)
+        self._Entries[key] = size
+        self._totalBytes += size
+        self._evict()
+
+    def _remove(self, key):
+        self._totalBytes -= self._Entries.pop(key)
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self._totalBytes > self._MaxBytes and self._Entries:
+            key = next(iter(self._Entries))
+            self._Logger.debug('Evicting %s', key)
+            self._remove(key)
+
+    def report(self):
+        self._Logger.info(
+            'Page cache: %s hits, %s misses, %s entries (%s bytes)',
+            self._hits,
+            self._misses,
+            len(self._Entries),
+            self._totalBytes,
+        )
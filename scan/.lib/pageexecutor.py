@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import concurrent.futures
+import io
+import logging
+import os
+
+import pagestats
+
+
+def _optimizePage(optimizer, name, data, divide):
+    u"""1 ページを最適化し、出力した JPEG のリストを返す"""
+    if divide:
+        outfh = (io.BytesIO(), io.BytesIO())
+        optimizer.optimize(name, io.BytesIO(data), outfh)
+        return [w.getvalue() for w in outfh]
+    outfh = io.BytesIO()
+    optimizer.optimize(name, io.BytesIO(data), outfh)
+    return [outfh.getvalue()]
+
+
+def _optimizePageInWorker(optimizer, name, data, divide):
+    u"""ワーカーで 1 ページを最適化し、出力とページ情報、所要時間の集計を返す"""
+    outputs = _optimizePage(optimizer, name, data, divide)
+    return outputs, optimizer.pageInfoMap, optimizer.stats
+
+
+class PageExecutor(object):
+    u"""ページ単位の最適化を並列に実行する
+
+    出力は入力の順に返し、report() 用のページ情報も入力の順に集計する。
+    cache (pagecache.PageCache) を指定した場合、最適化済みのページを再利用する。
+    ページごとの所要時間は stats (pagestats.StatsCollector) に入力の順に渡す。
+    """
+
+    THREAD = 'thread'
+    PROCESS = 'process'
+
+    def __init__(self, kind=THREAD, workers=None, cache=None, stats=None):
+        self._Logger = logging.getLogger(self.__class__.__name__)
+        if kind not in (self.THREAD, self.PROCESS):
+            raise ValueError('Unknown executor: {0}'.format(kind))
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self._Kind = kind
+        self._Workers = workers
+        self._Pool = None
+        self._Cache = cache
+        if stats is None:
+            stats = pagestats.StatsCollector()
+        self._Stats = stats
+
+    @property
+    def workers(self):
+        return self._Workers
+
+    @property
+    def stats(self):
+        return self._Stats
+
+    def _getPool(self):
+        if self._Pool is None:
+            self._Logger.debug('Starting %s pool with %s workers', self._Kind, self._Workers)
+            if self._Kind == self.PROCESS:
+                self._Pool = concurrent.futures.ProcessPoolExecutor(max_workers=self._Workers)
+            else:
+                self._Pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._Workers)
+        return self._Pool
+
+    def map(self, optimizer, pages):
+        u"""(name, data, divide) のイテレータを最適化し、入力順に (name, outputs) を返す
+
+        data は元の JPEG のバイト列。
+        outputs は divide が真の場合は 2 つ、そうでなければ 1 つの JPEG のバイト列。
+        """
+        if self._Workers <= 1 and self._Cache is None:
+            for name, data, divide in pages:
+                outputs = _optimizePage(optimizer, name, data, divide)
+                self._Stats.addPage(name, optimizer.takeStats())
+                yield name, outputs
+            return
+
+        # 先読みするページ数を制限してメモリ使用量を抑える
+        maxPending = self._Workers * 2 if self._Workers > 1 else 1
+        pending = collections.deque()
+        try:
+            for name, data, divide in pages:
+                pending.append(self._submit(optimizer, name, data, divide))
+                if len(pending) >= maxPending:
+                    yield self._collect(optimizer, *pending.popleft())
+            while pending:
+                yield self._collect(optimizer, *pending.popleft())
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+
+    def canStream(self):
+        u"""ページをバイト列として保持せずに読み書きできるかを返す
+
+        ワーカー・キャッシュを使う場合は入出力をバイト列として受け渡す必要がある。
+        """
+        return self._Workers <= 1 and self._Cache is None
+
+    def writePages(self, optimizer, archive, pages, openOutputs):
+        u"""(name, info, divide) のイテレータを最適化し、入力順に出力先に書き込む
+
+        info は archive (pagearchive.PageArchive) の zip のエントリ。
+        openOutputs(name, divide) は書き込み先のファイルオブジェクトのリスト
+        (divide が真の場合は 2 つ、そうでなければ 1 つ) を返す。
+        canStream() の場合、エントリをストリームとして読み込み、エンコード結果を
+        バッファせずに直接書き込むため、メモリ使用量はページの数や大きさによらない。
+        """
+        if not self.canStream():
+            for name, outputs in self.map(
+                optimizer,
+                ((name, archive.read(info), divide) for name, info, divide in pages),
+            ):
+                for outfh, data in zip(openOutputs(name, len(outputs) == 2), outputs):
+                    outfh.write(data)
+            return
+
+        for name, info, divide in pages:
+            outfh = openOutputs(name, divide)
+            with archive.open(info) as infh:
+                optimizer.optimize(name, infh, outfh if divide else outfh[0])
+            self._Stats.addPage(name, optimizer.takeStats())
+
+    def _submit(self, optimizer, name, data, divide):
+        u"""(name, キャッシュに保存するキー, future) を返す"""
+        key = None
+        if self._Cache is not None:
+            key = self._Cache.key(name, data, optimizer.parameters(divide))
+            cached = self._Cache.get(key)
+            if cached is not None:
+                stats = pagestats.PageStats()
+                stats.count('cacheHits')
+                future = concurrent.futures.Future()
+                future.set_result(cached + (stats,))
+                return name, None, future
+
+        if self._Workers <= 1:
+            future = concurrent.futures.Future()
+            future.set_result(_optimizePageInWorker(optimizer.clone(), name, data, divide))
+            return name, key, future
+
+        return name, key, self._getPool().submit(
+            _optimizePageInWorker,
+            optimizer.clone(),
+            name,
+            data,
+            divide,
+        )
+
+    def _collect(self, optimizer, name, key, future):
+        outputs, pageInfoMap, stats = future.result()
+        optimizer.mergePageInfo(pageInfoMap)
+        self._Stats.addPage(name, stats)
+        if key is not None:
+            self._Cache.put(key, outputs, pageInfoMap)
+        return name, outputs
+
+    def shutdown(self):
+        if self._Cache is not None:
+            self._Cache.report()
+        if self._Pool is not None:
+            self._Pool.shutdown()
+            self._Pool = None
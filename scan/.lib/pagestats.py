@@ -0,0 +1,188 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import contextlib
+import json
+import logging
+import time
+
+
+class PageStats(object):
+    u"""処理の段階ごとの所要時間・回数と、カウンターを集計する
+
+    段階は入れ子にでき (removeDirts の中の detectBound など)、
+    それぞれの所要時間は内側の段階の時間を含む。
+    1 つのインスタンスは 1 つのスレッドからのみ使用する。
+    """
+
+    def __init__(self):
+        # stage -> [seconds, calls]
+        self._Timers = {}
+        # name -> count
+        self._Counters = {}
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds, calls=1):
+        timer = self._Timers.get(stage)
+        if timer is None:
+            timer = self._Timers[stage] = [0.0, 0]
+        timer[0] += seconds
+        timer[1] += calls
+
+    def count(self, name, n=1):
+        self._Counters[name] = self._Counters.get(name, 0) + n
+
+    def seconds(self, stage):
+        return self._Timers.get(stage, [0.0, 0])[0]
+
+    def counter(self, name):
+        return self._Counters.get(name, 0)
+
+    def merge(self, other):
+        u"""other (PageStats または toDict() の結果) を加算する"""
+        if isinstance(other, PageStats):
+            other = other.toDict()
+        for stage, timer in other.get('timers', {}).items():
+            self.add(stage, timer['seconds'], timer['calls'])
+        for name, count in other.get('counters', {}).items():
+            self.count(name, count)
+
+    @classmethod
+    def fromDict(cls, data):
+        stats = cls()
+        stats.merge(data)
+        return stats
+
+    def toDict(self):
+        return {
+            'timers': dict(
+                (stage, {'seconds': seconds, 'calls': calls})
+                for stage, (seconds, calls) in self._Timers.items()
+            ),
+            'counters': dict(self._Counters),
+        }
+
+    def format(self):
+        u"""時間のかかった段階から順に並べた 1 行の文字列を返す"""
+        return ', '.join(
+            '%s %.2fs/%s' % (stage, seconds, calls)
+            for stage, (seconds, calls) in sorted(
+                self._Timers.items(),
+                key=lambda item: -item[1][0],
+            )
+        )
+
+
+class StatsCollector(object):
+    u"""ページ・本ごとの PageStats を本ごと・実行全体で集計する
+
+    addHook で登録した関数は hook(event, name, stats) の形で呼び出される。
+        PAGE: ページの最適化が終わった時。stats はそのページの PageStats
+        BOOK: 本の変換が終わった時。stats はその本の PageStats
+    ページの最適化をワーカーで行う場合も、フックは呼び出し元のスレッドで呼び出す。
+    """
+
+    PAGE = 'page'
+    BOOK = 'book'
+
+    def __init__(self):
+        self._Logger = logging.getLogger(self.__class__.__name__)
+        self._Hooks = []
+        self._Total = PageStats()
+        self._Books = []
+        self._BookName = None
+        self._Book = None
+
+    def addHook(self, hook):
+        self._Hooks.append(hook)
+
+    def removeHook(self, hook):
+        self._Hooks.remove(hook)
+
+    def _call(self, event, name, stats):
+        for hook in self._Hooks:
+            hook(event, name, stats)
+
+    @property
+    def total(self):
+        return self._Total
+
+    def beginBook(self, name):
+        u"""本の集計を始め、その本の PageStats を返す
+
+        終わっていない本がある場合、その本の集計は破棄する。
+        """
+        if self._Book is not None:
+            self._Logger.debug('Discard stats for %s', self._BookName)
+        self._BookName = name
+        self._Book = PageStats()
+        return self._Book
+
+    def addPage(self, name, stats):
+        u"""1 ページ分の PageStats を現在の本に加える"""
+        self._call(self.PAGE, name, stats)
+        if self._Book is not None:
+            self._Book.merge(stats)
+        else:
+            self._Total.merge(stats)
+
+    def endBook(self):
+        u"""現在の本の集計を終え、その本の PageStats を返す"""
+        name, stats = self._BookName, self._Book
+        if stats is None:
+            return None
+        self._BookName = None
+        self._Book = None
+        self.addBook(name, stats)
+        return stats
+
+    def addBook(self, name, stats):
+        u"""集計を終えた本の PageStats (または toDict() の結果) を加える
+
+        別のプロセスで変換した本の集計を取り込む場合に使用する。
+        """
+        if not isinstance(stats, PageStats):
+            stats = PageStats.fromDict(stats)
+        self._Books.append((name, stats))
+        self._Total.merge(stats)
+        self._call(self.BOOK, name, stats)
+
+    def takeBooks(self):
+        u"""集計を終えた本の (name, toDict() の結果) のリストを返し、集計から取り除く"""
+        books = [(name, stats.toDict()) for name, stats in self._Books]
+        self._Books = []
+        self._Total = PageStats()
+        return books
+
+    def addToBook(self, name, stats):
+        u"""集計を終えた本 name に、後から終わった処理の PageStats を加える
+
+        kindlegen をバックグラウンドで実行する場合など、
+        本の集計を終えた後に完了する処理に使用する。
+        """
+        for bookName, bookStats in reversed(self._Books):
+            if bookName == name:
+                bookStats.merge(stats)
+                break
+        self._Total.merge(stats)
+
+    def summary(self):
+        return {
+            'total': self._Total.toDict(),
+            'books': [
+                dict(name=name, **stats.toDict())
+                for name, stats in self._Books
+            ],
+        }
+
+    def save(self, path):
+        with open(path, 'w') as fh:
+            json.dump(self.summary(), fh, indent=1, sort_keys=True)
+            fh.write('\n')
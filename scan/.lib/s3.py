@@ -1,30 +1,100 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import calendar
+import collections
+import concurrent.futures
+import hashlib
 import json
+import logging
+import math
+import os
 import os.path
+import random
+import threading
+import time
+
+def getS3Info(inventoryCache=None, inventoryMaxAge=None, localRoot=None, localLatency=0.0, localBandwidth=None):
+    u"""s3.json があれば接続した ConnectedS3Info を返す
+
+    inventoryCache はバケットの一覧 (S3Inventory) を保存するディレクトリ。
+    localRoot を指定すると S3 の代わりにそのディレクトリ (LocalS3Info) を使用する。
+    """
+    if localRoot:
+        return LocalS3Info(
+            localRoot,
+            latency=localLatency,
+            bandwidth=localBandwidth,
+            inventoryCache=inventoryCache,
+            inventoryMaxAge=inventoryMaxAge,
+        )
 
-def getS3Info():
     s3file = os.path.join(os.path.dirname(__file__), 's3.json')
     if not os.path.exists(s3file):
         return S3Info()
 
     with open(s3file, 'rb') as f:
         s3info = json.load(f)
-    s3 = ConnectedS3Info(s3info)
+    s3 = ConnectedS3Info(s3info, inventoryCache=inventoryCache, inventoryMaxAge=inventoryMaxAge)
     s3.connect()
     return s3
 
 
 class S3Info(object):
+    u"""key (novel, comic) ごとのアップロード先 (Storage) と S3Inventory を返す
 
-    def getBucket(self, key):
+    このクラス自体はアップロード先を持たない。
+    """
+
+    def __init__(self, inventoryCache=None, inventoryMaxAge=None):
+        self._InventoryCache = inventoryCache
+        self._InventoryMaxAge = inventoryMaxAge
+        # key -> Storage
+        self._Buckets = {}
+        # key -> S3Inventory
+        self._Inventories = {}
+
+    def _OpenBucket(self, key):
         return None
 
+    def getBucket(self, key):
+        u"""key のアップロード先の Storage を返す。無い場合は None"""
+        if key not in self._Buckets:
+            self._Buckets[key] = self._OpenBucket(key)
+        return self._Buckets[key]
+
+    def getInventory(self, key):
+        u"""key のバケットの S3Inventory を返す。同じ key には同じものを返す"""
+        if key not in self._Inventories:
+            bucket = self.getBucket(key)
+            if bucket is None:
+                return None
+            cacheFile = None
+            if self._InventoryCache:
+                cacheFile = os.path.join(self._InventoryCache, bucket.name + '.json')
+            self._Inventories[key] = S3Inventory(bucket, cacheFile=cacheFile, maxAge=self._InventoryMaxAge)
+        return self._Inventories[key]
+
+    def loadInventories(self):
+        u"""作成済みの S3Inventory の一覧を取得する"""
+        for inventory in self._Inventories.values():
+            inventory.load()
+
+    def saveInventories(self):
+        for inventory in self._Inventories.values():
+            inventory.save()
+
+    def report(self):
+        u"""アップロード先ごとのリクエスト数をログに出力する"""
+        for bucket in self._Buckets.values():
+            if bucket is not None:
+                bucket.report()
+
 
 class ConnectedS3Info(S3Info):
 
-    def __init__(self, s3info):
+    def __init__(self, s3info, inventoryCache=None, inventoryMaxAge=None):
+        super(ConnectedS3Info, self).__init__(inventoryCache=inventoryCache, inventoryMaxAge=inventoryMaxAge)
         self._S3Info = s3info
         self._S3 = None
 
@@ -39,8 +109,632 @@ class ConnectedS3Info(S3Info):
             aws_secret_access_key=self._S3Info['aws_secret_access_key'],
         )
 
-    def getBucket(self, key):
+    def _OpenBucket(self, key):
         buckets = self._S3Info['buckets']
         if key not in buckets:
             return None
-        return self._S3.Bucket(buckets[key])
+        return S3Storage(self._S3.Bucket(buckets[key]))
+
+
+class LocalS3Info(S3Info):
+    u"""root の下の key ごとのディレクトリを S3 のバケットの代わりに使用する
+
+    AWS なしでアップロードの処理を試したり、リクエスト数や速度を計測したりするためのもの。
+    """
+
+    def __init__(self, root, latency=0.0, bandwidth=None, inventoryCache=None, inventoryMaxAge=None):
+        super(LocalS3Info, self).__init__(inventoryCache=inventoryCache, inventoryMaxAge=inventoryMaxAge)
+        self._Root = root
+        self._Latency = latency
+        self._Bandwidth = bandwidth
+
+    def _OpenBucket(self, key):
+        return LocalStorage(
+            os.path.join(self._Root, key),
+            name=key,
+            latency=self._Latency,
+            bandwidth=self._Bandwidth,
+        )
+
+
+class S3Inventory(object):
+    u"""バケットのオブジェクトの一覧 (サイズ, ETag, 更新日時) を保持する
+
+    最初に参照した時に Storage.list() (S3 では ListObjectsV2) で一覧を取得し、以降の参照はメモリ上で行う。
+    cacheFile を指定すると一覧をファイルに保存し、maxAge 秒以内であれば
+    バケットの一覧を取得せずにファイルから読み込む。
+    アップロードしたオブジェクトは put() で一覧に反映する。
+    """
+
+    MAX_AGE = 3600
+
+    def __init__(self, bucket, cacheFile=None, maxAge=None):
+        self._Logger = logging.getLogger(self.__class__.__name__)
+        self._Bucket = bucket
+        self._CacheFile = cacheFile
+        if maxAge is None:
+            maxAge = self.MAX_AGE
+        self._MaxAge = maxAge
+        # key -> {'size': バイト数, 'etag': ETag, 'mtime': 更新日時 (epoch 秒)}
+        self._Objects = None
+        # 一覧を取得した時刻
+        self._Listed = None
+        # put() したキー
+        self._Updated = set()
+        # remove() したキー
+        self._Removed = set()
+
+    @property
+    def name(self):
+        return self._Bucket.name
+
+    def load(self):
+        u"""一覧を取得していなければ、キャッシュのファイルまたはバケットから取得する"""
+        if self._Objects is not None:
+            return
+        if self._LoadCache():
+            return
+        self._Logger.info('Listing s3://%s...', self.name)
+        startTime = time.time()
+        objects = {}
+        for item in self._Bucket.list():
+            objects[item['key']] = {
+                'size': item['size'],
+                'etag': item['etag'],
+                'mtime': item['mtime'],
+            }
+        self._Objects = objects
+        self._Listed = startTime
+        self._Logger.info(
+            '  %s objects in s3://%s took %ss',
+            len(objects),
+            self.name,
+            int(time.time() - startTime),
+        )
+        self._Updated = set()
+        self._Removed = set()
+        self.save(force=True)
+
+    def _LoadCache(self):
+        if not self._CacheFile or not os.path.exists(self._CacheFile):
+            return False
+        try:
+            with open(self._CacheFile, 'r') as fh:
+                cache = json.load(fh)
+        except ValueError as e:
+            self._Logger.warning('Ignored broken inventory %s: %s', self._CacheFile, e)
+            return False
+        if cache.get('bucket') != self.name:
+            return False
+        if time.time() - cache.get('listed', 0) > self._MaxAge:
+            self._Logger.debug('Inventory %s is expired', self._CacheFile)
+            return False
+        self._Objects = cache['objects']
+        self._Listed = cache['listed']
+        self._Logger.debug('Loaded inventory of s3://%s from %s', self.name, self._CacheFile)
+        return True
+
+    def get(self, key):
+        u"""key のオブジェクトの情報を返す。無い場合は None"""
+        self.load()
+        return self._Objects.get(key)
+
+    def put(self, key, size, mtime, etag=None):
+        u"""アップロードしたオブジェクトを一覧に反映する"""
+        self.load()
+        self._Objects[key] = {
+            'size': size,
+            'etag': etag,
+            'mtime': int(mtime),
+        }
+        self._Updated.add(key)
+        self._Removed.discard(key)
+
+    def remove(self, key):
+        u"""削除したオブジェクトを一覧から取り除く"""
+        self.load()
+        self._Objects.pop(key, None)
+        self._Updated.discard(key)
+        self._Removed.add(key)
+
+    def items(self):
+        u"""(key, get(key) と同じ情報) のリストを返す"""
+        self.load()
+        return list(self._Objects.items())
+
+    def save(self, force=False):
+        u"""cacheFile に一覧を保存する
+
+        同じ一覧を元に他のプロセスが put() したオブジェクトを失わないよう、
+        保存済みのファイルが同じ時刻の一覧であれば、put() したものだけを反映する。
+        """
+        if not self._CacheFile or self._Objects is None:
+            return
+        if not force and not self._Updated and not self._Removed:
+            return
+        objects = self._Objects
+        if not force and os.path.exists(self._CacheFile):
+            try:
+                with open(self._CacheFile, 'r') as fh:
+                    cache = json.load(fh)
+            except ValueError:
+                cache = {}
+            if cache.get('bucket') == self.name and cache.get('listed') == self._Listed:
+                objects = cache['objects']
+                for key in self._Updated:
+                    if key in self._Objects:
+                        objects[key] = self._Objects[key]
+                for key in self._Removed:
+                    objects.pop(key, None)
+        cacheDir = os.path.dirname(self._CacheFile)
+        if cacheDir:
+            os.makedirs(cacheDir, exist_ok=True)
+        tmpFile = '{0}.{1}.tmp'.format(self._CacheFile, os.getpid())
+        with open(tmpFile, 'w') as fh:
+            json.dump({
+                'bucket': self.name,
+                'listed': self._Listed,
+                'objects': objects,
+            }, fh)
+        os.rename(tmpFile, self._CacheFile)
+        self._Updated = set()
+        self._Removed = set()
+
+
+class ETagCache(object):
+    u"""ローカルのファイルの MD5 と、S3 の ETag と同じ形式の値を計算して保持する
+
+    S3 の ETag は 1 回の PUT でアップロードした場合はファイルの MD5、
+    マルチパートアップロードの場合はパートごとの MD5 を連結したものの MD5 に "-パート数" を付けたもの。
+    (パス, サイズ, 更新日時) が変わらない限り再計算しない。
+    cacheFile を指定すると計算結果をファイルに保存し、次回以降も使用する。
+    """
+
+    # boto3 の TransferConfig の既定値
+    DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+    MIN_CHUNK_SIZE = 5 * 1024 * 1024
+    MAX_PARTS = 10000
+    # 1 回に読み込むバイト数
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, cacheFile=None):
+        self._Logger = logging.getLogger(self.__class__.__name__)
+        self._CacheFile = cacheFile
+        # path -> {'size': バイト数, 'mtime': 更新日時, 'md5': MD5, 'etags': {パートのバイト数: ETag}}
+        self._Entries = {}
+        # 計算したパス
+        self._Updated = set()
+        if cacheFile and os.path.exists(cacheFile):
+            try:
+                with open(cacheFile, 'r') as fh:
+                    self._Entries = json.load(fh)
+            except ValueError as e:
+                self._Logger.warning('Ignored broken hash cache %s: %s', cacheFile, e)
+
+    def _Entry(self, path):
+        stat = os.stat(path)
+        entry = self._Entries.get(path)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = self._Entries[path] = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'md5': None,
+                'etags': {},
+            }
+        return entry
+
+    @classmethod
+    def partSize(cls, size, chunkSize):
+        u"""boto3 が chunkSize で size バイトをアップロードする場合のパートのバイト数"""
+        chunkSize = max(chunkSize, cls.MIN_CHUNK_SIZE)
+        while math.ceil(size / chunkSize) > cls.MAX_PARTS:
+            chunkSize *= 2
+        return chunkSize
+
+    def _Compute(self, path, entry, chunkSize):
+        u"""ファイルを 1 回読み込み、MD5 と chunkSize の ETag を計算する"""
+        self._Logger.debug('Hashing %s', path)
+        md5 = hashlib.md5()
+        parts = []
+        part = hashlib.md5()
+        partBytes = 0
+        with open(path, 'rb') as fh:
+            while True:
+                block = fh.read(min(self.BLOCK_SIZE, chunkSize - partBytes))
+                if not block:
+                    break
+                md5.update(block)
+                part.update(block)
+                partBytes += len(block)
+                if partBytes == chunkSize:
+                    parts.append(part.digest())
+                    part = hashlib.md5()
+                    partBytes = 0
+        if partBytes:
+            parts.append(part.digest())
+        entry['md5'] = md5.hexdigest()
+        entry['etags'][str(chunkSize)] = '{0}-{1}'.format(
+            hashlib.md5(b''.join(parts)).hexdigest(),
+            len(parts),
+        )
+        self._Updated.add(path)
+
+    def md5(self, path):
+        entry = self._Entry(path)
+        if entry['md5'] is None:
+            self._Compute(path, entry, self.DEFAULT_CHUNK_SIZE)
+        return entry['md5']
+
+    def etag(self, path, chunkSize=None):
+        u"""path を chunkSize (マルチパートの閾値とパートのバイト数) でアップロードした場合の ETag を返す"""
+        if chunkSize is None:
+            chunkSize = self.DEFAULT_CHUNK_SIZE
+        entry = self._Entry(path)
+        if entry['size'] < chunkSize:
+            return self.md5(path)
+        partSize = self.partSize(entry['size'], chunkSize)
+        if str(partSize) not in entry['etags']:
+            self._Compute(path, entry, partSize)
+        return entry['etags'][str(partSize)]
+
+    def matches(self, path, etag, chunkSize=None):
+        u"""S3 の ETag が path と同じ内容のものかを返す
+
+        マルチパートの ETag はパートのバイト数によって変わるため、
+        chunkSize、boto3 の既定値、パート数から推測したバイト数 (MB 単位) で計算して比較する。
+        """
+        etag = etag.strip('"')
+        if '-' not in etag:
+            return self.md5(path) == etag
+        try:
+            parts = int(etag.rsplit('-', 1)[1])
+        except ValueError:
+            return False
+        size = self._Entry(path)['size']
+        unit = 1024 * 1024
+        candidates = [chunkSize or self.DEFAULT_CHUNK_SIZE, self.DEFAULT_CHUNK_SIZE]
+        if parts > 0:
+            candidates.append(int(math.ceil(size / parts / unit)) * unit)
+        for partSize in candidates:
+            if partSize <= 0 or size < partSize or math.ceil(size / partSize) != parts:
+                continue
+            if self.etag(path, partSize) == etag:
+                return True
+        return False
+
+    def save(self):
+        u"""cacheFile に計算結果を保存する。他のプロセスが保存したものは残す"""
+        if not self._CacheFile or not self._Updated:
+            return
+        entries = {}
+        if os.path.exists(self._CacheFile):
+            try:
+                with open(self._CacheFile, 'r') as fh:
+                    entries = json.load(fh)
+            except ValueError:
+                entries = {}
+        for path in self._Updated:
+            entries[path] = self._Entries[path]
+        cacheDir = os.path.dirname(self._CacheFile)
+        if cacheDir:
+            os.makedirs(cacheDir, exist_ok=True)
+        tmpFile = '{0}.{1}.tmp'.format(self._CacheFile, os.getpid())
+        with open(tmpFile, 'w') as fh:
+            json.dump(entries, fh)
+        os.rename(tmpFile, self._CacheFile)
+        self._Updated = set()
+
+
+class StorageError(Exception):
+    u"""Storage の操作の失敗。再試行できる"""
+
+
+class Storage(object):
+    u"""アップロード先 (バケット) のインターフェース
+
+    list(): すべてのオブジェクトの {'key', 'size', 'etag', 'mtime'} を返す
+    stat(key): オブジェクトの {'key', 'size', 'etag', 'mtime', 'metadata'}、無い場合は None を返す
+    put(key, path): 1 回のリクエストでアップロードする
+    putMultipart(key, path, chunkSize, threads): chunkSize ごとのパートに分けてアップロードする
+    delete(keys): オブジェクトをまとめて削除する
+    失敗した場合は StorageError を投げる。
+    callback(bytes) にはアップロードしたバイト数を順に渡す (複数のスレッドから呼び出す場合がある)。
+    requests は実行したリクエストの種類ごとの回数。
+    """
+
+    def __init__(self, name):
+        self._Logger = logging.getLogger(self.__class__.__name__)
+        self.name = name
+        self.requests = collections.Counter()
+        self._Lock = threading.Lock()
+
+    def _Count(self, request, n=1):
+        with self._Lock:
+            self.requests[request] += n
+
+    def list(self):
+        raise NotImplementedError()
+
+    def stat(self, key):
+        raise NotImplementedError()
+
+    def put(self, key, path, metadata=None, callback=None):
+        raise NotImplementedError()
+
+    def putMultipart(self, key, path, chunkSize, threads=None, metadata=None, callback=None):
+        raise NotImplementedError()
+
+    def delete(self, keys):
+        raise NotImplementedError()
+
+    def upload(self, key, path, chunkSize=None, threads=None, metadata=None, callback=None):
+        u"""boto3 の upload_file と同じく、chunkSize 以上のファイルはマルチパートでアップロードする"""
+        if chunkSize is None:
+            chunkSize = ETagCache.DEFAULT_CHUNK_SIZE
+        if os.path.getsize(path) < chunkSize:
+            self.put(key, path, metadata=metadata, callback=callback)
+        else:
+            self.putMultipart(key, path, chunkSize, threads=threads, metadata=metadata, callback=callback)
+
+    def report(self):
+        if self.requests:
+            self._Logger.info(
+                'Requests to %s: %s',
+                self.name,
+                ', '.join('%s %s' % item for item in sorted(self.requests.items())),
+            )
+
+
+class S3Storage(Storage):
+    u"""boto3 の Bucket を使用する Storage"""
+
+    # put() でマルチパートにしないための閾値
+    SINGLE_PUT_THRESHOLD = 5 * 1024 * 1024 * 1024
+    # DeleteObjects の 1 回のリクエストで削除できるオブジェクト数
+    DELETE_BATCH = 1000
+
+    def __init__(self, bucket):
+        super(S3Storage, self).__init__(bucket.name)
+        self._Bucket = bucket
+
+    def list(self):
+        import botocore.exceptions
+        paginator = self._Bucket.meta.client.get_paginator('list_objects_v2')
+        try:
+            for page in paginator.paginate(Bucket=self.name):
+                self._Count('ListObjectsV2')
+                for item in page.get('Contents', []):
+                    yield {
+                        'key': item['Key'],
+                        'size': item['Size'],
+                        'etag': item['ETag'].strip('"'),
+                        'mtime': int(calendar.timegm(item['LastModified'].utctimetuple())),
+                    }
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            raise StorageError(e)
+
+    def stat(self, key):
+        import botocore.exceptions
+        object = self._Bucket.Object(key)
+        self._Count('HeadObject')
+        try:
+            object.load()
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == '404':
+                return None
+            raise StorageError(e)
+        except botocore.exceptions.BotoCoreError as e:
+            raise StorageError(e)
+        return {
+            'key': key,
+            'size': object.content_length,
+            'etag': object.e_tag.strip('"'),
+            'mtime': int(calendar.timegm(object.last_modified.utctimetuple())),
+            'metadata': object.metadata or {},
+        }
+
+    def _Upload(self, key, path, config, metadata, callback):
+        import boto3.exceptions
+        import botocore.exceptions
+        kwargs = {'Config': config}
+        if callback is not None:
+            kwargs['Callback'] = callback
+        if metadata:
+            kwargs['ExtraArgs'] = {'Metadata': metadata}
+        try:
+            self._Bucket.Object(key).upload_file(path, **kwargs)
+        except (boto3.exceptions.S3UploadFailedError, botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            raise StorageError(e)
+
+    def put(self, key, path, metadata=None, callback=None):
+        import boto3.s3.transfer
+        self._Count('PutObject')
+        config = boto3.s3.transfer.TransferConfig(multipart_threshold=self.SINGLE_PUT_THRESHOLD)
+        self._Upload(key, path, config, metadata, callback)
+
+    def putMultipart(self, key, path, chunkSize, threads=None, metadata=None, callback=None):
+        import boto3.s3.transfer
+        partSize = ETagCache.partSize(os.path.getsize(path), chunkSize)
+        self._Count('CreateMultipartUpload')
+        self._Count('UploadPart', int(math.ceil(os.path.getsize(path) / partSize)))
+        self._Count('CompleteMultipartUpload')
+        kwargs = {
+            'multipart_threshold': chunkSize,
+            'multipart_chunksize': chunkSize,
+        }
+        if threads:
+            kwargs['max_concurrency'] = threads
+        self._Upload(key, path, boto3.s3.transfer.TransferConfig(**kwargs), metadata, callback)
+
+    def delete(self, keys):
+        import botocore.exceptions
+        keys = list(keys)
+        for index in range(0, len(keys), self.DELETE_BATCH):
+            self._Count('DeleteObjects')
+            try:
+                response = self._Bucket.meta.client.delete_objects(
+                    Bucket=self.name,
+                    Delete={
+                        'Objects': [{'Key': key} for key in keys[index:index + self.DELETE_BATCH]],
+                        'Quiet': True,
+                    },
+                )
+            except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+                raise StorageError(e)
+            errors = response.get('Errors', [])
+            if errors:
+                raise StorageError('Failed to delete {0} objects: {1}'.format(len(errors), errors[0]))
+
+
+class LocalStorage(Storage):
+    u"""ローカルのディレクトリを S3 のバケットとして扱う Storage
+
+    オブジェクトは root/key に、ETag とメタデータは root/.meta/key.json に保存する。
+    リクエストごとに latency 秒待ち、bandwidth (バイト/秒) を指定すると
+    接続ごとにその速度で転送したものとして待つ。
+    errorRate の割合でリクエストを失敗させ、再試行の動作を確かめられる。
+    """
+
+    META_DIR = '.meta'
+    # list() の 1 回のリクエストで返すオブジェクト数
+    PAGE_SIZE = 1000
+    # delete() の 1 回のリクエストで削除するオブジェクト数
+    DELETE_BATCH = 1000
+    # 1 回に複写するバイト数
+    BLOCK_SIZE = 1024 * 1024
+    DEFAULT_THREADS = 10
+
+    def __init__(self, root, name=None, latency=0.0, bandwidth=None, errorRate=0.0):
+        super(LocalStorage, self).__init__(name or os.path.basename(root))
+        self._Root = root
+        self._Latency = latency
+        self._Bandwidth = bandwidth
+        self._ErrorRate = errorRate
+
+    def _Request(self, request):
+        self._Count(request)
+        if self._Latency:
+            time.sleep(self._Latency)
+        if self._ErrorRate and random.random() < self._ErrorRate:
+            raise StorageError('Simulated {0} failure'.format(request))
+
+    def _Path(self, key):
+        return os.path.join(self._Root, *key.split('/'))
+
+    def _MetaPath(self, key):
+        return os.path.join(self._Root, self.META_DIR, *key.split('/')) + '.json'
+
+    def list(self):
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(self._Root):
+            if dirpath == self._Root and self.META_DIR in dirnames:
+                dirnames.remove(self.META_DIR)
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                keys.append(os.path.relpath(path, self._Root).replace(os.sep, '/'))
+        keys.sort()
+        for index in range(0, max(len(keys), 1), self.PAGE_SIZE):
+            self._Request('ListObjectsV2')
+            for key in keys[index:index + self.PAGE_SIZE]:
+                info = self._Stat(key)
+                if info is not None:
+                    del info['metadata']
+                    yield info
+
+    def stat(self, key):
+        self._Request('HeadObject')
+        return self._Stat(key)
+
+    def _Stat(self, key):
+        path = self._Path(key)
+        if not os.path.isfile(path):
+            return None
+        meta = {}
+        if os.path.exists(self._MetaPath(key)):
+            with open(self._MetaPath(key), 'r') as fh:
+                meta = json.load(fh)
+        stat = os.stat(path)
+        return {
+            'key': key,
+            'size': stat.st_size,
+            'etag': meta.get('etag') or ETagCache().md5(path),
+            'mtime': int(stat.st_mtime),
+            'metadata': meta.get('metadata', {}),
+        }
+
+    def _Transfer(self, rh, wh, offset, size, digest, callback):
+        u"""rh の offset から size バイトを wh の同じ位置に複写する"""
+        start = time.perf_counter()
+        rh.seek(offset)
+        wh.seek(offset)
+        remaining = size
+        while remaining > 0:
+            block = rh.read(min(self.BLOCK_SIZE, remaining))
+            if not block:
+                break
+            wh.write(block)
+            digest.update(block)
+            remaining -= len(block)
+            if callback is not None:
+                callback(len(block))
+        if self._Bandwidth:
+            wait = size / self._Bandwidth - (time.perf_counter() - start)
+            if wait > 0:
+                time.sleep(wait)
+
+    def _Commit(self, key, tmpPath, etag, metadata):
+        path = self._Path(key)
+        metaPath = self._MetaPath(key)
+        os.makedirs(os.path.dirname(metaPath), exist_ok=True)
+        with open(metaPath, 'w') as fh:
+            json.dump({'etag': etag, 'metadata': metadata or {}}, fh)
+        os.rename(tmpPath, path)
+
+    def _TmpPath(self, key):
+        path = self._Path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return '{0}.{1}.{2}.tmp'.format(path, os.getpid(), threading.get_ident())
+
+    def put(self, key, path, metadata=None, callback=None):
+        self._Request('PutObject')
+        tmpPath = self._TmpPath(key)
+        digest = hashlib.md5()
+        with open(path, 'rb') as rh, open(tmpPath, 'wb') as wh:
+            self._Transfer(rh, wh, 0, os.path.getsize(path), digest, callback)
+        self._Commit(key, tmpPath, digest.hexdigest(), metadata)
+
+    def putMultipart(self, key, path, chunkSize, threads=None, metadata=None, callback=None):
+        size = os.path.getsize(path)
+        partSize = ETagCache.partSize(size, chunkSize)
+        self._Request('CreateMultipartUpload')
+        tmpPath = self._TmpPath(key)
+        with open(tmpPath, 'wb') as wh:
+            wh.truncate(size)
+
+        def uploadPart(offset):
+            self._Request('UploadPart')
+            digest = hashlib.md5()
+            with open(path, 'rb') as rh, open(tmpPath, 'r+b') as wh:
+                self._Transfer(rh, wh, offset, min(partSize, size - offset), digest, callback)
+            return digest.digest()
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=(threads or self.DEFAULT_THREADS)) as pool:
+                digests = list(pool.map(uploadPart, range(0, size, partSize)))
+            self._Request('CompleteMultipartUpload')
+        except StorageError:
+            os.unlink(tmpPath)
+            raise
+        etag = '{0}-{1}'.format(hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+        self._Commit(key, tmpPath, etag, metadata)
+
+    def delete(self, keys):
+        keys = list(keys)
+        for index in range(0, len(keys), self.DELETE_BATCH):
+            self._Request('DeleteObjects')
+            for key in keys[index:index + self.DELETE_BATCH]:
+                for path in (self._Path(key), self._MetaPath(key)):
+                    if os.path.exists(path):
+                        os.unlink(path)
@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import mmap
+import struct
+
+# https://wiki.mobileread.com/wiki/PDB
+# https://wiki.mobileread.com/wiki/MOBI
+# https://www.mobileread.com/forums/showthread.php?t=96903
+
+
+NULL = 0xFFFFFFFF
+
+
+class SRCSStripper(object):
+    u"""kindlegen の出力から SRCS (元の epub) のレコードを取り除く
+
+    kindlestrip と同じく、SRCS のレコードは長さ 0 にしてレコード番号は変えず、
+    レコード 0 の SRCS の位置と数を消す。
+    入力はメモリマップで参照し、残す部分を順に出力先に書き込むため、
+    本の大きさによらず使用するメモリは CHUNK_SIZE 程度で済む。
+    """
+
+    # PDB ヘッダー
+    RECORD_COUNT = 76
+    RECORD_TABLE = 78
+    # レコード 0 の先頭からの位置
+    SRCS_INDEX = 224
+    # 1 回の write で書き込む最大のバイト数
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, fh):
+        self._Map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._Parse()
+        except Exception:
+            self._Map.close()
+            raise
+
+    def close(self):
+        self._Map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _Parse(self):
+        data = self._Map
+        if data[60:68] != b'BOOKMOBI':
+            raise ValueError('Not a mobi file')
+        count, = struct.unpack_from('>H', data, self.RECORD_COUNT)
+        self._Offsets = [
+            struct.unpack_from('>L', data, self.RECORD_TABLE + index * 8)[0]
+            for index in range(count)
+        ] + [len(data)]
+
+        self.srcsIndex, self.srcsCount = NULL, 0
+        if self._Offsets[1] - self._Offsets[0] >= self.SRCS_INDEX + 8:
+            self.srcsIndex, self.srcsCount = struct.unpack_from('>LL', data, self._Offsets[0] + self.SRCS_INDEX)
+        if self.srcsIndex == NULL or self.srcsCount == 0:
+            self.srcsIndex, self.srcsCount = NULL, 0
+            return
+        if self.srcsIndex == 0 or self.srcsIndex + self.srcsCount > count:
+            raise ValueError('Invalid SRCS records: {0}+{1}'.format(self.srcsIndex, self.srcsCount))
+        start = self._Offsets[self.srcsIndex]
+        if data[start:start + 4] != b'SRCS':
+            raise ValueError('Record {0} is not SRCS'.format(self.srcsIndex))
+
+    @property
+    def srcsBytes(self):
+        u"""取り除くレコードのバイト数"""
+        if not self.srcsCount:
+            return 0
+        return self._Offsets[self.srcsIndex + self.srcsCount] - self._Offsets[self.srcsIndex]
+
+    def write(self, fh):
+        u"""SRCS を取り除いた mobi を fh に書き込む"""
+        data = self._Map
+        if not self.srcsCount:
+            self._WriteRange(fh, 0, len(data))
+            return
+
+        srcsStart = self._Offsets[self.srcsIndex]
+        srcsEnd = self._Offsets[self.srcsIndex + self.srcsCount]
+        srcsBytes = srcsEnd - srcsStart
+
+        # レコードテーブルの SRCS 以降の位置を詰める
+        table = bytearray(data[:self._Offsets[0]])
+        for index in range(self.srcsIndex + 1, len(self._Offsets) - 1):
+            if index < self.srcsIndex + self.srcsCount:
+                offset = srcsStart
+            else:
+                offset = self._Offsets[index] - srcsBytes
+            struct.pack_into('>L', table, self.RECORD_TABLE + index * 8, offset)
+        fh.write(table)
+
+        record0 = bytearray(data[self._Offsets[0]:self._Offsets[1]])
+        struct.pack_into('>LL', record0, self.SRCS_INDEX, NULL, 0)
+        fh.write(record0)
+
+        self._WriteRange(fh, self._Offsets[1], srcsStart)
+        self._WriteRange(fh, srcsEnd, len(data))
+
+    def _WriteRange(self, fh, start, end):
+        while start < end:
+            size = min(end - start, self.CHUNK_SIZE)
+            fh.write(self._Map[start:start + size])
+            start += size
+
+
+def stripFile(fromFile, toFile):
+    u"""fromFile から SRCS を取り除いて toFile に書き込み、取り除いたバイト数を返す
+
+    SRCS が無い場合はそのまま複写する。
+    """
+    with open(fromFile, 'rb') as rh, SRCSStripper(rh) as stripper, open(toFile, 'wb') as wh:
+        stripper.write(wh)
+        return stripper.srcsBytes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', dest='verbose', action='count', default=0)
+    parser.add_argument('mobi')
+    parser.add_argument('output')
+    opts = parser.parse_args()
+    level = logging.INFO
+    if opts.verbose:
+        level = logging.DEBUG
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)s: %(message)s',
+        level=level,
+    )
+    stripped = stripFile(opts.mobi, opts.output)
+    logging.info('Stripped %s bytes', stripped)
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import os.path
+import random
+import threading
+import time
+
+import backgroundpool
+import s3
+
+
+def backoffDelay(attempt, backoff=1.0, maxBackoff=30.0):
+    u"""attempt 回目 (1 から) の失敗の後に再試行まで待つ秒数を返す
+
+    full jitter: 指数的に伸ばした上限までの一様な時間待つ。
+    """
+    return random.uniform(0, min(maxBackoff, backoff * 2 ** (attempt - 1)))
+
+
+class UploadJob(object):
+    u"""bucket (s3.Storage) への 1 ファイルのアップロード
+
+    失敗した場合は retries 回まで、指数的に伸ばした時間に揺らぎを加えて待ってから再試行する。
+    run() の後、succeeded, error, attempts, bytes, seconds を参照できる。
+    """
+
+    # 進捗をログに出力する間隔 (秒)
+    PROGRESS_INTERVAL = 10
+
+    def __init__(self, bucket, key, path, metadata=None):
+        self._Logger = logging.getLogger(self.__class__.__name__)
+        self.bucket = bucket
+        self.key = key
+        self.path = path
+        # オブジェクトに付けるユーザー定義のメタデータ
+        self.metadata = metadata
+        self.error = None
+        self.attempts = 0
+        self.bytes = None
+        self.seconds = None
+        self.finishedAt = None
+        self._Lock = threading.Lock()
+        self._Transferred = 0
+        self._Reported = None
+
+    @property
+    def name(self):
+        return 's3://{0}/{1}'.format(self.bucket.name, self.key)
+
+    @property
+    def succeeded(self):
+        return self.finishedAt is not None and self.error is None
+
+    def run(self, chunkSize=None, threads=None, retries=3, backoff=1.0, maxBackoff=30.0):
+        self.bytes = os.path.getsize(self.path)
+        start = time.perf_counter()
+        self._Reported = start
+        while True:
+            self.attempts += 1
+            self._Transferred = 0
+            try:
+                self.bucket.upload(
+                    self.key,
+                    self.path,
+                    chunkSize=chunkSize,
+                    threads=threads,
+                    metadata=self.metadata,
+                    callback=self._Progress,
+                )
+                self.error = None
+            except s3.StorageError as e:
+                self.error = e
+                if self.attempts <= retries:
+                    delay = backoffDelay(self.attempts, backoff, maxBackoff)
+                    self._Logger.warning(
+                        '  Uploading to %s failed. Retrying in %.1fs...: %s',
+                        self.name,
+                        delay,
+                        e,
+                    )
+                    time.sleep(delay)
+                    continue
+            break
+        self.seconds = time.perf_counter() - start
+        self.finishedAt = time.time()
+        return self
+
+    def _Progress(self, transferred):
+        # マルチパートの場合は複数のスレッドから呼び出される
+        with self._Lock:
+            self._Transferred += transferred
+            now = time.perf_counter()
+            if now - self._Reported < self.PROGRESS_INTERVAL:
+                return
+            self._Reported = now
+            done = self._Transferred
+        self._Logger.info(
+            '  Uploading to %s: %s%% of %s bytes',
+            self.name,
+            done * 100 // max(self.bytes, 1),
+            self.bytes,
+        )
+
+
+class UploadQueue(backgroundpool.BackgroundPool):
+    u"""s3.Storage へのアップロードをバックグラウンドで実行する
+
+    submit(job, finish) でアップロードを登録し、完了した job は finish(job) で後処理を行う。
+    KindlegenPool と同じく backgroundpool.BackgroundPool で、
+    finish は submit/poll/wait を呼び出したスレッドで呼び出す。
+    失敗した job も finish に渡すので、job.succeeded を確認すること。
+    workers が 0 の場合は submit の中でアップロードする。
+    chunkSize はマルチパートアップロードのパートのバイト数、
+    threads は 1 ファイルのパートを並行にアップロードするスレッド数。
+    """
+
+    NAME = 'upload'
+    PENDING_PER_WORKER = 4
+
+    def __init__(self, workers=0, chunkSize=None, threads=None, retries=3, backoff=1.0, maxBackoff=30.0, maxPending=None):
+        super(UploadQueue, self).__init__(workers, maxPending=maxPending)
+        self._ChunkSize = chunkSize
+        self._Threads = threads
+        self._Retries = retries
+        self._Backoff = backoff
+        self._MaxBackoff = maxBackoff
+        # 全体の集計
+        self._Files = 0
+        self._Bytes = 0
+        self._Failures = 0
+        self._Started = None
+        self._Finished = None
+
+    @property
+    def failures(self):
+        return self._Failures
+
+    @property
+    def chunkSize(self):
+        u"""マルチパートアップロードの閾値とパートのバイト数。None は boto3 の既定値"""
+        return self._ChunkSize
+
+    def _run(self, job):
+        return job.run(
+            chunkSize=self._ChunkSize,
+            threads=self._Threads,
+            retries=self._Retries,
+            backoff=self._Backoff,
+            maxBackoff=self._MaxBackoff,
+        )
+
+    def submit(self, job, finish):
+        if self._Started is None:
+            self._Started = time.time()
+        super(UploadQueue, self).submit(job, finish)
+
+    def _done(self, job, finish):
+        self._Finished = max(self._Finished or job.finishedAt, job.finishedAt)
+        if job.succeeded:
+            self._Files += 1
+            self._Bytes += job.bytes
+        else:
+            self._Failures += 1
+        finish(job)
+
+    def report(self):
+        # job.run が例外を投げた場合など、完了した job が無いこともある
+        if self._Started is None or self._Finished is None:
+            return
+        seconds = max(self._Finished - self._Started, 0.001)
+        self._Logger.info(
+            'Uploaded %s files, %s bytes in %ss (%.2f MB/s)',
+            self._Files,
+            self._Bytes,
+            int(seconds),
+            self._Bytes / seconds / 1024 / 1024,
+        )
+        if self._Failures:
+            self._Logger.error('Failed to upload %s files', self._Failures)
+
+    def shutdown(self):
+        try:
+            super(UploadQueue, self).shutdown()
+        finally:
+            self.report()
@@ -15,11 +15,146 @@ sys.path.append(os.path.join(
 
 NOVEL_VERSION=1606645800
 
+import bookscheduler
 import createepub
 import createmobi
 import imageoptimizer
 import indextool
+import kindlegenpool
+import mirrorsync
+import pagecache
+import pageexecutor
 import s3
+import uploadqueue
+
+
+class Converter(object):
+    u"""opts から copier とそれが共有するオブジェクトを作成する
+
+    --jobs の場合はワーカーのプロセスごとにも作成する。
+    """
+
+    def __init__(self, opts):
+        self._Opts = opts
+        self._S3Info = s3.getS3Info(
+            inventoryCache=opts.s3InventoryCache,
+            inventoryMaxAge=opts.s3InventoryMaxAge,
+            localRoot=opts.s3Local,
+            localLatency=opts.s3LocalLatency / 1000.0,
+            localBandwidth=(opts.s3LocalBandwidth * 1024 * 1024 if opts.s3LocalBandwidth else None),
+        )
+        cache = None
+        if opts.pageCache:
+            cache = pagecache.PageCache(opts.pageCache, opts.pageCacheSize * 1024 * 1024)
+        self.executor = pageexecutor.PageExecutor(opts.pageExecutor, opts.pageWorkers, cache=cache)
+        self.kindlegen = kindlegenpool.KindlegenPool(opts.kindlegenWorkers, timeout=opts.kindlegenTimeout)
+        self.s3Hashes = None
+        if opts.s3CompareHash:
+            self.s3Hashes = s3.ETagCache(opts.s3HashCache)
+        self.uploads = uploadqueue.UploadQueue(
+            opts.s3UploadWorkers,
+            chunkSize=(opts.s3ChunkSize * 1024 * 1024 if opts.s3ChunkSize else None),
+            threads=opts.s3UploadThreads,
+        )
+        self._Encoder = imageoptimizer.JpegEncoder(
+            quality=opts.jpegQuality,
+            optimize=opts.jpegOptimize,
+            progressive=opts.jpegProgressive,
+            subsampling=opts.jpegSubsampling,
+            maxBytes=(opts.pageBytes * 1024 if opts.pageBytes else None),
+        )
+        self._BandMemory = opts.bandMemory * 1024 * 1024 if opts.bandMemory else None
+        self._Copiers = {}
+
+    @property
+    def stats(self):
+        return self.executor.stats
+
+    def copiers(self, kind):
+        u"""kind (出力先のディレクトリ) の copier のリストを返す"""
+        if kind not in self._Copiers:
+            self._Copiers[kind] = getattr(self, '_' + kind)()
+        return self._Copiers[kind]
+
+    def _novels(self):
+        opts = self._Opts
+        optimizer = imageoptimizer.ImageOptimizer(
+            whitespace=imageoptimizer.ImageOptimizer.WHITESPACE_CLEAN,
+            encoder=self._Encoder,
+            bandMemory=self._BandMemory,
+            detectGray=opts.detectGray,
+        )
+        copier = [createepub.ZipToKepubEpub(optimizer, executor=self.executor, singlePass=opts.singlePass)]
+        if opts.mobi:
+            copier.append(createmobi.ZipToMobi(optimizer, s3Bucket=self._S3Info.getBucket('novel'), s3Inventory=self._S3Info.getInventory('novel'), executor=self.executor, singlePass=opts.singlePass, kindlegenPool=self.kindlegen, uploadQueue=self.uploads, s3Hashes=self.s3Hashes, nativeMobi=opts.nativeMobi))
+        else:
+            copier.append(createmobi.ZipToMobi(None, skip=True))
+        for c in copier:
+            c.VERSION = NOVEL_VERSION
+        return copier
+
+    def _comics(self):
+        opts = self._Opts
+        optimizer = imageoptimizer.ImageOptimizer(
+            whitespace=imageoptimizer.ImageOptimizer.WHITESPACE_NONE,
+            boldize=False,
+            encoder=self._Encoder,
+            bandMemory=self._BandMemory,
+            detectGray=opts.detectGray,
+        )
+        copier = [createepub.ZipToKepubEpub(optimizer, executor=self.executor, singlePass=opts.singlePass)]
+        if opts.mobi:
+            copier.append(createmobi.ZipToMobi(optimizer, s3Bucket=self._S3Info.getBucket('comic'), s3Inventory=self._S3Info.getInventory('comic'), executor=self.executor, singlePass=opts.singlePass, kindlegenPool=self.kindlegen, uploadQueue=self.uploads, s3Hashes=self.s3Hashes, nativeMobi=opts.nativeMobi))
+        else:
+            copier.append(createmobi.ZipToMobi(None, skip=True))
+        return copier
+
+    @property
+    def failures(self):
+        u"""kindlegen 以降の後処理に失敗した本の数"""
+        return sum(
+            getattr(copier, 'failures', 0)
+            for copiers in self._Copiers.values()
+            for copier in copiers
+        )
+
+    def wait(self):
+        self.kindlegen.wait()
+        self.uploads.wait()
+        # --jobs のワーカーは shutdown() しないため、本ごとにアップロードを一覧に保存する
+        self._S3Info.saveInventories()
+        if self.s3Hashes is not None:
+            self.s3Hashes.save()
+
+    def loadInventories(self):
+        u"""作成済みの copier がアップロードするバケットの一覧を取得する"""
+        self._S3Info.loadInventories()
+
+    def mirror(self, paths):
+        u"""出力先の paths (カレントディレクトリからの相対パス) を mirror のバケットに同期する"""
+        bucket = self._S3Info.getBucket('mirror')
+        if bucket is None:
+            logging.warning('--mirror needs the mirror bucket in s3.json')
+            return
+        mirror = mirrorsync.MirrorSync(
+            bucket,
+            self._S3Info.getInventory('mirror'),
+            self.uploads,
+            hashes=self.s3Hashes,
+            delete=self._Opts.mirrorDelete,
+            dryRun=self._Opts.mirrorDryRun,
+        )
+        mirror.sync('.', paths)
+
+    def shutdown(self):
+        # kindlegen の後処理でアップロードを登録するので、その後にアップロードを待つ
+        self.kindlegen.shutdown()
+        self.uploads.shutdown()
+        self._S3Info.saveInventories()
+        self._S3Info.report()
+        if self.s3Hashes is not None:
+            self.s3Hashes.save()
+        self.executor.shutdown()
 
 
 if __name__ == '__main__':
@@ -30,6 +165,41 @@ if __name__ == '__main__':
     parser.add_argument('--max', dest='max', type=int, default=-1)
     parser.add_argument('--only', dest='only')
     parser.add_argument('--comics', dest='comics', action='store_true')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1, help='convert this many books in parallel processes')
+    parser.add_argument('--page-workers', dest='pageWorkers', type=int, default=1)
+    parser.add_argument(
+        '--page-executor',
+        dest='pageExecutor',
+        choices=[pageexecutor.PageExecutor.THREAD, pageexecutor.PageExecutor.PROCESS],
+        default=pageexecutor.PageExecutor.THREAD,
+    )
+    parser.add_argument('--single-pass', dest='singlePass', action='store_true')
+    parser.add_argument('--page-cache', dest='pageCache')
+    parser.add_argument('--page-cache-size', dest='pageCacheSize', type=int, default=1024, help='MB')
+    parser.add_argument('--jpeg-quality', dest='jpegQuality', type=int)
+    parser.add_argument('--jpeg-optimize', dest='jpegOptimize', action='store_true')
+    parser.add_argument('--jpeg-progressive', dest='jpegProgressive', action='store_true')
+    parser.add_argument('--jpeg-subsampling', dest='jpegSubsampling', choices=['4:4:4', '4:2:2', '4:2:0'])
+    parser.add_argument('--page-bytes', dest='pageBytes', type=int, help='max KB per page')
+    parser.add_argument('--intermediate-memory', dest='bandMemory', type=int, help='MB per page worker for working buffers (processed in bands); decoded pages are still held whole')
+    parser.add_argument('--no-detect-gray', dest='detectGray', action='store_false', help='keep RGB pages without colors as RGB')
+    parser.add_argument('--kindlegen-workers', dest='kindlegenWorkers', type=int, default=0, help='run kindlegen in background while optimizing next books')
+    parser.add_argument('--native-mobi', dest='nativeMobi', action='store_true', help='write mobi without kindlegen')
+    parser.add_argument('--kindlegen-timeout', dest='kindlegenTimeout', type=int, help='seconds per kindlegen run')
+    parser.add_argument('--s3-inventory-cache', dest='s3InventoryCache', help='directory to keep S3 bucket listings between runs and --jobs workers')
+    parser.add_argument('--s3-inventory-max-age', dest='s3InventoryMaxAge', type=int, help='seconds to reuse a cached S3 bucket listing')
+    parser.add_argument('--s3-upload-workers', dest='s3UploadWorkers', type=int, default=0, help='upload to S3 in background while converting next books')
+    parser.add_argument('--s3-chunk-size', dest='s3ChunkSize', type=int, help='MB per part of multipart S3 uploads')
+    parser.add_argument('--s3-upload-threads', dest='s3UploadThreads', type=int, help='threads to upload parts of one file')
+    parser.add_argument('--s3-compare-hash', dest='s3CompareHash', action='store_true', help='upload to S3 only when MD5/ETag differs instead of comparing mtime')
+    parser.add_argument('--s3-hash-cache', dest='s3HashCache', help='JSON file to keep local hashes between runs')
+    parser.add_argument('--s3-local', dest='s3Local', help='upload to this directory instead of S3 to measure uploads offline')
+    parser.add_argument('--s3-local-latency', dest='s3LocalLatency', type=int, default=0, help='ms per request with --s3-local')
+    parser.add_argument('--s3-local-bandwidth', dest='s3LocalBandwidth', type=int, help='MB/s per connection with --s3-local')
+    parser.add_argument('--mirror', dest='mirror', action='store_true', help='sync output tree to the mirror bucket')
+    parser.add_argument('--mirror-dry-run', dest='mirrorDryRun', action='store_true', help='with --mirror, show planned transfers without uploading or deleting')
+    parser.add_argument('--mirror-delete', dest='mirrorDelete', action='store_true', help='delete objects in the mirror bucket missing locally')
+    parser.add_argument('--stats', dest='stats', help='write per-stage timings to this JSON file')
     opts = parser.parse_args()
     level = logging.INFO
     if opts.verbose:
@@ -41,71 +211,74 @@ if __name__ == '__main__':
     for name in ['boto3', 'botocore', 's3transfer', 'urllib3']:
         logging.getLogger(name).setLevel(logging.WARNING)
 
-    s3info = s3.getS3Info()
+    converter = Converter(opts)
+    scheduler = None
+    if opts.jobs > 1:
+        # 変換する本を集めてからプロセスプールで変換し、index.html はその後に書き込む
+        scheduler = bookscheduler.BookScheduler(opts.jobs, Converter, opts, stats=converter.stats)
 
     indexer = indextool.Indexer()
-    optimizer = imageoptimizer.ImageOptimizer(
-        whitespace=imageoptimizer.ImageOptimizer.WHITESPACE_CLEAN,
-    )
-    copier = [createepub.ZipToKepubEpub(optimizer)]
-    if opts.mobi:
-        copier.append(createmobi.ZipToMobi(optimizer, s3Bucket=s3info.getBucket('novel')))
-    else:
-        copier.append(createmobi.ZipToMobi(None, skip=True))
-    for c in copier:
-        c.VERSION = NOVEL_VERSION
-    fileList = []
     scanner = indextool.IndexScanner(indexer, ['.zip'])
-    generator = indextool.CopyingIndexGenerator(
-        '../novels',
-        'novels',
-        copier,
-    )
-    result = scanner.scan(generator, '小説一覧', '../novels', '../../.lib/.js', opts)
-    fileList.extend([
-        {
-            'filename': os.path.join('novels', file['filename']),
-            'index': file['index'],
-            'author': file['author'],
-            'title': file['title'],
-            'mtime': file['mtime'],
-        }
-        for file in result['fileList']
-    ])
-
+    targets = [
+        ('novels', '小説一覧', '../novels'),
+    ]
     if opts.comics:
-        optimizer = imageoptimizer.ImageOptimizer(
-            whitespace=imageoptimizer.ImageOptimizer.WHITESPACE_NONE,
-            boldize=False,
-        )
-        copier = [createepub.ZipToKepubEpub(optimizer)]
-        if opts.mobi:
-            copier.append(createmobi.ZipToMobi(optimizer, s3Bucket=s3info.getBucket('comic')))
-        else:
-            copier.append(createmobi.ZipToMobi(skip=True))
-        generator = indextool.CopyingIndexGenerator(
-            '../zip',
-            'comics',
-            copier,
-        )
-        result = scanner.scan(generator, '漫画一覧', '../zip', '../../.lib/.js', opts)
-        fileList.extend([
-            {
-                'filename': os.path.join('comics', file['filename']),
-                'index': file['index'],
-                'author': file['author'],
-                'title': file['title'],
-                'mtime': file['mtime'],
-            }
-            for file in result['fileList']
-        ])
-
-    indexer.save()
-    fileList.sort(key=(lambda x: -x['mtime']))
-    with open('index.json', 'wb') as f:
-        f.write(json.dumps(
-            fileList,
-            ensure_ascii=False,
-            indent=4,
-            sort_keys=True,
-        ).encode('utf-8'))
+        targets.append(('comics', '漫画一覧', '../zip'))
+
+    def scanTargets():
+        fileList = []
+        for kind, title, fromDir in targets:
+            generator = indextool.CopyingIndexGenerator(
+                fromDir,
+                kind,
+                converter.copiers(kind),
+                scheduler=scheduler,
+            )
+            result = scanner.scan(generator, title, fromDir, '../../.lib/.js', opts)
+            if result is None:
+                # すべての本の変換に失敗した場合など
+                continue
+            fileList.extend([
+                {
+                    'filename': os.path.join(kind, file['filename']),
+                    'index': file['index'],
+                    'author': file['author'],
+                    'title': file['title'],
+                    'mtime': file['mtime'],
+                }
+                for file in result['fileList']
+            ])
+        return fileList
+
+    try:
+        fileList = scanTargets()
+        if scheduler is not None:
+            if opts.s3InventoryCache:
+                # ワーカーがそれぞれバケットの一覧を取得しないよう、先に取得して保存する
+                converter.loadInventories()
+            scheduler.run()
+            fileList = scanTargets()
+
+        indexer.save()
+        fileList.sort(key=(lambda x: -x['mtime']))
+        with open('index.json', 'wb') as f:
+            f.write(json.dumps(
+                fileList,
+                ensure_ascii=False,
+                indent=4,
+                sort_keys=True,
+            ).encode('utf-8'))
+
+        if opts.mirror and opts.dryrun:
+            # -n では変換も index.html の更新もしないため、同期の予定が実際と異なる
+            logging.warning('--mirror is skipped with -n; use --mirror-dry-run to show planned transfers')
+        elif opts.mirror:
+            # kindlegen の完了を待ってから出力先を同期する
+            converter.wait()
+            converter.mirror([kind for kind, _, _ in targets if os.path.isdir(kind)] + ['index.json'])
+    finally:
+        converter.shutdown()
+    if converter.stats.total.counter('pages'):
+        logging.info('Stages: %s', converter.stats.total.format())
+    if opts.stats:
+        converter.stats.save(opts.stats)
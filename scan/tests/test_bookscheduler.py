@@ -0,0 +1,179 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import os.path
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(
+    os.path.dirname(__file__),
+    '../.lib'
+))
+
+import bookscheduler
+import pagestats
+
+
+class StubCopier(object):
+    u"""ZipToMobi と同じく --max, --only を plan() で判定し、convert() で toDir に書き出す
+
+    path に broken を含む本は convert() で例外を投げる。
+    """
+
+    def __init__(self, ext, stats):
+        self._Logger = logging.getLogger(self.__class__.__name__)
+        self._count = 0
+        self._Ext = ext
+        self._Stats = stats
+
+    def plan(self, file, toDir, opts):
+        result = {
+            'filename': file['basename'] + self._Ext,
+            'path': os.path.join(toDir, file['basename'] + self._Ext),
+        }
+        only = getattr(opts, 'only', None)
+        if only and not file['path'].startswith(only):
+            return None, False
+        maxCount = getattr(opts, 'max', -1)
+        if maxCount >= 0 and self._count >= maxCount:
+            return None, False
+        self._count = self._count + 1
+        return result, True
+
+    def convert(self, file, toDir):
+        if 'broken' in file['path']:
+            raise ValueError('broken zip')
+        stats = self._Stats.beginBook(file['basename'] + self._Ext)
+        stats.count('pages')
+        with open(os.path.join(toDir, file['basename'] + self._Ext), 'w') as fh:
+            fh.write(str(os.getpid()))
+        self._Stats.endBook()
+        self._Logger.info('Converted %s', file['basename'] + self._Ext)
+
+
+class StubConverter(object):
+    u"""index.Converter の代わりに BookScheduler に渡す factory"""
+
+    def __init__(self, opts):
+        self.stats = pagestats.StatsCollector()
+        self.failures = 0
+        self._Copiers = {}
+
+    def copiers(self, kind):
+        if kind not in self._Copiers:
+            self._Copiers[kind] = [StubCopier('.epub', self.stats), StubCopier('.mobi', self.stats)]
+        return self._Copiers[kind]
+
+    def wait(self):
+        pass
+
+
+class KindlegenFailingCopier(StubCopier):
+
+    def __init__(self, converter, ext, stats):
+        super(KindlegenFailingCopier, self).__init__(ext, stats)
+        self._Converter = converter
+
+    def convert(self, file, toDir):
+        super(KindlegenFailingCopier, self).convert(file, toDir)
+        if 'kindlegen' in file['path']:
+            os.unlink(os.path.join(toDir, file['basename'] + self._Ext))
+            self._Converter.failures += 1
+
+
+class KindlegenFailingConverter(StubConverter):
+    u"""path に kindlegen を含む本は、kindlegen の後処理が失敗した場合と同じく
+    mobi を書き出さず、例外を投げずに failures を増やす
+    """
+
+    def copiers(self, kind):
+        if kind not in self._Copiers:
+            self._Copiers[kind] = [
+                StubCopier('.epub', self.stats),
+                KindlegenFailingCopier(self, '.mobi', self.stats),
+            ]
+        return self._Copiers[kind]
+
+
+class BookSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._TmpDir = tempfile.TemporaryDirectory()
+        self.fromDir = os.path.join(self._TmpDir.name, 'zip')
+        self.toDir = os.path.join(self._TmpDir.name, 'novels')
+        os.makedirs(self.toDir)
+
+    def tearDown(self):
+        self._TmpDir.cleanup()
+
+    def file(self, basename):
+        return {
+            'path': os.path.join(self.fromDir, basename + '.zip'),
+            'basename': basename,
+        }
+
+    def schedule(self, factory, opts, basenames):
+        u"""planning と run() を行い、(scheduler, 1 回目の結果, 2 回目の結果, 集計) を返す"""
+        stats = pagestats.StatsCollector()
+        scheduler = bookscheduler.BookScheduler(2, factory, opts, stats=stats)
+        copiers = factory(opts).copiers('novels')
+        files = [self.file(basename) for basename in basenames]
+        self.assertTrue(scheduler.planning)
+        planned = [scheduler('novels', copiers, file, self.toDir, opts) for file in files]
+        scheduler.run()
+        self.assertFalse(scheduler.planning)
+        results = [scheduler('novels', copiers, file, self.toDir, opts) for file in files]
+        return scheduler, planned, results, stats
+
+    def outputs(self):
+        return sorted(os.listdir(self.toDir))
+
+    def testMax(self):
+        opts = argparse.Namespace(max=2, only=None)
+        with self.assertLogs(level=logging.INFO) as logs:
+            scheduler, planned, results, stats = self.schedule(StubConverter, opts, ['a', 'b', 'c'])
+        self.assertEqual(planned[2], [None, None])
+        self.assertEqual([result[1]['filename'] for result in planned[:2]], ['a.mobi', 'b.mobi'])
+        self.assertEqual(results, planned)
+        self.assertEqual(self.outputs(), ['a.epub', 'a.mobi', 'b.epub', 'b.mobi'])
+        self.assertEqual(scheduler.failures, 0)
+        self.assertEqual(stats.total.counter('pages'), 4)
+
+        # ワーカーのログは本ごとにまとめて呼び出し元で出力する
+        messages = [record.getMessage() for record in logs.records if record.name == 'StubCopier']
+        self.assertEqual(sorted(messages), ['Converted a.epub', 'Converted a.mobi', 'Converted b.epub', 'Converted b.mobi'])
+        for book in ('a', 'b'):
+            index = messages.index('Converted {0}.epub'.format(book))
+            self.assertEqual(messages[index + 1], 'Converted {0}.mobi'.format(book))
+
+    def testOnly(self):
+        opts = argparse.Namespace(max=-1, only=self.file('b')['path'])
+        scheduler, planned, results, stats = self.schedule(StubConverter, opts, ['a', 'b', 'c'])
+        self.assertEqual(planned[0], [None, None])
+        self.assertEqual(planned[2], [None, None])
+        self.assertEqual(results, planned)
+        self.assertEqual(self.outputs(), ['b.epub', 'b.mobi'])
+
+    def testFailures(self):
+        opts = argparse.Namespace(max=-1, only=None)
+        with self.assertLogs(level=logging.INFO) as logs:
+            scheduler, planned, results, stats = self.schedule(KindlegenFailingConverter, opts, ['a', 'broken', 'kindlegen'])
+        self.assertEqual(scheduler.failures, 2)
+        self.assertEqual(planned[1][0]['filename'], 'broken.epub')
+        # 変換に失敗した本は index.html に含めない
+        self.assertEqual(results[0], planned[0])
+        self.assertEqual(results[1], [None, None])
+        self.assertEqual(results[2], [None, None])
+        self.assertEqual(self.outputs(), ['a.epub', 'a.mobi', 'kindlegen.epub'])
+
+        failed = [record for record in logs.records if record.getMessage().startswith('Failed to convert /')]
+        self.assertEqual([record.getMessage() for record in failed], ['Failed to convert ' + self.file('broken')['path']])
+        self.assertIn('ValueError: broken zip', failed[0].exc_text)
+
+
+if __name__ == '__main__':
+    unittest.main()
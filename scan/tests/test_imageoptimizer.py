@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import io
+import os.path
+import sys
+import unittest
+
+import PIL.Image
+
+sys.path.append(os.path.join(
+    os.path.dirname(__file__),
+    '../.lib'
+))
+
+import imageoptimizer
+
+
+def colorPage():
+    u"""色のある RGB の JPEG のバイト列を返す"""
+    image = PIL.Image.new('RGB', (200, 300))
+    image.putdata([(x, y % 256, 128) for y in range(300) for x in range(200)])
+    out = io.BytesIO()
+    image.save(out, format='jpeg', quality=95)
+    return out.getvalue()
+
+
+class PassthroughTest(unittest.TestCase):
+
+    def optimize(self, data, encoder=None):
+        optimizer = imageoptimizer.ImageOptimizer(
+            whitespace=imageoptimizer.ImageOptimizer.WHITESPACE_NONE,
+            encoder=encoder,
+        )
+        optimizer.reset()
+        optimizer.prepare_optimize()
+        out = io.BytesIO()
+        optimizer.optimize('page.jpg', io.BytesIO(data), out)
+        return out.getvalue(), optimizer.takeStats()
+
+    def testColorPagePassesThrough(self):
+        data = colorPage()
+        output, stats = self.optimize(data)
+        self.assertEqual(output, data)
+        self.assertEqual(stats.counter('passthrough'), 1)
+
+    def testMaxBytesKeepsPassthrough(self):
+        data = colorPage()
+        output, stats = self.optimize(data, imageoptimizer.JpegEncoder(maxBytes=len(data)))
+        self.assertEqual(output, data)
+        self.assertEqual(stats.counter('passthrough'), 1)
+
+    def testQualityReencodes(self):
+        data = colorPage()
+        for encoder in (
+            imageoptimizer.JpegEncoder(quality=40),
+            imageoptimizer.JpegEncoder(progressive=True),
+            imageoptimizer.JpegEncoder(optimize=True),
+            imageoptimizer.JpegEncoder(subsampling='4:2:0'),
+        ):
+            output, stats = self.optimize(data, encoder)
+            self.assertNotEqual(output, data, encoder.parameters())
+            self.assertEqual(stats.counter('passthrough'), 0, encoder.parameters())
+        output, _ = self.optimize(data, imageoptimizer.JpegEncoder(quality=40))
+        self.assertLess(len(output), len(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(
+    os.path.dirname(__file__),
+    '../.lib'
+))
+
+import mirrorsync
+import s3
+import uploadqueue
+
+
+class MirrorSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self._TmpDir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self._TmpDir.name, 'epub')
+        self.bucketRoot = os.path.join(self._TmpDir.name, 'bucket')
+        self.write('index.json', b'[]')
+        self.write('novels/index.html', b'<html></html>')
+        self.write('novels/a.mobi', b'new book')
+        self.write('novels/b.mobi', b'changed book')
+        # 隠しファイルと書き込み中のファイルは同期しない
+        self.write('novels/.lock', b'')
+        self.write('novels/c.mobi.tmp', b'partial')
+
+        bucket = s3.LocalStorage(self.bucketRoot)
+        self.upload(bucket, 'novels/index.html', b'<html></html>')
+        self.upload(bucket, 'novels/b.mobi', b'old book')
+        self.upload(bucket, 'novels/old.mobi', b'removed book')
+        # paths に含まれない場所のものは削除しない
+        self.upload(bucket, 'comics/x.mobi', b'comic')
+        # アップロード先の mtime の方が新しくなるよう、ローカルのファイルを 1 日前にする
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                os.utime(path, (stat.st_atime, stat.st_mtime - 86400))
+        os.utime(self.path('novels/b.mobi'))
+
+    def tearDown(self):
+        self._TmpDir.cleanup()
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def write(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fh:
+            fh.write(data)
+
+    def upload(self, bucket, key, data):
+        path = os.path.join(self._TmpDir.name, 'upload')
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        bucket.put(key, path)
+        os.unlink(path)
+
+    def mirror(self, hashes=None, delete=False, dryRun=False):
+        u"""(MirrorSync, アップロード先の LocalStorage) を返す"""
+        info = s3.LocalS3Info(self._TmpDir.name)
+        bucket = info.getBucket('bucket')
+        return mirrorsync.MirrorSync(
+            bucket,
+            info.getInventory('bucket'),
+            uploadqueue.UploadQueue(0),
+            hashes=hashes,
+            delete=delete,
+            dryRun=dryRun,
+        ), bucket
+
+    def remote(self, key):
+        path = os.path.join(self.bucketRoot, *key.split('/'))
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as fh:
+            return fh.read()
+
+    def testPlan(self):
+        mirror, _ = self.mirror()
+        self.assertEqual(mirror.plan(self.root, ['novels', 'index.json']), [
+            (mirrorsync.MirrorSync.ADD, 'index.json', self.path('index.json')),
+            (mirrorsync.MirrorSync.ADD, 'novels/a.mobi', self.path('novels/a.mobi')),
+            (mirrorsync.MirrorSync.UPDATE, 'novels/b.mobi', self.path('novels/b.mobi')),
+            (mirrorsync.MirrorSync.DELETE, 'novels/old.mobi', None),
+        ])
+
+    def testPlanWithHashes(self):
+        # 内容で比較する場合は、サイズが同じでも内容が異なれば更新し、更新日時は見ない
+        self.write('novels/b.mobi', b'old book')
+        os.utime(self.path('novels/index.html'))
+        mirror, _ = self.mirror(hashes=s3.ETagCache())
+        self.assertEqual(
+            [(action, key) for action, key, _ in mirror.plan(self.root, ['novels'])],
+            [(mirrorsync.MirrorSync.ADD, 'novels/a.mobi'), (mirrorsync.MirrorSync.DELETE, 'novels/old.mobi')],
+        )
+        self.write('novels/b.mobi', b'new book')
+        self.assertEqual(
+            [(action, key) for action, key, _ in mirror.plan(self.root, ['novels'])],
+            [
+                (mirrorsync.MirrorSync.ADD, 'novels/a.mobi'),
+                (mirrorsync.MirrorSync.UPDATE, 'novels/b.mobi'),
+                (mirrorsync.MirrorSync.DELETE, 'novels/old.mobi'),
+            ],
+        )
+
+    def testSync(self):
+        mirror, bucket = self.mirror(delete=True)
+        self.assertEqual(mirror.sync(self.root, ['novels', 'index.json']), 0)
+        self.assertEqual(self.remote('index.json'), b'[]')
+        self.assertEqual(self.remote('novels/a.mobi'), b'new book')
+        self.assertEqual(self.remote('novels/b.mobi'), b'changed book')
+        self.assertIsNone(self.remote('novels/old.mobi'))
+        self.assertIsNone(self.remote('novels/c.mobi.tmp'))
+        self.assertIsNone(self.remote('novels/.lock'))
+        self.assertEqual(self.remote('comics/x.mobi'), b'comic')
+        self.assertEqual(bucket.requests['PutObject'], 3)
+        self.assertEqual(bucket.requests['DeleteObjects'], 1)
+
+        # 同期した後は何もしない
+        mirror, _ = self.mirror(delete=True)
+        self.assertEqual(mirror.plan(self.root, ['novels', 'index.json']), [])
+
+    def testSyncKeepsOrphans(self):
+        mirror, bucket = self.mirror()
+        self.assertEqual(mirror.sync(self.root, ['novels']), 0)
+        self.assertEqual(self.remote('novels/old.mobi'), b'removed book')
+        self.assertEqual(bucket.requests['DeleteObjects'], 0)
+
+    def testDryRun(self):
+        mirror, bucket = self.mirror(delete=True, dryRun=True)
+        with self.assertLogs('MirrorSync', 'INFO') as logs:
+            self.assertEqual(mirror.sync(self.root, ['novels', 'index.json']), 0)
+        self.assertEqual(dict(bucket.requests), {'ListObjectsV2': 1})
+        self.assertEqual(self.remote('novels/b.mobi'), b'old book')
+        self.assertEqual(self.remote('novels/old.mobi'), b'removed book')
+        self.assertIsNone(self.remote('novels/a.mobi'))
+        messages = '\n'.join(logs.output)
+        self.assertIn('(dryrun) ADD: {0} -> s3://bucket/novels/a.mobi'.format(self.path('novels/a.mobi')), messages)
+        self.assertIn('(dryrun) UPDATE: {0} -> s3://bucket/novels/b.mobi'.format(self.path('novels/b.mobi')), messages)
+        self.assertIn('(dryrun) DELETE: s3://bucket/novels/old.mobi', messages)
+
+
+if __name__ == '__main__':
+    unittest.main()
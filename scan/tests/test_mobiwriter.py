@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import datetime
+import io
+import os.path
+import struct
+import sys
+import unittest
+
+import PIL.Image
+
+sys.path.append(os.path.join(
+    os.path.dirname(__file__),
+    '../.lib'
+))
+
+import mobiwriter
+
+
+def decodeInt(data, pos):
+    u"""mobiwriter.encodeInt の逆。(値, 次の位置) を返す"""
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte & 0x80:
+            return value, pos
+
+
+def readPdb(data):
+    u"""PDB のレコードのリストを返す"""
+    count, = struct.unpack_from('>H', data, 76)
+    offsets = [
+        struct.unpack_from('>L', data, 78 + index * 8)[0]
+        for index in range(count)
+    ] + [len(data)]
+    return [data[offsets[index]:offsets[index + 1]] for index in range(count)]
+
+
+def readIndex(records, first):
+    u"""records[first] から始まる INDX を読み、(TAGX, [(ラベル, {タグ番号: 値のリスト})], CNCX のレコード) を返す"""
+    header = records[first]
+    assert header[:4] == b'INDX'
+    headerLength, = struct.unpack_from('>L', header, 4)
+    recordCount, = struct.unpack_from('>L', header, 24)
+    entryCount, = struct.unpack_from('>L', header, 36)
+    cncxCount, = struct.unpack_from('>L', header, 52)
+
+    assert header[headerLength:headerLength + 4] == b'TAGX'
+    tagxLength, controlBytes = struct.unpack_from('>LL', header, headerLength + 4)
+    assert controlBytes == 1
+    tagx = []
+    for pos in range(headerLength + 12, headerLength + tagxLength, 4):
+        number, valuesPerEntry, mask, end = struct.unpack_from('>BBBB', header, pos)
+        if end:
+            break
+        tagx.append((number, valuesPerEntry, mask))
+
+    entries = []
+    for record in records[first + 1:first + 1 + recordCount]:
+        assert record[:4] == b'INDX'
+        idxt, count = struct.unpack_from('>LL', record, 20)
+        assert record[idxt:idxt + 4] == b'IDXT'
+        for index in range(count):
+            pos, = struct.unpack_from('>H', record, idxt + 4 + index * 2)
+            labelLength = record[pos]
+            label = record[pos + 1:pos + 1 + labelLength].decode('utf-8')
+            pos += 1 + labelLength
+            control = record[pos]
+            pos += 1
+            tags = {}
+            for number, valuesPerEntry, mask in tagx:
+                if not control & mask:
+                    continue
+                shift = (mask & -mask).bit_length() - 1
+                values = []
+                for _ in range(((control & mask) >> shift) * valuesPerEntry):
+                    value, pos = decodeInt(record, pos)
+                    values.append(value)
+                tags[number] = values
+            entries.append((label, tags))
+    assert len(entries) == entryCount
+    cncx = records[first + 1 + recordCount:first + 1 + recordCount + cncxCount]
+    return tagx, entries, cncx
+
+
+def readCncx(cncx, offset):
+    record = cncx[offset // 0x10000]
+    length, pos = decodeInt(record, offset % 0x10000)
+    return record[pos:pos + length].decode('utf-8')
+
+
+class MobiWriterTest(unittest.TestCase):
+
+    SIZES = [(600, 800), (640, 900), (600, 800)]
+
+    def setUp(self):
+        writer = mobiwriter.MobiWriter(
+            u'テスト',
+            author=u'作者',
+            published=datetime.datetime(2020, 1, 2, tzinfo=datetime.timezone.utc),
+        )
+        for index, size in enumerate(self.SIZES):
+            image = PIL.Image.new('L', size, index * 64)
+            out = io.BytesIO()
+            image.save(out, format='jpeg')
+            writer.addPage(out.getvalue())
+        out = io.BytesIO()
+        writer.write(out)
+        self.data = out.getvalue()
+        self.records = readPdb(self.data)
+        self.record0 = self.records[0]
+
+    def header(self, offset):
+        return struct.unpack_from('>L', self.record0, offset)[0]
+
+    def text(self):
+        textLength, textRecords = struct.unpack_from('>LH', self.record0, 4)
+        text = b''
+        for record in self.records[1:1 + textRecords]:
+            # 末尾のバイトはマルチバイト文字の続きの長さ
+            text += record[:len(record) - 1 - record[-1]]
+        self.assertEqual(len(text), textLength)
+        return text
+
+    def testRecord0(self):
+        self.assertEqual(self.data[60:68], b'BOOKMOBI')
+        self.assertEqual(self.record0[16:20], b'MOBI')
+        self.assertEqual(self.header(20), mobiwriter.MobiWriter.MOBI_HEADER_LENGTH)
+        # KF8
+        self.assertEqual(self.header(36), 8)
+        # SRCS なし
+        self.assertEqual(self.header(224), mobiwriter.NULL)
+        # 最初の画像のレコード
+        firstResource = self.header(108)
+        for index in range(len(self.SIZES)):
+            self.assertEqual(self.records[firstResource + index][:2], b'\xff\xd8')
+        exthOffset = 16 + self.header(20)
+        self.assertEqual(self.record0[exthOffset:exthOffset + 4], b'EXTH')
+        titleOffset, titleLength = self.header(84), self.header(88)
+        self.assertEqual(self.record0[titleOffset:titleOffset + titleLength].decode('utf-8'), u'テスト')
+
+    def testFdst(self):
+        fdst, fdstCount = self.header(192), self.header(196)
+        record = self.records[fdst]
+        self.assertEqual(record[:4], b'FDST')
+        self.assertEqual(struct.unpack_from('>LL', record, 4), (12, fdstCount))
+        flows = [struct.unpack_from('>LL', record, 12 + index * 8) for index in range(fdstCount)]
+        self.assertEqual(flows[0][0], 0)
+        for (_, end), (start, _) in zip(flows, flows[1:]):
+            self.assertEqual(end, start)
+        self.assertEqual(flows[-1][1], len(self.text()))
+        text = self.text()
+        self.assertEqual(text[flows[1][0]:flows[1][1]], mobiwriter.MobiWriter.CSS.encode('utf-8'))
+
+    def testSkeletonAndFragmentIndex(self):
+        text = self.text()
+        tagx, skeletons, _ = readIndex(self.records, self.header(252))
+        self.assertEqual(tagx, [(1, 1, 3), (6, 2, 12)])
+        tagx, fragments, cncx = readIndex(self.records, self.header(248))
+        self.assertEqual(tagx, [(2, 1, 1), (3, 1, 2), (4, 1, 4), (6, 2, 8)])
+        self.assertEqual(len(skeletons), len(self.SIZES))
+        self.assertEqual(len(fragments), len(self.SIZES))
+
+        for index, ((label, skeleton), (position, fragment)) in enumerate(zip(skeletons, fragments)):
+            self.assertEqual(label, 'SKEL{0:010d}'.format(index))
+            self.assertEqual(skeleton[1], [1, 1])
+            start, length = skeleton[6][:2]
+            self.assertEqual(skeleton[6][2:], [start, length])
+            skeletonText = text[start:start + length]
+            page = skeletonText.decode('utf-8')
+            width, height = self.SIZES[index]
+            self.assertIn('width={0}, height={1}'.format(width, height), page)
+
+            # フラグメントはスケルトンの </body> の位置に挿入する
+            self.assertEqual(int(position), start + skeletonText.index(b'</body>'))
+            self.assertEqual(fragment[3], [index])
+            self.assertEqual(fragment[4], [index])
+            self.assertEqual(fragment[6][0], 0)
+            selector = readCncx(cncx, fragment[2][0])
+            body = text[start + length:start + length + fragment[6][1]].decode('utf-8')
+            self.assertTrue(body.startswith('<div aid='))
+            self.assertIn('kindle:embed:{0}'.format(mobiwriter.toBase32(index + 1, 4)), body)
+            self.assertIn("'{0}'".format(page.split('<body aid="')[1].split('"')[0]), selector)
+
+    def testNcxIndex(self):
+        tagx, entries, cncx = readIndex(self.records, self.header(244))
+        self.assertEqual(tagx, [(1, 1, 1), (2, 1, 2), (3, 1, 4), (4, 1, 8), (6, 2, 128)])
+        self.assertEqual(len(entries), 1)
+        label, tags = entries[0]
+        self.assertEqual(label, '0')
+        self.assertEqual(readCncx(cncx, tags[3][0]), u'テスト')
+        self.assertEqual(tags[6], [0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
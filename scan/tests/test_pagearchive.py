@@ -0,0 +1,45 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import io
+import os.path
+import sys
+import unittest
+import zipfile
+
+sys.path.append(os.path.join(
+    os.path.dirname(__file__),
+    '../.lib'
+))
+
+import pagearchive
+
+
+class PageWriterTest(unittest.TestCase):
+
+    def testEntries(self):
+        out = io.BytesIO()
+        with zipfile.ZipFile(out, 'w') as wh, pagearchive.PageWriter(wh) as writer:
+            left, right = writer.open('content/a.1.jpg'), writer.open('content/a.2.jpg')
+            left.write(b'left')
+            left.write(b'!')
+            right.write(b'right')
+            writer.close()
+            wh.writestr('metadata.opf', b'opf')
+        with zipfile.ZipFile(out) as rh:
+            self.assertEqual(rh.read('content/a.1.jpg'), b'left!')
+            self.assertEqual(rh.read('content/a.2.jpg'), b'right')
+            self.assertEqual(rh.getinfo('content/a.1.jpg').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(writer.bytesWritten, 10)
+
+    def testErrorWhileWriting(self):
+        u"""書き込み中の例外は、開いたままのエントリで ZipFile を閉じられない例外に隠れない"""
+        out = io.BytesIO()
+        with self.assertRaises(KeyError):
+            with zipfile.ZipFile(out, 'w') as wh, pagearchive.PageWriter(wh) as writer:
+                writer.open('content/a.jpg').write(b'partial')
+                raise KeyError('optimize failed')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(
+    os.path.dirname(__file__),
+    '../.lib'
+))
+
+import pagecache
+
+
+class PageCacheTest(unittest.TestCase):
+
+    PAGE = b'\xff\xd8' + b'x' * 1000
+
+    def setUp(self):
+        self._TmpDir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self._TmpDir.name, 'cache')
+
+    def tearDown(self):
+        self._TmpDir.cleanup()
+
+    def entryBytes(self):
+        u"""PAGE を 1 つ保存した場合のファイルのバイト数"""
+        cache = pagecache.PageCache(os.path.join(self._TmpDir.name, 'probe'))
+        key = cache.key('a.jpg', b'a', {})
+        cache.put(key, [self.PAGE], {'a.jpg': []})
+        return os.path.getsize(cache._path(key))
+
+    def testKey(self):
+        cache = pagecache.PageCache(self.directory)
+        key = cache.key('a.jpg', b'data', {'quality': 80})
+        self.assertEqual(key, cache.key('a.jpg', b'data', {'quality': 80}))
+        self.assertNotEqual(key, cache.key('a.jpg', b'data', {'quality': 90}))
+        self.assertNotEqual(key, cache.key('a.jpg', b'other', {'quality': 80}))
+        self.assertNotEqual(key, cache.key('b.jpg', b'data', {'quality': 80}))
+
+    def testPutAndGet(self):
+        cache = pagecache.PageCache(self.directory)
+        key = cache.key('a.jpg', b'data', {})
+        self.assertIsNone(cache.get(key))
+        cache.put(key, [b'left', b'right!'], {'a.jpg': [{'size': [1, 2]}]})
+        self.assertEqual(cache.get(key), ([b'left', b'right!'], {'a.jpg': [{'size': [1, 2]}]}))
+
+        # ディレクトリから読み直しても使える
+        cache = pagecache.PageCache(self.directory)
+        self.assertEqual(cache.get(key)[0], [b'left', b'right!'])
+
+    def testEvictLeastRecentlyUsed(self):
+        cache = pagecache.PageCache(self.directory, maxBytes=self.entryBytes() * 5 // 2)
+        keys = [cache.key(name, b'data', {}) for name in ('a.jpg', 'b.jpg', 'c.jpg')]
+        cache.put(keys[0], [self.PAGE], {})
+        cache.put(keys[1], [self.PAGE], {})
+        # a を使ったので、c を入れると b が消える
+        self.assertIsNotNone(cache.get(keys[0]))
+        cache.put(keys[2], [self.PAGE], {})
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertIsNotNone(cache.get(keys[2]))
+        self.assertFalse(os.path.exists(cache._path(keys[1])))
+
+    def testEvictOnLoad(self):
+        cache = pagecache.PageCache(self.directory)
+        for name in ('a.jpg', 'b.jpg', 'c.jpg'):
+            cache.put(cache.key(name, b'data', {}), [self.PAGE], {})
+        cache = pagecache.PageCache(self.directory, maxBytes=self.entryBytes() * 2)
+        hits = [
+            cache.get(cache.key(name, b'data', {})) is not None
+            for name in ('a.jpg', 'b.jpg', 'c.jpg')
+        ]
+        self.assertEqual(hits.count(True), 2)
+
+    def testBrokenHeader(self):
+        cache = pagecache.PageCache(self.directory)
+        key = cache.key('a.jpg', b'data', {})
+        cache.put(key, [self.PAGE], {})
+        with open(cache._path(key), 'wb') as fh:
+            fh.write(b'{broken\n' + self.PAGE)
+        self.assertIsNone(cache.get(key))
+        self.assertFalse(os.path.exists(cache._path(key)))
+
+        # 取り除いた後は保存し直せる
+        cache.put(key, [self.PAGE], {})
+        self.assertEqual(cache.get(key), ([self.PAGE], {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import os.path
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+sys.path.append(os.path.join(
+    os.path.dirname(__file__),
+    '../.lib'
+))
+
+import s3
+
+
+MB = 1024 * 1024
+
+
+class SmallETagCache(s3.ETagCache):
+    u"""パートを小さくして、数十バイトのファイルでマルチパートの ETag を計算する"""
+
+    DEFAULT_CHUNK_SIZE = 8
+    MIN_CHUNK_SIZE = 4
+    MAX_PARTS = 4
+    BLOCK_SIZE = 3
+
+
+def multipartETag(data, partSize):
+    u"""data を partSize ごとにアップロードした場合の S3 の ETag"""
+    parts = [
+        hashlib.md5(data[start:start + partSize]).digest()
+        for start in range(0, len(data), partSize)
+    ]
+    return '{0}-{1}'.format(hashlib.md5(b''.join(parts)).hexdigest(), len(parts))
+
+
+class ETagCacheTest(unittest.TestCase):
+
+    DATA = bytes(range(20))
+
+    def setUp(self):
+        self._TmpDir = tempfile.TemporaryDirectory()
+        self.path = self.write('book.mobi', self.DATA)
+
+    def tearDown(self):
+        self._TmpDir.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self._TmpDir.name, name)
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        return path
+
+    def testSmallerThanChunk(self):
+        cache = SmallETagCache()
+        md5 = hashlib.md5(self.DATA).hexdigest()
+        self.assertEqual(cache.md5(self.path), md5)
+        # 閾値より小さいファイルは 1 回の PUT でアップロードされ、ETag は MD5
+        self.assertEqual(cache.etag(self.path, 21), md5)
+        self.assertEqual(cache.etag(self.path, 20), multipartETag(self.DATA, 20))
+        self.assertTrue(cache.etag(self.path, 20).endswith('-1'))
+
+    def testMultipart(self):
+        cache = SmallETagCache()
+        self.assertEqual(cache.etag(self.path), multipartETag(self.DATA, 8))
+        self.assertEqual(cache.etag(self.path, 5), multipartETag(self.DATA, 5))
+        self.assertTrue(cache.etag(self.path, 5).endswith('-4'))
+        # 最小のパートより小さい chunkSize は最小のパートにする
+        path = self.write('short.mobi', self.DATA[:12])
+        self.assertEqual(cache.etag(path, 2), multipartETag(self.DATA[:12], 4))
+        self.assertEqual(cache.md5(self.path), hashlib.md5(self.DATA).hexdigest())
+
+    def testPartSize(self):
+        self.assertEqual(s3.ETagCache.partSize(10000 * 8 * MB, 8 * MB), 8 * MB)
+        self.assertEqual(s3.ETagCache.partSize(10000 * 8 * MB + 1, 8 * MB), 16 * MB)
+        self.assertEqual(s3.ETagCache.partSize(10000 * 16 * MB + 1, 8 * MB), 32 * MB)
+        self.assertEqual(s3.ETagCache.partSize(1, 1), 5 * MB)
+
+        # パート数が MAX_PARTS を超える場合はパートを倍にした ETag になる
+        cache = SmallETagCache()
+        self.assertEqual(SmallETagCache.partSize(20, 4), 8)
+        self.assertEqual(cache.etag(self.path, 4), multipartETag(self.DATA, 8))
+
+    def testMatches(self):
+        cache = SmallETagCache()
+        md5 = hashlib.md5(self.DATA).hexdigest()
+        self.assertTrue(cache.matches(self.path, '"{0}"'.format(md5)))
+        self.assertFalse(cache.matches(self.path, hashlib.md5(b'other').hexdigest()))
+        self.assertTrue(cache.matches(self.path, multipartETag(self.DATA, 8)))
+        self.assertTrue(cache.matches(self.path, multipartETag(self.DATA, 5), 5))
+        self.assertFalse(cache.matches(self.path, multipartETag(self.DATA, 5)))
+        self.assertFalse(cache.matches(self.path, multipartETag(b'x' * 20, 8)))
+        self.assertFalse(cache.matches(self.path, md5 + '-x'))
+
+    def testMatchesInferredPartSize(self):
+        # 5 MB のパートで 3 パートの ETag は、chunkSize や既定値と違ってもパート数から推測して比較する
+        data = os.urandom(15 * MB - 100)
+        path = self.write('large.mobi', data)
+        cache = s3.ETagCache()
+        self.assertTrue(cache.matches(path, multipartETag(data, 5 * MB), 8 * MB))
+        self.assertFalse(cache.matches(path, multipartETag(data[:-1] + b'\0', 5 * MB), 8 * MB))
+
+    def testInvalidate(self):
+        cache = SmallETagCache()
+        with unittest.mock.patch.object(cache, '_Compute', wraps=cache._Compute) as compute:
+            etag = cache.etag(self.path)
+            self.assertEqual(cache.etag(self.path), etag)
+            self.assertEqual(cache.md5(self.path), hashlib.md5(self.DATA).hexdigest())
+            self.assertEqual(compute.call_count, 1)
+
+            # 更新日時が変わると同じサイズでも計算し直す
+            data = bytes(reversed(self.DATA))
+            self.write('book.mobi', data)
+            stat = os.stat(self.path)
+            os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+            self.assertEqual(cache.etag(self.path), multipartETag(data, 8))
+            self.assertEqual(compute.call_count, 2)
+
+            # サイズが変わった場合も計算し直す
+            data = data + b'!'
+            self.write('book.mobi', data)
+            os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+            self.assertEqual(cache.md5(self.path), hashlib.md5(data).hexdigest())
+            self.assertEqual(compute.call_count, 3)
+
+    def testSave(self):
+        cacheFile = os.path.join(self._TmpDir.name, 'cache', 'hashes.json')
+        cache = SmallETagCache(cacheFile)
+        etag = cache.etag(self.path)
+        cache.save()
+
+        cache = SmallETagCache(cacheFile)
+        with unittest.mock.patch.object(cache, '_Compute') as compute:
+            self.assertEqual(cache.etag(self.path), etag)
+            self.assertEqual(cache.md5(self.path), hashlib.md5(self.DATA).hexdigest())
+        self.assertEqual(compute.call_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
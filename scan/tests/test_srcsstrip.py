@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import datetime
+import io
+import os.path
+import struct
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+import PIL.Image
+
+sys.path.append(os.path.join(
+    os.path.dirname(__file__),
+    '../.lib'
+))
+
+import mobiwriter
+import srcsstrip
+
+
+def readPdb(data):
+    u"""PDB の (レコードの位置のリスト, レコードのリスト) を返す"""
+    count, = struct.unpack_from('>H', data, 76)
+    offsets = [
+        struct.unpack_from('>L', data, 78 + index * 8)[0]
+        for index in range(count)
+    ]
+    ends = offsets[1:] + [len(data)]
+    return offsets, [data[start:end] for start, end in zip(offsets, ends)]
+
+
+def writePdb(header, records):
+    u"""header (PDB ヘッダーの先頭 78 バイト) と records から PDB のバイト列を作る"""
+    header = bytearray(header[:78])
+    struct.pack_into('>H', header, 76, len(records))
+    offset = len(header) + len(records) * 8 + 2
+    table = b''
+    for index, record in enumerate(records):
+        table += struct.pack('>LL', offset, index * 2)
+        offset += len(record)
+    return bytes(header) + table + b'\0\0' + b''.join(records)
+
+
+class SRCSStripperTest(unittest.TestCase):
+
+    # kindlegen と同じく、EOF の前に SRCS のレコードを置く
+    SRCS = [
+        b'SRCS' + struct.pack('>LLL', 16, 0, 0) + b'epub' * 300,
+        b'CONT' + b'x' * 100,
+    ]
+
+    def setUp(self):
+        writer = mobiwriter.MobiWriter(
+            u'テスト',
+            published=datetime.datetime(2020, 1, 2, tzinfo=datetime.timezone.utc),
+        )
+        for index in range(3):
+            image = PIL.Image.new('L', (600, 800), index * 64)
+            out = io.BytesIO()
+            image.save(out, format='jpeg')
+            writer.addPage(out.getvalue())
+        out = io.BytesIO()
+        writer.write(out)
+        self.plain = out.getvalue()
+
+        _, records = readPdb(self.plain)
+        self.srcsIndex = len(records) - 1
+        records[self.srcsIndex:self.srcsIndex] = self.SRCS
+        record0 = bytearray(records[0])
+        struct.pack_into('>LL', record0, srcsstrip.SRCSStripper.SRCS_INDEX, self.srcsIndex, len(self.SRCS))
+        records[0] = bytes(record0)
+        self.data = writePdb(self.plain, records)
+
+        self._TmpDir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._TmpDir.cleanup()
+
+    def strip(self, data):
+        u"""data を stripFile に通し、(取り除いたバイト数, 出力) を返す"""
+        fromFile = os.path.join(self._TmpDir.name, 'in.mobi')
+        toFile = os.path.join(self._TmpDir.name, 'out.mobi')
+        with open(fromFile, 'wb') as fh:
+            fh.write(data)
+        stripped = srcsstrip.stripFile(fromFile, toFile)
+        with open(toFile, 'rb') as fh:
+            return stripped, fh.read()
+
+    def testStrip(self):
+        # 小さな単位で書き込んでも同じ結果になる
+        for chunkSize in (srcsstrip.SRCSStripper.CHUNK_SIZE, 7):
+            with unittest.mock.patch.object(srcsstrip.SRCSStripper, 'CHUNK_SIZE', chunkSize):
+                stripped, output = self.strip(self.data)
+            srcsBytes = sum(len(record) for record in self.SRCS)
+            self.assertEqual(stripped, srcsBytes)
+            self.assertEqual(len(output), len(self.data) - srcsBytes)
+
+            inOffsets, inRecords = readPdb(self.data)
+            outOffsets, outRecords = readPdb(output)
+            self.assertEqual(len(outRecords), len(inRecords))
+            self.assertEqual(output[:78], self.data[:78])
+
+            # SRCS より前の位置は変わらず、SRCS は長さ 0 になり、以降は SRCS の分だけ詰まる
+            srcsEnd = self.srcsIndex + len(self.SRCS)
+            self.assertEqual(outOffsets[:self.srcsIndex + 1], inOffsets[:self.srcsIndex + 1])
+            for index in range(self.srcsIndex, srcsEnd):
+                self.assertEqual(outOffsets[index], inOffsets[self.srcsIndex])
+                self.assertEqual(outRecords[index], b'')
+            for index in range(srcsEnd, len(inRecords)):
+                self.assertEqual(outOffsets[index], inOffsets[index] - srcsBytes)
+
+            # レコード 0 は SRCS の位置と数のみ変わる
+            pos = srcsstrip.SRCSStripper.SRCS_INDEX
+            self.assertEqual(struct.unpack_from('>LL', outRecords[0], pos), (srcsstrip.NULL, 0))
+            self.assertEqual(outRecords[0][:pos], inRecords[0][:pos])
+            self.assertEqual(outRecords[0][pos + 8:], inRecords[0][pos + 8:])
+            for index in range(1, len(inRecords)):
+                if not self.srcsIndex <= index < srcsEnd:
+                    self.assertEqual(outRecords[index], inRecords[index])
+
+    def testWithoutSRCS(self):
+        stripped, output = self.strip(self.plain)
+        self.assertEqual(stripped, 0)
+        self.assertEqual(output, self.plain)
+
+    def testInvalidSRCS(self):
+        offsets, records = readPdb(self.data)
+        record0 = bytearray(records[0])
+        struct.pack_into('>LL', record0, srcsstrip.SRCSStripper.SRCS_INDEX, 1, len(self.SRCS))
+        records[0] = bytes(record0)
+        with self.assertRaises(ValueError):
+            self.strip(writePdb(self.data, records))
+
+
+if __name__ == '__main__':
+    unittest.main()